@@ -16,6 +16,9 @@ import time
 
 from newrelic_plugin_agent import __version__
 from newrelic_plugin_agent import plugins
+from newrelic_plugin_agent import poller
+from newrelic_plugin_agent import statistics
+from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,8 +29,9 @@ class NewRelicPluginAgent(helper.Controller):
 
     """
     IGNORE_KEYS = ['license_key', 'proxy', 'endpoint',
-                   'poll_interval', 'wake_interval']
+                   'poll_interval', 'wake_interval', 'min_max_window']
     MAX_METRICS_PER_REQUEST = 10000
+    MIN_MAX_WINDOW = 60
     PLATFORM_URL = 'https://platform-api.newrelic.com/platform/v1/metrics'
     WAKE_INTERVAL = 60
 
@@ -43,8 +47,11 @@ class NewRelicPluginAgent(helper.Controller):
         self.endpoint = self.PLATFORM_URL
         self.http_headers = {'Accept': 'application/json',
                              'Content-Type': 'application/json'}
+        self.interval = 0
         self.last_interval_start = None
         self.min_max_values = dict()
+        self.min_max_window = int(self.config.application.get(
+            'min_max_window', self.MIN_MAX_WINDOW))
         self._wake_interval = (self.config.application.get('wake_interval') or
                                self.config.application.get('poll_interval') or
                                self.WAKE_INTERVAL)
@@ -98,6 +105,36 @@ class NewRelicPluginAgent(helper.Controller):
         if not isinstance(config, (list, tuple)):
             config = [config]
 
+        # Instances that discover other instances, such as the members of a
+        # cluster, poll all of the discovered instances from their own thread
+        for instance in [instance for instance in config
+                         if instance.get('discover')]:
+            config = [other for other in config if other is not instance]
+            thread = threading.Thread(target=self.thread_process_discovered,
+                                      kwargs={'config': instance,
+                                              'name': plugin_name,
+                                              'plugin': plugin,
+                                              'poll_interval':
+                                                  int(self._wake_interval)})
+            thread.run()
+            self.threads.append(thread)
+
+        # Socket based instances are polled together from a single thread,
+        # except for sampled instances which poll on their own schedule
+        multiplexed = [instance for instance in config
+                       if plugin.multiplexed(instance)]
+        if len(multiplexed) > 1:
+            config = [instance for instance in config
+                      if instance not in multiplexed]
+            kwargs = {'configs': multiplexed,
+                      'name': plugin_name,
+                      'plugin': plugin,
+                      'poll_interval': int(self._wake_interval)}
+            thread = threading.Thread(
+                target=self.thread_process_multiplexed, kwargs=kwargs)
+            thread.run()
+            self.threads.append(thread)
+
         for instance in config:
             thread = threading.Thread(target=self.thread_process,
                                       kwargs={'config': instance,
@@ -105,7 +142,12 @@ class NewRelicPluginAgent(helper.Controller):
                                               'plugin': plugin,
                                               'poll_interval':
                                                   int(self._wake_interval)})
-            thread.run()
+            # Sampled instances poll for most of the interval, so they are
+            # the only ones started in the background
+            if instance.get('sample_interval'):
+                thread.start()
+            else:
+                thread.run()
             self.threads.append(thread)
 
     def process(self):
@@ -115,6 +157,7 @@ class NewRelicPluginAgent(helper.Controller):
 
         """
         start_time = time.time()
+        base.expire_cluster_results()
         self.start_plugin_polling()
 
         # Sleep for a second while threads are running
@@ -133,8 +176,9 @@ class NewRelicPluginAgent(helper.Controller):
                     duration, self.next_wake_interval)
 
     def process_min_max_values(self, component):
-        """Agent keeps track of previous values, so compute the differences for
-        min/max values.
+        """Agent keeps track of previous values over a sliding window of
+        intervals, so fill in the min/max values for any metric the plugin did
+        not provide them for.
 
         :param dict component: The component to calc min/max values for
 
@@ -142,29 +186,43 @@ class NewRelicPluginAgent(helper.Controller):
         guid = component['guid']
         name = component['name']
 
-        if guid not in self.min_max_values.keys():
+        if guid not in self.min_max_values:
             self.min_max_values[guid] = dict()
 
-        if name not in self.min_max_values[guid].keys():
+        if name not in self.min_max_values[guid]:
             self.min_max_values[guid][name] = dict()
 
+        windows = self.min_max_values[guid][name]
         for metric in component['metrics']:
-            min_val, max_val = self.min_max_values[guid][name].get(metric,
-                                                                   (None, None))
-            value = component['metrics'][metric]['total']
-            if min_val is not None and min_val > value:
-                min_val = value
-
-            if max_val is None or max_val < value:
-                max_val = value
+            if metric not in windows:
+                windows[metric] = \
+                    statistics.WindowedMinMax(self.min_max_window)
+            min_val, max_val = windows[metric].add(
+                self.interval, component['metrics'][metric]['total'])
 
             if component['metrics'][metric]['min'] is None:
-                component['metrics'][metric]['min'] = min_val or value
+                component['metrics'][metric]['min'] = min_val
 
             if component['metrics'][metric]['max'] is None:
                 component['metrics'][metric]['max'] = max_val
 
-            self.min_max_values[guid][name][metric] = min_val, max_val
+    def prune_min_max_values(self):
+        """Remove the min/max windows for metrics that have not been reported
+        for the full window, keeping the agent's memory bounded as metrics
+        come and go.
+
+        """
+        expired = self.interval - self.min_max_window
+        for guid in list(self.min_max_values):
+            for name in list(self.min_max_values[guid]):
+                windows = self.min_max_values[guid][name]
+                for metric in [key for key in windows
+                               if windows[key].last_interval <= expired]:
+                    del windows[metric]
+                if not windows:
+                    del self.min_max_values[guid][name]
+            if not self.min_max_values[guid]:
+                del self.min_max_values[guid]
 
     @property
     def proxies(self):
@@ -181,6 +239,7 @@ class NewRelicPluginAgent(helper.Controller):
         return None
 
     def send_data_to_newrelic(self):
+        self.interval += 1
         metrics = 0
         components = list()
         while self.publish_queue.qsize():
@@ -207,6 +266,7 @@ class NewRelicPluginAgent(helper.Controller):
 
         LOGGER.debug('Done, will send remainder of %i metrics', metrics)
         self.send_components(components, metrics)
+        self.prune_min_max_values()
 
     def send_components(self, components, metrics):
         """Create the headers and payload to send to NewRelic platform as a
@@ -305,9 +365,68 @@ class NewRelicPluginAgent(helper.Controller):
         instance_name = "%s:%s" % (name, config.get('name', 'unnamed'))
         obj = plugin(config, poll_interval,
                      self.derive_last_interval.get(instance_name))
-        obj.poll()
+        if obj.sample_interval:
+            obj.sample()
+        else:
+            obj.poll()
         self.publish_queue.put((instance_name, obj.values(),
                                 obj.derive_last_interval))
+        return obj
+
+    def thread_process_discovered(self, name, plugin, config,
+                                  poll_interval):
+        """Created a thread process that discovers the instances from the
+        given plugin configuration and polls all of them, in parallel if the
+        plugin supports multiplexing, followed by the summary of all of the
+        instances if the plugin provides one.
+
+        :param str name: The name of the plugin
+        :param newrelic_plugin_agent.plugin.Plugin plugin: The plugin class
+        :param dict config: The plugin configuration to discover from
+        :param int poll_interval: How often the plugin is invoked
+
+        """
+        configs = plugin.discover(config)
+        LOGGER.debug('Discovered %i %s instances from %s', len(configs),
+                     name, config.get('name', 'unnamed'))
+        if all(plugin.multiplexed(instance) for instance in configs):
+            instances = self.thread_process_multiplexed(name, plugin, configs,
+                                                        poll_interval)
+        else:
+            instances = [self.thread_process(name, plugin, instance,
+                                             poll_interval)
+                         for instance in configs]
+        summary = plugin.summarize(config, instances, poll_interval)
+        if summary:
+            self.publish_queue.put(("%s:%s" % (name, config.get('name',
+                                                                'unnamed')),
+                                    summary.values(),
+                                    summary.derive_last_interval))
+
+    def thread_process_multiplexed(self, name, plugin, configs,
+                                   poll_interval):
+        """Created a thread process that polls all of the given socket based
+        plugin instances at once using the multiplexed socket poller, adding
+        the results for each instance to the publishing Queue.
+
+        :param str name: The name of the plugin
+        :param newrelic_plugin_agent.plugin.Plugin plugin: The plugin class
+        :param list configs: The plugin configuration for each instance
+        :param int poll_interval: How often the plugin is invoked
+
+        """
+        instances = list()
+        for config in configs:
+            instance_name = "%s:%s" % (name, config.get('name', 'unnamed'))
+            instances.append((instance_name,
+                              plugin(config, poll_interval,
+                                     self.derive_last_interval.get(
+                                         instance_name))))
+        poller.SocketPoller([obj for _name, obj in instances]).poll()
+        for instance_name, obj in instances:
+            self.publish_queue.put((instance_name, obj.values(),
+                                    obj.derive_last_interval))
+        return [obj for _name, obj in instances]
 
     @property
     def wake_interval(self):
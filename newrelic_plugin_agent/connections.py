@@ -0,0 +1,307 @@
+"""
+Connection pools, HTTP sessions and receive buffers that are shared by
+plugin instances for the life of the agent, so that connections to the
+services being polled are reused across poll intervals instead of being
+opened and closed every time, and replies are read without repeatedly copying
+them.
+
+"""
+import errno
+import logging
+import requests
+import socket
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SocketPool(object):
+    """A small pool of idle, connected sockets for a single target. Sockets
+    are health checked when they are taken out of the pool and discarded if
+    the remote end closed them or they sat idle for too long.
+
+    """
+    IDLE_TIMEOUT = 300
+    MAX_IDLE = 2
+
+    def __init__(self, max_idle=MAX_IDLE, idle_timeout=IDLE_TIMEOUT):
+        self.idle = list()
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.max_idle = max_idle
+
+    def clear(self):
+        """Close all of the idle sockets in the pool"""
+        with self.lock:
+            idle, self.idle = self.idle, list()
+        for connection, _last_used in idle:
+            connection.close()
+
+    def get(self):
+        """Return a healthy idle socket from the pool, or None if there are
+        none available.
+
+        :rtype: socket.socket
+
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                connection, last_used = self.idle.pop()
+            if time.time() - last_used > self.idle_timeout:
+                LOGGER.debug('Closing socket idle for %.2f seconds',
+                             time.time() - last_used)
+                connection.close()
+            elif not self.healthy(connection):
+                LOGGER.debug('Closing unhealthy pooled socket')
+                connection.close()
+            else:
+                return connection
+
+    @staticmethod
+    def healthy(connection):
+        """Check that an idle socket is still connected and has no unread
+        data waiting on it, without blocking.
+
+        :param socket.socket connection: The socket to check
+        :rtype: bool
+
+        """
+        timeout = connection.gettimeout()
+        connection.setblocking(0)
+        try:
+            connection.recv(1, socket.MSG_PEEK)
+        except socket.error as error:
+            return error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        else:
+            # Either the remote end closed the socket or there is unexpected
+            # data that would corrupt the next reply
+            return False
+        finally:
+            connection.settimeout(timeout)
+
+    def put(self, connection):
+        """Return a socket to the pool, closing it if the pool is full
+
+        :param socket.socket connection: The socket to return
+
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((connection, time.time()))
+                return
+        connection.close()
+
+
+class ReceiveBuffer(object):
+    """A growable receive buffer backed by a pre-sized bytearray. Data is
+    read directly into the free space of the buffer with recv_into, so a
+    reply is not repeatedly copied while it is received, and parsers are
+    handed a read-only view of the buffer instead of a copy.
+
+    The framing methods cover the protocols spoken by the socket plugins:
+    length-prefixed (Redis bulk strings), terminator based (memcached END)
+    and end-of-file terminated (uWSGI) replies.
+
+    """
+    INITIAL_SIZE = 65536
+    MIN_READ = 16384
+
+    def __init__(self, size=INITIAL_SIZE):
+        self.data = bytearray(size)
+        self.length = 0
+        self.matched = 0
+        self.scanned = 0
+
+    def __len__(self):
+        return self.length
+
+    def bulk_end(self, offset=0):
+        """Return the end of the length-prefixed bulk string that starts at
+        offset, or -1 if it has not been completely received yet. A negative
+        length is a null bulk string without a body.
+
+        :param int offset: Where the bulk string starts
+        :rtype: int
+
+        """
+        header = self.data.find('\r\n', offset, self.length)
+        if header == -1:
+            return -1
+        size = int(str(self.view(offset + 1, header)))
+        if size < 0:
+            return header + 2
+        end = header + 2 + size + 2
+        return end if end <= self.length else -1
+
+    def count_lines(self, pattern):
+        """Return how many lines of the received data match the line
+        anchored pattern. Only the complete lines received since the last
+        call are scanned, so calling this after every read stays linear in
+        the size of the reply. The same pattern must be used until the
+        buffer is reset.
+
+        :param re.RegexObject pattern: The pattern to match lines with
+        :rtype: int
+
+        """
+        end = self.data.rfind('\n', self.scanned, self.length) + 1
+        if end > self.scanned:
+            self.matched += len(pattern.findall(self.view(self.scanned, end)))
+            self.scanned = end
+        return self.matched
+
+    def endswith(self, suffix):
+        """Return True if the received data ends with the suffix, such as the
+        terminator of a reply.
+
+        :param str suffix: The suffix to check for
+        :rtype: bool
+
+        """
+        return self.startswith(suffix, self.length - len(suffix))
+
+    def find(self, value, start=0, end=None):
+        """Return the offset of value in the received data or -1
+
+        :param str value: The value to find
+        :param int start: Where to start searching
+        :param int end: Where to stop searching
+        :rtype: int
+
+        """
+        return self.data.find(value, start,
+                              self.length if end is None else end)
+
+    def recv(self, connection, size):
+        """Read up to size bytes from the connection into the free space of
+        the buffer, doubling the buffer when it is nearly full.
+
+        :param socket.socket connection: The connection to read from
+        :param int size: The maximum number of bytes to read
+        :return: The number of bytes read, 0 when the connection was closed
+        :rtype: int
+
+        """
+        if len(self.data) - self.length < self.MIN_READ:
+            self.data.extend(bytearray(max(len(self.data), self.MIN_READ)))
+        count = connection.recv_into(memoryview(self.data)[self.length:],
+                                     min(size, len(self.data) - self.length))
+        self.length += count
+        return count
+
+    def reset(self):
+        """Discard the received data, keeping the allocated buffer"""
+        self.length = 0
+        self.matched = 0
+        self.scanned = 0
+
+    def startswith(self, prefix, start=0):
+        """Return True if prefix is found at the start offset
+
+        :param str prefix: The prefix to check for
+        :param int start: The offset to check at
+        :rtype: bool
+
+        """
+        return (start >= 0 and
+                self.data.find(prefix, start, start + len(prefix)) == start)
+
+    def view(self, start=0, end=None):
+        """Return a read-only view of the received data without copying it.
+        The view is only valid until the buffer is reset or released.
+
+        :param int start: The start of the view
+        :param int end: The end of the view, defaults to the received length
+        :rtype: buffer
+
+        """
+        end = self.length if end is None else end
+        return buffer(self.data, start, end - start)
+
+
+HTTP_POOL_SIZE = 4
+HTTP_SESSIONS = dict()
+HTTP_SESSIONS_LOCK = threading.Lock()
+
+
+def http_session(key, pool_size=HTTP_POOL_SIZE):
+    """Return the agent-wide HTTP session for the given scheme, host and
+    user, creating it if it does not exist. Connections are kept alive
+    between polls, so HTTPS endpoints only pay for the TLS handshake when a
+    connection is first opened, and up to pool_size idle connections to the
+    host are kept. Requests never wait for a pooled connection, one is
+    opened instead, so callers only need to bound the request with a
+    timeout.
+
+    :param tuple key: The scheme, network location and user of the host
+    :param int pool_size: The maximum number of idle connections to keep
+    :rtype: requests.Session
+
+    """
+    with HTTP_SESSIONS_LOCK:
+        if key not in HTTP_SESSIONS:
+            LOGGER.debug('Creating HTTP session for %s://%s as %s', *key)
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=pool_size,
+                                                    pool_block=False)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            HTTP_SESSIONS[key] = session
+        return HTTP_SESSIONS[key]
+
+
+RECEIVE_BUFFERS = list()
+RECEIVE_BUFFERS_LOCK = threading.Lock()
+MAX_POOLED_BUFFERS = 16
+MAX_POOLED_BUFFER_SIZE = 4194304
+
+
+def receive_buffer():
+    """Return a receive buffer from the agent-wide free list, creating a new
+    one if the free list is empty.
+
+    :rtype: ReceiveBuffer
+
+    """
+    with RECEIVE_BUFFERS_LOCK:
+        if RECEIVE_BUFFERS:
+            return RECEIVE_BUFFERS.pop()
+    return ReceiveBuffer()
+
+
+def release_buffer(value):
+    """Return a receive buffer to the free list for reuse. Buffers that grew
+    very large are dropped so one large reply does not pin the memory.
+
+    :param ReceiveBuffer value: The buffer to release
+
+    """
+    value.reset()
+    if len(value.data) > MAX_POOLED_BUFFER_SIZE:
+        return
+    with RECEIVE_BUFFERS_LOCK:
+        if len(RECEIVE_BUFFERS) < MAX_POOLED_BUFFERS:
+            RECEIVE_BUFFERS.append(value)
+
+
+SOCKET_POOLS = dict()
+SOCKET_POOLS_LOCK = threading.Lock()
+
+
+def socket_pool(key, max_idle=SocketPool.MAX_IDLE):
+    """Return the agent-wide socket pool for the given target key, creating
+    it if it does not exist.
+
+    :param tuple key: The key identifying the target
+    :param int max_idle: The maximum number of idle sockets to keep
+    :rtype: SocketPool
+
+    """
+    with SOCKET_POOLS_LOCK:
+        if key not in SOCKET_POOLS:
+            SOCKET_POOLS[key] = SocketPool(max_idle)
+        return SOCKET_POOLS[key]
@@ -0,0 +1,137 @@
+"""
+A minimal FastCGI client, just enough to send a single request to a
+FastCGI application such as php-fpm and read the response back without a
+web server in between.
+
+"""
+import struct
+
+BEGIN_REQUEST = 1
+END_REQUEST = 3
+PARAMS = 4
+STDIN = 5
+STDOUT = 6
+STDERR = 7
+
+KEEP_CONN = 1
+MAX_CONTENT = 65535
+RESPONDER = 1
+VERSION = 1
+
+BEGIN_REQUEST_BODY = struct.Struct('!HB5x')
+END_REQUEST_BODY = struct.Struct('!IB3x')
+HEADER = struct.Struct('!BBHHBx')
+
+
+def encode_length(length):
+    """Return the encoded length of a name or value in a name-value pair,
+    one byte for lengths under 128 and four bytes otherwise.
+
+    :param int length: The length to encode
+    :rtype: str
+
+    """
+    if length < 128:
+        return chr(length)
+    return struct.pack('!I', length | 0x80000000)
+
+
+def encode_params(params):
+    """Return the name-value pairs of the request params encoded for the
+    content of PARAMS records.
+
+    :param dict params: The request params
+    :rtype: str
+
+    """
+    pairs = list()
+    for name, value in sorted(params.items()):
+        value = str(value)
+        pairs.append(encode_length(len(name)) + encode_length(len(value)) +
+                     name + value)
+    return ''.join(pairs)
+
+
+def record(record_type, content, request_id=1):
+    """Return a record of the given type wrapping the content.
+
+    :param int record_type: The record type
+    :param str content: The record content
+    :param int request_id: The request id
+    :rtype: str
+
+    """
+    return HEADER.pack(VERSION, record_type, request_id,
+                       len(content), 0) + content
+
+
+def request(params, keep_conn=False, request_id=1):
+    """Return the records for a responder request with the given params and
+    an empty request body. If keep_conn is set the application leaves the
+    connection open after the response, so it can be reused.
+
+    :param dict params: The request params
+    :param bool keep_conn: Keep the connection open after the response
+    :param int request_id: The request id
+    :rtype: str
+
+    """
+    flags = KEEP_CONN if keep_conn else 0
+    records = [record(BEGIN_REQUEST, BEGIN_REQUEST_BODY.pack(RESPONDER, flags),
+                      request_id)]
+    content = encode_params(params)
+    for offset in range(0, len(content), MAX_CONTENT):
+        records.append(record(PARAMS, content[offset:offset + MAX_CONTENT],
+                              request_id))
+    records.append(record(PARAMS, '', request_id))
+    records.append(record(STDIN, '', request_id))
+    return ''.join(records)
+
+
+def response(data):
+    """Return the output, error output and application status of the
+    complete response in data. The output streams are joined from all of
+    their records.
+
+    :param str|buffer data: The response
+    :rtype: tuple
+    :raises: ValueError
+
+    """
+    stdout, stderr = list(), list()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        version, record_type, _request_id, length, padding = \
+            HEADER.unpack_from(data, offset)
+        if version != VERSION:
+            raise ValueError('Unsupported FastCGI version %i' % version)
+        start = offset + HEADER.size
+        if record_type == STDOUT:
+            stdout.append(data[start:start + length])
+        elif record_type == STDERR:
+            stderr.append(data[start:start + length])
+        elif record_type == END_REQUEST:
+            status, _protocol_status = END_REQUEST_BODY.unpack_from(data,
+                                                                    start)
+            return ''.join(stdout), ''.join(stderr), status
+        offset = start + length + padding
+    raise ValueError('FastCGI response has no end of request')
+
+
+def response_end(data, length):
+    """Return the offset after the end of request record of the response in
+    the first length bytes of data, or -1 if the response is incomplete.
+
+    :param bytearray|buffer data: The data received so far
+    :param int length: The number of bytes received
+    :rtype: int
+
+    """
+    offset = 0
+    while offset + HEADER.size <= length:
+        _version, record_type, _request_id, content_length, padding = \
+            HEADER.unpack_from(data, offset)
+        offset += HEADER.size + content_length + padding
+        if record_type == END_REQUEST:
+            return offset if offset <= length else -1
+    return -1
@@ -3,31 +3,298 @@ Base Plugin Classes
 
 """
 import csv
+import errno
+import fcntl
+import glob
+import heapq
 import logging
+import os
 from os import path
+import re
 import requests
 import socket
-import tempfile
+import threading
 import time
 import urlparse
 
+from newrelic_plugin_agent import connections
+from newrelic_plugin_agent import statistics
+from newrelic_plugin_agent import streaming
+
 LOGGER = logging.getLogger(__name__)
 
 
+class MetricFilter(object):
+    """Decide if a metric should be collected using include and exclude glob
+    patterns that are each compiled into a single regular expression. The
+    decision for each metric name is cached, so the patterns are only
+    evaluated the first time a metric is seen.
+
+    """
+    MAX_CACHE_SIZE = 100000
+
+    def __init__(self, include=None, exclude=None):
+        self.decisions = dict()
+        self.exclude = self.compile(exclude)
+        self.include = self.compile(include)
+
+    def allowed(self, metric_name):
+        """Return True if the metric should be collected
+
+        :param str metric_name: The metric name, without prefix or units
+        :rtype: bool
+
+        """
+        try:
+            return self.decisions[metric_name]
+        except KeyError:
+            pass
+        decision = ((self.include is None or
+                     self.include.match(metric_name) is not None) and
+                    (self.exclude is None or
+                     self.exclude.match(metric_name) is None))
+        if len(self.decisions) >= self.MAX_CACHE_SIZE:
+            self.decisions = dict()
+        self.decisions[metric_name] = decision
+        return decision
+
+    @staticmethod
+    def compile(patterns):
+        """Compile a list of glob patterns, where * matches anything and ?
+        matches a single character, into one regular expression.
+
+        :param list patterns: The glob patterns
+        :rtype: re.RegexObject
+
+        """
+        if not patterns:
+            return None
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        expressions = list()
+        for pattern in patterns:
+            expression = re.escape(pattern)
+            expression = expression.replace(r'\*', '.*').replace(r'\?', '.')
+            expressions.append(expression)
+        return re.compile(r'^(?:%s)$' % '|'.join(expressions), re.DOTALL)
+
+
+METRIC_FILTERS = dict()
+
+
+def metric_filter(config):
+    """Return the shared MetricFilter for the include_metrics and
+    exclude_metrics settings in the plugin config, so the patterns are only
+    compiled once for the life of the agent.
+
+    :param dict config: The plugin configuration
+    :rtype: MetricFilter
+
+    """
+    include = config.get('include_metrics')
+    exclude = config.get('exclude_metrics')
+    if not include and not exclude:
+        return None
+    key = repr((include, exclude))
+    if key not in METRIC_FILTERS:
+        METRIC_FILTERS[key] = MetricFilter(include, exclude)
+    return METRIC_FILTERS[key]
+
+
+DISCOVERED = dict()
+DISCOVERED_LOCK = threading.Lock()
+
+
+def discovered(key, ttl, discover):
+    """Return the members discovered by calling discover, caching them for
+    ttl seconds under key. If discovery fails, the last known members are
+    returned until discovery succeeds again.
+
+    :param tuple key: The key identifying what is discovered
+    :param int ttl: How long to cache the members for in seconds
+    :param callable discover: Returns the members or None on failure
+    :rtype: list
+
+    """
+    with DISCOVERED_LOCK:
+        expires, members = DISCOVERED.get(key, (0, None))
+    if expires < time.time():
+        found = discover()
+        if found:
+            members = found
+            with DISCOVERED_LOCK:
+                DISCOVERED[key] = (time.time() + ttl, members)
+        elif members:
+            LOGGER.warning('Discovery failed for %r, using the last known '
+                           'members', key)
+    return members
+
+
+CLUSTER_LOCK = threading.Lock()
+CLUSTER_LOCKS = dict()
+CLUSTER_RESULTS = dict()
+
+
+def cluster_result(key, ttl, fetch):
+    """Return the result of calling fetch, caching it for ttl seconds under
+    key so the instances of a cluster polled by the agent only request
+    cluster wide data once between them. Instances asking for the same key
+    at the same time wait for the first one to fetch it.
+
+    :param tuple key: The key identifying the cluster and the data
+    :param int ttl: How long to cache the result for in seconds
+    :param callable fetch: Returns the result, or None on failure
+    :rtype: mixed
+
+    """
+    expire_cluster_results()
+    with CLUSTER_LOCK:
+        lock = CLUSTER_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        expires, result = CLUSTER_RESULTS.get(key, (0, None))
+        if expires < time.time():
+            result = fetch()
+            if result:
+                CLUSTER_RESULTS[key] = (time.time() + ttl, result)
+            else:
+                CLUSTER_RESULTS.pop(key, None)
+    return result
+
+
+def expire_cluster_results():
+    """Drop the cached cluster results whose ttl has passed, so large
+    responses, such as whole RabbitMQ queue lists, are not kept in memory
+    until the next time the same data is fetched.
+
+    """
+    now = time.time()
+    with CLUSTER_LOCK:
+        for key in [key for key, (expires, _result)
+                    in CLUSTER_RESULTS.items() if expires < now]:
+            CLUSTER_RESULTS.pop(key, None)
+
+
+LEADER_LOCK = threading.Lock()
+LEADER_LOCKS = dict()
+
+
+def cluster_leader(lock_path):
+    """Return True if this agent holds the exclusive lock on the file at
+    lock_path, taking it if no other agent does. With the file on storage
+    shared by the agents of a cluster, only the agent holding the lock
+    collects the cluster wide data. The lock is held until the agent exits,
+    after which the next agent to poll takes it over.
+
+    :param str lock_path: The path of the lock file
+    :rtype: bool
+
+    """
+    with LEADER_LOCK:
+        if lock_path in LEADER_LOCKS:
+            return True
+        try:
+            handle = open(lock_path, 'a+')
+        except IOError as error:
+            LOGGER.error('Could not open cluster lock %s, collecting the '
+                         'cluster data anyway: %s', lock_path, error)
+            return True
+        try:
+            fcntl.lockf(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            handle.close()
+            if error.errno not in (errno.EACCES, errno.EAGAIN):
+                LOGGER.error('Could not lock cluster lock %s: %s', lock_path,
+                             error)
+            return False
+        handle.truncate(0)
+        handle.write('%s %i\n' % (socket.gethostname(), os.getpid()))
+        handle.flush()
+        LOGGER.info('Took cluster lock %s, collecting the cluster data',
+                    lock_path)
+        LEADER_LOCKS[lock_path] = handle
+        return True
+
+
+MAX_RESPONSE_SIZE = 67108864
+
+
+def response_content(response, max_size=MAX_RESPONSE_SIZE, chunk_size=65536):
+    """Read the body of a streamed HTTP response, giving up as soon as it is
+    known to be larger than max_size bytes so a misbehaving endpoint can not
+    balloon the memory of the agent.
+
+    :param requests.models.Response response: The streamed response
+    :param int max_size: The maximum size of the body in bytes
+    :param int chunk_size: How many bytes to read at a time
+    :rtype: str
+    :raises: ValueError
+
+    """
+    length = response.headers.get('content-length')
+    if length and int(length) > max_size:
+        raise ValueError('Content-Length of %s bytes is over the %i byte '
+                         'limit' % (length, max_size))
+    chunks, size = list(), 0
+    for chunk in response.iter_content(chunk_size):
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError('Response is over the %i byte limit' % max_size)
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def concurrently(calls):
+    """Make each call in its own thread, returning the results by name once
+    all of them have returned. A call that raises an exception has no
+    result.
+
+    :param dict calls: The callables to call by name
+    :rtype: dict
+
+    """
+    results = dict()
+
+    def call(name, function):
+        try:
+            results[name] = function()
+        except Exception as error:
+            LOGGER.exception('Error calling %s: %s', name, error)
+
+    threads = [threading.Thread(target=call, args=item)
+               for item in calls.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 class Plugin(object):
 
     GUID = 'com.meetme.newrelic_plugin_agent'
+    MAX_METRICS = 10000
     MAX_VAL = 2147483647
+    MULTIPLEX = False
+    OTHER_ENTITY = '__other__'
+    PERCENTILES = [50, 90, 99]
+
+    # Per-entity metric groups that can be limited with the top_k setting,
+    # mapping the metric prefix with a * for each entity path segment to the
+    # metric used to rank the entities by activity.
+    ENTITIES = dict()
 
     def __init__(self, config, poll_interval, last_interval_values=None):
         self.config = config
         LOGGER.debug('%s config: %r', self.__class__.__name__, self.config)
         self.poll_interval = poll_interval
         self.poll_start_time = 0
+        self.sample_interval = config.get('sample_interval')
 
         self.derive_values = dict()
         self.derive_last_interval = last_interval_values or dict()
+        self.entities = dict()
         self.gauge_values = dict()
+        self.metric_filter = metric_filter(config)
 
     def add_datapoints(self, data):
         """Extend this method to process the data points retrieved during the
@@ -38,7 +305,8 @@ class Plugin(object):
         """
         raise NotImplementedError
 
-    def add_derive_value(self, metric_name, units, value, count=None):
+    def add_derive_value(self, metric_name, units, value, count=None,
+                         entity=None):
         """Add a value that will derive the current value from the difference
         between the last interval value and the current value.
 
@@ -50,12 +318,17 @@ class Plugin(object):
         :param str units: The unit type
         :param int value: The value to add
         :param int count: The number of items the timing is for
+        :param str entity: The metric name prefix of the entity the metric
+            belongs to, see add_entity
 
         """
+        if self.metric_filter and not self.metric_filter.allowed(metric_name):
+            return
         if value is None:
             value = 0
         metric = self.metric_name(metric_name, units)
-        if metric not in self.derive_last_interval.keys():
+        self.add_entity(metric, entity)
+        if metric not in self.derive_last_interval:
             LOGGER.debug('Bypassing initial %s value for first run', metric)
             self.derive_values[metric] = self.metric_payload(0, count=0)
         else:
@@ -86,9 +359,22 @@ class Plugin(object):
         self.add_derive_value('%s/Last' % metric_name,
                               units, last_value, count)
 
+    def add_entity(self, metric, entity):
+        """Record the entity a metric belongs to for top_k, given as the
+        metric name prefix of the entity, such as Queue/vhost/name. Entity
+        names may contain slashes, unlike those matched from the finished
+        metric names by entity_patterns.
+
+        :param str metric: The full metric name
+        :param str entity: The metric name prefix of the entity
+
+        """
+        if entity is not None:
+            self.entities[metric] = entity
+
     def add_gauge_value(self, metric_name, units, value,
                         min_val=None, max_val=None, count=None,
-                        sum_of_squares=None):
+                        sum_of_squares=None, entity=None):
         """Add a value that is not a rolling counter but rather an absolute
         gauge
 
@@ -96,9 +382,14 @@ class Plugin(object):
         :param str units: The unit type
         :param int value: The value to add
         :param float value: The sum of squares for the values
+        :param str entity: The metric name prefix of the entity the metric
+            belongs to, see add_entity
 
         """
+        if self.metric_filter and not self.metric_filter.allowed(metric_name):
+            return
         metric = self.metric_name(metric_name, units)
+        self.add_entity(metric, entity)
         self.gauge_values[metric] = self.metric_payload(value,
                                                         min_val,
                                                         max_val,
@@ -106,6 +397,68 @@ class Plugin(object):
                                                         sum_of_squares)
         LOGGER.debug('%s: %r', metric_name, self.gauge_values[metric])
 
+    def add_distribution_values(self, metric_name, units, values,
+                                percentiles=None):
+        """Add a summary of a distribution of values, such as per-worker
+        timings, as one gauge carrying the count, min, max and sum of squares
+        plus one gauge per percentile. The number of metrics stays the same
+        no matter how many values are in the distribution.
+
+        :param str metric_name: The name of the metric
+        :param str units: The unit type
+        :param list|statistics.QuantileSketch values: The values to summarize
+        :param list percentiles: Percentiles to report, defaults to PERCENTILES
+
+        """
+        sketch = values
+        if not isinstance(sketch, statistics.QuantileSketch):
+            sketch = statistics.QuantileSketch(values)
+        if not sketch.count:
+            return
+        self.add_gauge_value(metric_name, units, sketch.total,
+                             sketch.min, sketch.max, sketch.count,
+                             sketch.sum_of_squares)
+        for percentile in percentiles or self.PERCENTILES:
+            self.add_gauge_value('%s/%ith Percentile' % (metric_name,
+                                                         percentile),
+                                 units, sketch.quantile(percentile / 100.0))
+
+    def cluster_fetch(self, key, fetch):
+        """Return the result of calling fetch for cluster wide data,
+        sharing it between the instances with the same cluster setting for
+        cluster_ttl seconds, half of the poll interval by default.
+
+        :param tuple|str key: The key identifying the data in the cluster
+        :param callable fetch: Returns the data, or None on failure
+        :rtype: mixed
+
+        """
+        cluster = self.config.get('cluster')
+        if not cluster:
+            return fetch()
+        return cluster_result((self.__class__.__name__, cluster, key),
+                              self.config.get('cluster_ttl',
+                                              self.poll_interval / 2.0),
+                              fetch)
+
+    @property
+    def cluster_leader(self):
+        """Return False if cluster_lock is set and another agent holds it,
+        in which case that agent collects the cluster wide data. The last
+        values are forgotten while not the leader, so derive values start
+        afresh if this agent takes over.
+
+        :rtype: bool
+
+        """
+        lock_path = self.config.get('cluster_lock')
+        if not lock_path or cluster_leader(lock_path):
+            return True
+        LOGGER.debug('Another agent holds %s, skipping the cluster data for '
+                     '%s', lock_path, self.name)
+        self.derive_last_interval.clear()
+        return False
+
     def component_data(self):
         """Create the component section of the NewRelic Platform data payload
         message.
@@ -116,11 +469,38 @@ class Plugin(object):
         metrics = dict()
         metrics.update(self.derive_values.items())
         metrics.update(self.gauge_values.items())
+        metrics = self.limit_cardinality(metrics)
         return {'name': self.name,
                 'guid': self.GUID,
                 'duration': self.poll_interval,
                 'metrics': metrics}
 
+    @classmethod
+    def discover(cls, config):
+        """Extend this method to expand an instance configured with discover
+        set into the configs of the instances discovered from it, such as the
+        members of a cluster. Each config must have a unique name.
+
+        :param dict config: The configured instance
+        :rtype: list
+
+        """
+        return [config]
+
+    @classmethod
+    def summarize(cls, config, instances, poll_interval):
+        """Extend this method to return a plugin instance reporting metrics
+        that summarize the polled instances discovered from config, such as
+        fleet wide totals, or None if there is no summary.
+
+        :param dict config: The configured instance
+        :param list instances: The polled plugin instances
+        :param int poll_interval: How often the plugin is invoked
+        :rtype: Plugin
+
+        """
+        return None
+
     def error_message(self):
         """Output an error message when stats collection fails"""
         LOGGER.error('Error collecting stats data from %s. Please check '
@@ -135,6 +515,7 @@ class Plugin(object):
         if not self.derive_values and not self.gauge_values:
             self.error_message()
         else:
+            self.prune_last_values()
             LOGGER.info('%s poll successful, completed in %.2f seconds',
                         self.__class__.__name__,
                         time.time() - self.poll_start_time)
@@ -159,6 +540,119 @@ class Plugin(object):
              max_val[key], values[key]) = 0, 0, self.MAX_VAL, 0, list()
         return count, total, min_val, max_val, values
 
+    def limit_cardinality(self, metrics):
+        """Keep only the top_k most active entities in each per-entity metric
+        group, folding the rest into the OTHER_ENTITY entity, named so it can
+        not collide with a real entity, then enforce the max_metrics cap for
+        the component by folding the least active of the remaining entities.
+
+        :param dict metrics: The component metrics
+        :rtype: dict
+
+        """
+        top_k = self.config.get('top_k')
+        max_metrics = self.config.get('max_metrics', self.MAX_METRICS)
+        if not top_k and len(metrics) <= max_metrics:
+            return metrics
+
+        groups, patterns = dict(), self.entity_patterns
+        for metric in list(metrics.keys()):
+            match = self.entity_match(metric, patterns)
+            if match:
+                prefix, entity, name = match
+                groups.setdefault(prefix, dict()).setdefault(
+                    entity, dict())[name] = metrics.pop(metric)
+
+        keys = self.config.get('top_k_key')
+        kept, other = list(), list()
+        for prefix, entities in groups.items():
+            key = keys.get(prefix) if isinstance(keys, dict) else keys
+            key = key or self.ENTITIES[prefix]
+            activity = lambda entity: (entities[entity].get(key) or
+                                       {}).get('total', 0)
+            top = set(heapq.nlargest(top_k or len(entities), entities,
+                                     key=activity))
+            for entity in entities:
+                if entity in top:
+                    kept.append((activity(entity), prefix, entity))
+                else:
+                    other.append((prefix, entity))
+
+        other_names = set()
+        for prefix, entity in other:
+            for name in groups[prefix][entity]:
+                other_names.add((prefix, name))
+
+        count = len(metrics) + len(other_names)
+        for _activity, prefix, entity in kept:
+            count += len(groups[prefix][entity])
+        if count > max_metrics:
+            kept.sort(reverse=True)
+            while kept and count > max_metrics:
+                _activity, prefix, entity = kept.pop()
+                other.append((prefix, entity))
+                count -= len(groups[prefix][entity])
+                for name in groups[prefix][entity]:
+                    if (prefix, name) not in other_names:
+                        other_names.add((prefix, name))
+                        count += 1
+
+        for _activity, prefix, entity in kept:
+            for name, payload in groups[prefix][entity].items():
+                metrics['Component/%s/%s/%s' %
+                        (prefix.split('/*')[0], entity, name)] = payload
+
+        for prefix, entity in other:
+            for name, payload in groups[prefix][entity].items():
+                metric = 'Component/%s/%s/%s' % (prefix.split('/*')[0],
+                                                 self.OTHER_ENTITY, name)
+                metrics[metric] = self.merge_payloads(metrics.get(metric),
+                                                      payload)
+        if other:
+            LOGGER.debug('Folded %i entities into %s', len(other),
+                         self.OTHER_ENTITY)
+
+        if len(metrics) > max_metrics:
+            LOGGER.warning('%s has %i metrics, dropping %i over the '
+                           'max_metrics limit', self.__class__.__name__,
+                           len(metrics), len(metrics) - max_metrics)
+            for metric in sorted(metrics.keys())[max_metrics:]:
+                del metrics[metric]
+        return metrics
+
+    @property
+    def max_response_size(self):
+        """Return the maximum size of the stats response or reply in bytes
+
+        :rtype: int
+
+        """
+        return self.config.get('max_response_size', MAX_RESPONSE_SIZE)
+
+    def merge_payloads(self, payload, other):
+        """Combine two metric payloads into a single payload that covers the
+        values of both.
+
+        :param dict payload: The payload to merge into, may be None
+        :param dict other: The payload to merge
+        :rtype: dict
+
+        """
+        if payload is None:
+            return dict(other)
+        sum_of_squares = payload['sum_of_squares'] + other['sum_of_squares']
+        if sum_of_squares > self.MAX_VAL:
+            sum_of_squares = 0
+        min_values = [value for value in (payload['min'], other['min'])
+                      if value is not None]
+        max_values = [value for value in (payload['max'], other['max'])
+                      if value is not None]
+        return {'min': min(min_values) if min_values else None,
+                'max': max(max_values) if max_values else None,
+                'total': payload['total'] + other['total'],
+                'count': payload['count'] + other['count'],
+                'sum_of_squares': sum_of_squares}
+
     def metric_name(self, metric, units):
         """Return the metric name in the format for the NewRelic platform
 
@@ -191,6 +685,60 @@ class Plugin(object):
                 'count': count or 1,
                 'sum_of_squares': sum_of_squares}
 
+    @classmethod
+    def multiplexed(cls, config):
+        """Return True if the instance can be polled together with other
+        instances by the multiplexed socket poller.
+
+        :param dict config: The configured instance
+        :rtype: bool
+
+        """
+        return (cls.MULTIPLEX and config.get('multiplex', True) and
+                not config.get('sample_interval'))
+
+    def entity_match(self, metric, patterns):
+        """Return the per-entity metric group, entity and metric name within
+        the entity of a metric, or None if it does not belong to an entity.
+        Entities recorded when the metric was added are used as they are,
+        otherwise the entity is matched from the metric name.
+
+        :param str metric: The full metric name
+        :param list patterns: The compiled entity_patterns
+        :rtype: tuple
+
+        """
+        entity = self.entities.get(metric)
+        if entity is not None:
+            for prefix in self.ENTITIES:
+                base_name = prefix.split('/*')[0]
+                if (entity.startswith('%s/' % base_name) and
+                        metric.startswith('Component/%s/' % entity)):
+                    return (prefix, entity[len(base_name) + 1:],
+                            metric[len('Component/%s/' % entity):])
+        for prefix, pattern in patterns:
+            match = pattern.match(metric)
+            if match:
+                return (prefix,) + match.groups()
+        return None
+
+    @property
+    def entity_patterns(self):
+        """Return the compiled patterns for the per-entity metric groups,
+        matching the entity and the metric name within the entity.
+
+        :rtype: list
+
+        """
+        patterns = list()
+        for prefix in self.ENTITIES:
+            base_name, segments = prefix.split('/*')[0], prefix.count('*')
+            entity = '/'.join([r'[^/]+'] * segments)
+            patterns.append((prefix,
+                             re.compile(r'^Component/%s/(%s)/(.+)$' %
+                                        (re.escape(base_name), entity))))
+        return patterns
+
     @property
     def name(self):
         """Return the name of the component
@@ -207,6 +755,69 @@ class Plugin(object):
         """
         raise NotImplementedError
 
+    def prune_last_values(self):
+        """Forget the last values of per-entity metrics that were not
+        collected, such as those of deleted indices or queues, so the derive
+        state does not grow without bound. Only the groups in ENTITIES with
+        an entity collected in this poll are pruned, so a failed request does
+        not reset the derive values of everything it reports.
+
+        """
+        prefixes = ['Component/%s/' % prefix.split('/*')[0]
+                    for prefix in self.ENTITIES]
+        collected = tuple(prefix for prefix in prefixes
+                          if any(metric.startswith(prefix)
+                                 for metric in self.derive_values))
+        if not collected:
+            return
+        for metric in [metric for metric in self.derive_last_interval
+                       if metric not in self.derive_values and
+                       metric.startswith(collected)]:
+            del self.derive_last_interval[metric]
+
+    def sample(self):
+        """Poll the server every sample_interval seconds for the duration of
+        the poll interval, folding each sample into a streaming accumulator
+        so that a single metric per interval is published with meaningful
+        min, max, count and sum_of_squares values.
+
+        Gauges are rolled up across the samples, derive values are summed
+        so the total still reflects the change over the whole interval.
+
+        """
+        samples = max(1, int(self.poll_interval // self.sample_interval))
+        LOGGER.info('Sampling %s %i times every %s seconds',
+                    self.__class__.__name__, samples, self.sample_interval)
+        gauges, derives = dict(), dict()
+        start_time = time.time()
+        for offset in range(0, samples):
+            delay = start_time + (offset * self.sample_interval) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.poll()
+            for metric, payload in self.gauge_values.items():
+                if metric not in gauges:
+                    gauges[metric] = statistics.Accumulator()
+                gauges[metric].add(float(payload['total']) / payload['count'],
+                                   payload['min'], payload['max'])
+            for metric, payload in self.derive_values.items():
+                total, _count = derives.get(metric, (0, None))
+                derives[metric] = total + payload['total'], payload['count']
+
+        self.poll_start_time = start_time
+        self.gauge_values = dict()
+        for metric, accumulator in gauges.items():
+            self.gauge_values[metric] = \
+                self.metric_payload(accumulator.total,
+                                    accumulator.min,
+                                    accumulator.max,
+                                    accumulator.count,
+                                    accumulator.sum_of_squares)
+        self.derive_values = dict()
+        for metric, (total, count) in derives.items():
+            self.derive_values[metric] = self.metric_payload(total,
+                                                             count=count)
+
     def sum_of_squares(self, values):
         """Return the sum_of_squares for the given values
 
@@ -232,10 +843,31 @@ class Plugin(object):
 
 
 class SocketStatsPlugin(Plugin):
-    """Connect to a socket and collect stats data"""
+    """Connect to a socket and collect stats data. Unless the protocol closes
+    the connection after each reply, connections are kept open in an
+    agent-wide pool and reused across poll intervals.
+
+    """
+    COMMAND = None
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 0
+    MULTIPLEX = True
+    PERSISTENT = True
     SOCKET_RECV_MAX = 10485760
+    SOCKET_TIMEOUT = 10
+
+    def acquire(self):
+        """Return a pooled connection if one is available, otherwise a new
+        connection, along with a flag indicating if it was reused.
+
+        :rtype: tuple
+
+        """
+        if self.persistent:
+            connection = self.pool.get()
+            if connection:
+                return connection, True
+        return self.connect(), False
 
     def connect(self):
         """Top level interface to create a socket and connect it to the
@@ -252,21 +884,107 @@ class SocketStatsPlugin(Plugin):
         else:
             return connection
 
-    def fetch_data(self, connection, read_till_empty=False):
-        """Read the data from the socket
+    def fetch(self):
+        """Fetch the data from the remote socket. If a pooled connection
+        turns out to be stale, it is discarded and the fetch is retried on a
+        new connection.
 
-        :param  socket connection: The connection
+        :rtype: mixed
+
+        """
+        while True:
+            connection, reused = self.acquire()
+            if not connection:
+                LOGGER.error('%s could not connect, skipping poll interval',
+                             self.__class__.__name__)
+                return None
+            try:
+                data = self.fetch_data(connection, reused)
+            except ValueError as error:
+                connection.close()
+                LOGGER.error('Error fetching data from %s: %s',
+                             self.__class__.__name__, error)
+                return None
+            except socket.error as error:
+                connection.close()
+                if reused:
+                    LOGGER.debug('Pooled connection failed, reconnecting: %s',
+                                 error)
+                    continue
+                LOGGER.error('Error fetching data from %s: %s',
+                             self.__class__.__name__, error)
+                return None
+            if not data:
+                connection.close()
+                if reused:
+                    LOGGER.debug('No data on pooled connection, reconnecting')
+                    continue
+                return None
+            self.release(connection)
+            return data
+
+    def fetch_data(self, connection, reused=False):
+        """Send the request for stats and read the reply from the socket
+        until it is complete, returning the parsed reply. Reading stops as
+        soon as the reply is larger than max_response_size bytes.
+
+        :param socket connection: The connection
+        :param bool reused: If the connection was reused from the pool
+        :rtype: mixed
+        :raises: ValueError
 
         """
         LOGGER.debug('Fetching data')
-        received = connection.recv(self.SOCKET_RECV_MAX)
-        while read_till_empty:
-            chunk = connection.recv(self.SOCKET_RECV_MAX)
-            if chunk:
-                received += chunk
-            else:
-                break
-        return received
+        request = self.request(reused)
+        if request:
+            connection.sendall(request)
+        received = connections.receive_buffer()
+        try:
+            while True:
+                count = received.recv(connection, self.recv_size(received))
+                if len(received) > self.max_response_size:
+                    raise ValueError('Reply is over the %i byte limit' %
+                                     self.max_response_size)
+                if self.reply_complete(received, not count):
+                    return self.parse_reply(received.view())
+                if not count:
+                    return None
+        finally:
+            connections.release_buffer(received)
+
+    @staticmethod
+    def glob_sockets(pattern):
+        """Return the name and address of each UNIX domain socket matching
+        the glob, naming them by the part of the path the glob matched.
+
+        :param str pattern: The glob of socket paths
+        :rtype: list
+
+        """
+        prefix = path.dirname(re.split(r'[*?[]', pattern, 1)[0])
+        return [(path.relpath(socket_path, prefix), {'path': socket_path})
+                for socket_path in sorted(glob.glob(pattern))]
+
+    def parse_reply(self, data):
+        """Extend this method to parse the complete reply read from the
+        socket into the value passed to add_datapoints. The reply is a view
+        of the receive buffer that is only valid until this method returns,
+        so the default implementation returns a copy of it.
+
+        :param buffer data: The reply
+        :rtype: mixed
+
+        """
+        return str(data)
+
+    @property
+    def persistent(self):
+        """Return True if connections should be pooled and reused
+
+        :rtype: bool
+
+        """
+        return self.config.get('persistent', self.PERSISTENT)
 
     def poll(self):
         """This method is called after every sleep interval. If the intention
@@ -278,24 +996,90 @@ class SocketStatsPlugin(Plugin):
         self.initialize()
 
         # Fetch the data from the remote socket
-        connection = self.connect()
-        if not connection:
-            LOGGER.error('%s could not connect, skipping poll interval',
-                         self.__class__.__name__)
-            return
-
-        data = self.fetch_data(connection)
-        connection.close()
-
+        data = self.fetch()
         if data:
             self.add_datapoints(data)
             self.finish()
         else:
             self.error_message()
 
-    def socket_connect(self):
-        """Low level interface to create a socket and connect to it.
+    @property
+    def pool(self):
+        """Return the agent-wide connection pool for this target
+
+        :rtype: newrelic_plugin_agent.connections.SocketPool
 
+        """
+        return connections.socket_pool(
+            (self.__class__.__name__, self.config.get('path')) +
+            self.remote_address,
+            self.config.get('pool_size', connections.SocketPool.MAX_IDLE))
+
+    @property
+    def remote_address(self):
+        """Return the host and port of the TCP socket to connect to
+
+        :rtype: tuple
+
+        """
+        return (self.config.get('host', self.DEFAULT_HOST),
+                self.config.get('port', self.DEFAULT_PORT))
+
+    def reply_complete(self, data, closed):
+        """Extend this method to implement the framing of the protocol,
+        returning True once the full reply has been received. By default the
+        reply is complete when the remote end closes the connection.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer data: The
+            data received so far
+        :param bool closed: If the remote end closed the connection
+        :rtype: bool
+
+        """
+        return closed
+
+    def recv_size(self, received):
+        """Return how many bytes to read from the socket next, reading at
+        most one byte past max_response_size so an oversized reply is
+        detected without buffering more of it.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer received: The
+            data received so far
+        :rtype: int
+
+        """
+        return max(1, min(self.SOCKET_RECV_MAX,
+                          self.max_response_size - len(received) + 1))
+
+    def release(self, connection):
+        """Return the connection to the pool, or close it if connections are
+        not persistent.
+
+        :param socket connection: The connection
+
+        """
+        if self.persistent:
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+    def request(self, reused):
+        """Return the request to send to ask for stats, or None if the remote
+        end sends them as soon as a connection is made. If the connection is
+        new, any handshake such as authentication should be included.
+
+        :param bool reused: If the connection was reused from the pool
+        :rtype: str
+
+        """
+        return self.COMMAND
+
+    def socket_connect(self, blocking=True):
+        """Low level interface to create a socket and connect to it. When not
+        blocking, a TCP/IP connection may still be in progress when the
+        socket is returned.
+
+        :param bool blocking: Connect in blocking mode
         :rtype: socket
 
         """
@@ -304,17 +1088,29 @@ class SocketStatsPlugin(Plugin):
                 LOGGER.debug('Connecting to UNIX domain socket: %s',
                              self.config['path'])
                 connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.settimeout(self.config.get('timeout',
+                                                      self.SOCKET_TIMEOUT))
                 connection.connect(self.config['path'])
             else:
                 LOGGER.error('UNIX domain socket path does not exist: %s',
                              self.config['path'])
                 return None
         else:
-            remote_host = (self.config.get('host', self.DEFAULT_HOST),
-                           self.config.get('port', self.DEFAULT_PORT))
+            remote_host = self.remote_address
             LOGGER.debug('Connecting to %r', remote_host)
             connection = socket.socket()
-            connection.connect(remote_host)
+            if blocking:
+                connection.settimeout(self.config.get('timeout',
+                                                      self.SOCKET_TIMEOUT))
+                connection.connect(remote_host)
+            else:
+                connection.setblocking(0)
+                result = connection.connect_ex(remote_host)
+                if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    connection.close()
+                    raise socket.error(result, os.strerror(result))
+        if not blocking:
+            connection.setblocking(0)
         return connection
 
 
@@ -323,34 +1119,54 @@ class HTTPStatsPlugin(Plugin):
     via HTTP protocol.
 
     """
+    DEFAULT_HOST = 'localhost'
     DEFAULT_PATH = '/'
+    DEFAULT_PORT = None
     DEFAULT_QUERY = None
+    TIMEOUT = 30
 
     def fetch_data(self):
-        """Fetch the data from the stats URL
+        """Fetch the data from the stats URL, reading at most
+        max_response_size bytes.
 
         :rtype: str
 
         """
-        data = self.http_get()
-        return data.content if data else ''
+        response = self.http_get(stream=True)
+        if not response:
+            return ''
+        try:
+            return response_content(response, self.max_response_size)
+        except ValueError as error:
+            LOGGER.error('Error reading stats from %s: %s', self.stats_url,
+                         error)
+            return ''
+        finally:
+            response.close()
 
-    def http_get(self):
-        """Fetch the data from the stats URL
+    def http_get(self, stream=False, url=None):
+        """Fetch the data from the stats URL, or another URL on the same
+        server. If stream is set, the body is not read until the response
+        content is iterated over.
 
+        :param bool stream: Stream the response body
+        :param str url: The URL to fetch instead of the stats URL
         :rtype: requests.models.Response
 
         """
+        kwargs = self.request_kwargs
+        if url:
+            kwargs['url'] = url
         LOGGER.debug('Polling %s Stats at %s',
-                     self.__class__.__name__, self.stats_url)
+                     self.__class__.__name__, kwargs['url'])
         try:
-            response = requests.get(**self.request_kwargs)
-        except requests.ConnectionError as error:
+            response = self.session.get(stream=stream, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
             LOGGER.error('Error polling stats: %s', error)
             return ''
 
         if response.status_code >= 300:
-            LOGGER.error('Error response from %s (%s): %s', self.stats_url,
+            LOGGER.error('Error response from %s (%s): %s', kwargs['url'],
                          response.status_code, response.content)
             return None
         return response
@@ -363,6 +1179,19 @@ class HTTPStatsPlugin(Plugin):
             self.add_datapoints(data)
         self.finish()
 
+    @property
+    def session(self):
+        """Return the agent-wide HTTP session for the stats host and user,
+        so connections are kept alive and reused across poll intervals.
+
+        :rtype: requests.Session
+
+        """
+        parsed = urlparse.urlparse(self.stats_url)
+        return connections.http_session(
+            (parsed.scheme, parsed.netloc, self.config.get('username')),
+            self.config.get('pool_size', connections.HTTP_POOL_SIZE))
+
     @property
     def stats_url(self):
         """Return the configured URL in a uniform way for all HTTP based data
@@ -371,17 +1200,23 @@ class HTTPStatsPlugin(Plugin):
         :rtype: str
 
         """
-        netloc = self.config.get('host', 'localhost')
-        if self.config.get('port'):
-            netloc += ':%s' % self.config['port']
+        return self.url(self.config.get('path', self.DEFAULT_PATH),
+                        self.config.get('query', self.DEFAULT_QUERY))
+
+    def url(self, url_path, query=None):
+        """Return the URL of a path on the configured HTTP server
+
+        :param str url_path: The path of the URL
+        :param str query: The query string of the URL
+        :rtype: str
+
+        """
+        netloc = self.config.get('host', self.DEFAULT_HOST)
+        if self.config.get('port', self.DEFAULT_PORT):
+            netloc += ':%s' % self.config.get('port', self.DEFAULT_PORT)
 
         return urlparse.urlunparse((self.config.get('scheme', 'http'),
-                                    netloc,
-                                    self.config.get('path', self.DEFAULT_PATH),
-                                    None,
-                                    self.config.get('query',
-                                                    self.DEFAULT_QUERY),
-                                    None))
+                                    netloc, url_path, None, query, None))
 
     @property
     def request_kwargs(self):
@@ -390,7 +1225,8 @@ class HTTPStatsPlugin(Plugin):
         :rtype: dict
 
         """
-        kwargs = {'url': self.stats_url}
+        kwargs = {'timeout': self.config.get('timeout', self.TIMEOUT),
+                  'url': self.stats_url}
         if self.config.get('scheme') == 'https':
             kwargs['verify'] = self.config.get('verify_ssl_cert', False)
 
@@ -406,24 +1242,65 @@ class CSVStatsPlugin(HTTPStatsPlugin):
     for stats collection
 
     """
+    CHUNK_SIZE = 65536
+    COLUMNS = None
+    LABELS = None
+
     def fetch_data(self):
-        """Fetch the data from the stats URL
+        """Fetch the data from the stats URL, parsing the rows as the
+        response is streamed in.
 
-        :rtype: dict
+        :rtype: list
 
         """
-        data = super(CSVStatsPlugin, self).fetch_data()
-        if not data:
-            return dict()
-        temp = tempfile.TemporaryFile()
-        temp.write(data)
-        temp.seek(0)
-        reader = csv.DictReader(temp)
-        data = list()
+        response = self.http_get(stream=True)
+        if not response:
+            return list()
+        try:
+            return self.parse_rows(response.iter_lines(self.CHUNK_SIZE))
+        finally:
+            response.close()
+
+    def parse_rows(self, lines):
+        """Parse the CSV rows from an iterable of lines. If COLUMNS is set,
+        only those columns are picked from each row by their position in the
+        header and converted to integers, returning a tuple per row with the
+        string values of the LABELS columns followed by the values of the
+        COLUMNS, missing or empty values being 0. Otherwise a dict of the
+        string values is returned for each row.
+
+        :param iterable lines: The lines of the CSV document
+        :rtype: list
+
+        """
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if not header:
+            return list()
+        header = [column.lstrip('# ') for column in header]
+        if not self.COLUMNS:
+            return [dict(zip(header, row)) for row in reader if row]
+        positions = dict((column, index)
+                         for index, column in enumerate(header))
+        missing = [column for column in (self.LABELS or []) + self.COLUMNS
+                   if column not in positions]
+        if missing:
+            LOGGER.debug('CSV columns missing from %s: %s',
+                         self.__class__.__name__, ', '.join(missing))
+        labels = [positions.get(column) for column in self.LABELS or []]
+        indexes = [positions.get(column) for column in self.COLUMNS]
+        present = [index for index in labels + indexes if index is not None]
+        width = max(present) + 1 if present else 0
+        rows = list()
         for row in reader:
-            data.append(row)
-        temp.close()
-        return data
+            if len(row) < width:
+                continue
+            rows.append(tuple([row[index] if index is not None else ''
+                               for index in labels] +
+                              [int(row[index] or 0)
+                               if index is not None else 0
+                               for index in indexes]))
+        return rows
 
     def poll(self):
         """Poll HTTP JSON endpoint for stats data"""
@@ -439,15 +1316,24 @@ class JSONStatsPlugin(HTTPStatsPlugin):
     for stats collection
 
     """
+    FIELDS = None
+
     def fetch_data(self):
-        """Fetch the data from the stats URL
+        """Fetch the data from the stats URL and decode it with the fastest
+        JSON decoder available. If FIELDS is set, only the selected fields
+        are decoded in a single streaming pass over the document, which
+        keeps very large documents cheap to process.
 
         :rtype: dict
 
         """
-        data = self.http_get()
+        data = super(JSONStatsPlugin, self).fetch_data()
+        if not data:
+            return {}
         try:
-            return data.json() if data else {}
+            if self.FIELDS:
+                return streaming.select(data, self.FIELDS)
+            return streaming.loads(data)
         except Exception as error:
             LOGGER.error('JSON decoding error: %r', error)
         return {}
@@ -2,9 +2,11 @@
 Elastic Search
 
 """
+import functools
 import logging
-import requests
+import urlparse
 
+from newrelic_plugin_agent import streaming
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -17,53 +19,137 @@ class ElasticSearch(base.JSONStatsPlugin):
                     'total_opened', 'collection_count']
     GAUGE_MATCH = ['Current']
 
+    CLUSTER_STATS = ('indices.count,indices.docs.count,'
+                     'indices.fielddata.memory_size_in_bytes,'
+                     'indices.store.size_in_bytes,nodes.jvm.mem')
     DEFAULT_HOST = 'localhost'
-    DEFAULT_PATH = '/_nodes/stats?all'
+    DEFAULT_NODE_METRICS = ['http', 'indices', 'transport']
+    DEFAULT_PATH = '/_nodes/stats'
     DEFAULT_PORT = 9200
+    DEFAULT_THREAD_POOLS = ['bulk', 'get', 'index', 'search', 'write']
+    ENTITIES = {'Index/*': 'Operations[ops]', 'Node/*': 'Operations[ops]'}
     GUID = 'com.meetme.newrelic_elasticsearch_node_agent'
 
+    # The stats of each index reported when indices is set
+    INDEX_STATS = ['docs.count',
+                   'get.time_in_millis',
+                   'get.total',
+                   'indexing.index_time_in_millis',
+                   'indexing.index_total',
+                   'search.query_time_in_millis',
+                   'search.query_total',
+                   'store.size_in_bytes']
+    INDEX_FIELDS = streaming.fields_for('indices.*.total.%s' % stat
+                                        for stat in INDEX_STATS)
+
+    # The stats of each node reported when nodes is set by metric group, in
+    # addition to the indices stats in NODE_STATS
+    NODE_DETAILS = {'jvm': ['gc.collectors.*.collection_count',
+                            'gc.collectors.*.collection_time_in_millis',
+                            'mem.heap_max_in_bytes',
+                            'mem.heap_used_in_bytes'],
+                    'thread_pool': ['*.queue', '*.rejected']}
+
+    # The node stats used by add_datapoints by metric group, only these are
+    # requested, decoded and added up across the nodes. The network group
+    # only exists before Elasticsearch 2.0.
+    NODE_STATS = {'http': ['total_opened'],
+                  'indices': ['docs.count',
+                              'docs.deleted',
+                              'flush.total',
+                              'flush.total_time_in_millis',
+                              'get.exists_time_in_millis',
+                              'get.exists_total',
+                              'get.missing_time_in_millis',
+                              'get.missing_total',
+                              'get.time_in_millis',
+                              'get.total',
+                              'indexing.delete_time_in_millis',
+                              'indexing.delete_total',
+                              'indexing.index_time_in_millis',
+                              'indexing.index_total',
+                              'merges.total',
+                              'merges.total_time_in_millis',
+                              'search.fetch_time_in_millis',
+                              'search.fetch_total',
+                              'search.open_contexts',
+                              'search.query_time_in_millis',
+                              'search.query_total',
+                              'store.size_in_bytes',
+                              'store.throttle_time_in_millis'],
+                  'network': ['tcp.active_opens',
+                              'tcp.attempt_fails',
+                              'tcp.estab_resets',
+                              'tcp.in_errs',
+                              'tcp.in_segs',
+                              'tcp.out_segs',
+                              'tcp.passive_opens',
+                              'tcp.retrans_segs'],
+                  'transport': ['rx_size_in_bytes', 'tx_size_in_bytes']}
+    FIELDS = streaming.fields_for(['nodes.*.name'] +
+                                  ['nodes.*.%s.%s' % (group, stat)
+                                   for group, stats in (NODE_STATS.items() +
+                                                        NODE_DETAILS.items())
+                                   for stat in stats])
+
     def add_datapoints(self, stats):
         """Add all of the datapoints for the Elasticsearch poll
 
         :param dict stats: The stats to process for the values
 
         """
-        totals = dict()
-        for node in stats.get('nodes'):
-            for key in stats['nodes'][node].keys():
-                if isinstance(stats['nodes'][node][key], dict):
-                    if key not in totals:
-                        totals[key] = dict()
-                    self.process_tree(totals[key],
-                                      stats['nodes'][node][key])
-
-        self.add_index_datapoints(totals)
+        totals = self.sum_nodes(stats.get('nodes') or dict())
+
+        if 'indices' in self.node_metrics:
+            self.add_index_datapoints(totals)
         self.add_network_datapoints(totals)
-        self.add_cluster_stats()
-
-    def add_cluster_stats(self):
-        """Add stats that go under Component/Cluster"""
-        url = self.stats_url.replace(self.DEFAULT_PATH, '/_cluster/health')
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            self.add_gauge_value('Cluster/Nodes', 'nodes',
-                                 data.get('number_of_nodes', 0))
-            self.add_gauge_value('Cluster/Data Nodes', 'nodes',
-                                 data.get('number_of_data_nodes', 0))
-            self.add_gauge_value('Cluster/Shards/Active', 'shards',
-                                 data.get('active_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Initializing', 'shards',
-                                 data.get('initializing_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Primary', 'shards',
-                                 data.get('active_primary_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Relocating', 'shards',
-                                 data.get('relocating_shards', 0))
-            self.add_gauge_value('Cluster/Shards/Unassigned', 'shards',
-                                 data.get('unassigned_shards', 0))
-        else:
-            LOGGER.error('Error collecting cluster stats (%s): %s',
-                         response.status_code, response.content)
+        if self.config.get('nodes'):
+            self.add_node_datapoints(stats.get('nodes') or dict())
+
+    def add_cluster_health_datapoints(self, health):
+        """Add the data points for Component/Cluster from the cluster health
+
+        :param dict health: The cluster health
+
+        """
+        self.add_gauge_value('Cluster/Nodes', 'nodes',
+                             health.get('number_of_nodes', 0))
+        self.add_gauge_value('Cluster/Data Nodes', 'nodes',
+                             health.get('number_of_data_nodes', 0))
+        self.add_gauge_value('Cluster/Shards/Active', 'shards',
+                             health.get('active_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Initializing', 'shards',
+                             health.get('initializing_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Primary', 'shards',
+                             health.get('active_primary_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Relocating', 'shards',
+                             health.get('relocating_shards', 0))
+        self.add_gauge_value('Cluster/Shards/Unassigned', 'shards',
+                             health.get('unassigned_shards', 0))
+
+    def add_cluster_stats_datapoints(self, stats):
+        """Add the cluster wide index and JVM data points from the cluster
+        stats
+
+        :param dict stats: The cluster stats
+
+        """
+        indices = stats.get('indices', dict())
+        self.add_gauge_value('Cluster/Indices', 'indices',
+                             indices.get('count', 0))
+        self.add_gauge_value('Cluster/Documents', 'docs',
+                             indices.get('docs', dict()).get('count', 0))
+        self.add_gauge_value('Cluster/Storage', 'bytes',
+                             indices.get('store', dict()).get(
+                                 'size_in_bytes', 0))
+        self.add_gauge_value('Cluster/Fielddata', 'bytes',
+                             indices.get('fielddata', dict()).get(
+                                 'memory_size_in_bytes', 0))
+        heap = stats.get('nodes', dict()).get('jvm', dict()).get('mem',
+                                                                 dict())
+        self.add_gauge_value('Cluster/JVM/Heap Used', 'bytes',
+                             heap.get('heap_used_in_bytes', 0),
+                             max_val=heap.get('heap_max_in_bytes'))
 
     def add_index_datapoints(self, stats):
         """Add the data points for Component/Indices
@@ -124,7 +210,7 @@ class ElasticSearch(base.JSONStatsPlugin):
         self.add_derive_value('Indices/Search Fetch', 'ms',
                               search.get('fetch_time_in_millis', 0))
 
-        merge_stats = indices.get('merge', dict())
+        merge_stats = indices.get('merges', dict())
         self.add_derive_value('Indices/Merge', 'count',
                               merge_stats.get('total', 0))
         self.add_derive_value('Indices/Merge', 'ms',
@@ -136,19 +222,52 @@ class ElasticSearch(base.JSONStatsPlugin):
         self.add_derive_value('Indices/Flush', 'ms',
                               flush_stats.get('total_time_in_millis', 0))
 
+    def add_latency_datapoints(self, metric, count, millis):
+        """Add the rate and time spent on an operation, and the average
+        latency of the operations since the last poll.
+
+        :param str metric: The metric name of the operation
+        :param int count: The number of operations
+        :param int millis: The time spent on the operations
+
+        """
+        # Must happen before the derive values are saved
+        last_count = self.derive_last_interval.get(
+            self.metric_name(metric, 'count'))
+        last_millis = self.derive_last_interval.get(
+            self.metric_name(metric, 'ms'))
+        if last_count is not None and last_millis is not None:
+            if count > last_count:
+                self.add_gauge_value('%s/Latency' % metric, 'ms',
+                                     float(millis - last_millis) /
+                                     (count - last_count))
+
+        self.add_derive_value(metric, 'count', count)
+        self.add_derive_value(metric, 'ms', millis)
+
     def add_network_datapoints(self, stats):
-        """Add the data points for Component/Network
+        """Add the data points for Component/Network, for the node stats
+        metric groups that were requested
 
         :param dict stats: The stats to process for the values
 
         """
-        transport = stats.get('transport', dict())
-        self.add_derive_value('Network/Traffic/Received', 'bytes',
-                              transport.get('rx_size_in_bytes', 0))
-        self.add_derive_value('Network/Traffic/Sent', 'bytes',
-                              transport.get('tx_size_in_bytes', 0))
-
-        network = stats.get('network', dict())
+        groups = self.node_metrics
+        if 'transport' in groups:
+            transport = stats.get('transport', dict())
+            self.add_derive_value('Network/Traffic/Received', 'bytes',
+                                  transport.get('rx_size_in_bytes', 0))
+            self.add_derive_value('Network/Traffic/Sent', 'bytes',
+                                  transport.get('tx_size_in_bytes', 0))
+
+        if 'http' in groups:
+            self.add_derive_value('Network/HTTP Connections', 'conn',
+                                  stats.get('http',
+                                            dict()).get('total_opened', 0))
+
+        if 'network' not in groups:
+            return
+        network = stats.get('network', dict()).get('tcp', dict())
         self.add_derive_value('Network/Connections/Active', 'conn',
                               network.get('active_opens', 0))
         self.add_derive_value('Network/Connections/Passive', 'conn',
@@ -158,33 +277,232 @@ class ElasticSearch(base.JSONStatsPlugin):
         self.add_derive_value('Network/Connections/Failures', 'conn',
                               network.get('attempt_fails', 0))
 
-        self.add_derive_value('Network/HTTP Connections', 'conn',
-                              stats.get('http', dict()).get('total_opened', 0))
-
         self.add_derive_value('Network/Segments/In', 'seg',
-                              network.get('in_seg', 0))
-        self.add_derive_value('Network/Segments/In', 'errors',
+                              network.get('in_segs', 0))
+        self.add_derive_value('Network/Segments/In Errors', 'seg',
                               network.get('in_errs', 0))
         self.add_derive_value('Network/Segments/Out', 'seg',
-                              network.get('out_seg', 0))
+                              network.get('out_segs', 0))
         self.add_derive_value('Network/Segments/Retransmitted', 'seg',
                               network.get('retrans_segs', 0))
 
-    def process_tree(self, tree, values):
-        """Recursively combine all node stats into a single top-level value
+    def add_node_datapoints(self, nodes):
+        """Add the heap, garbage collection, thread pool and operation data
+        points of each node under Component/Node.
+
+        :param dict nodes: The stats of each node
+
+        """
+        pools = self.config.get('thread_pools', self.DEFAULT_THREAD_POOLS)
+        for node_id, node in nodes.items():
+            prefix = 'Node/%s' % node.get('name', node_id)
+            jvm = node.get('jvm', dict())
+            heap = jvm.get('mem', dict())
+            self.add_gauge_value('%s/JVM/Heap Used' % prefix, 'bytes',
+                                 heap.get('heap_used_in_bytes', 0),
+                                 max_val=heap.get('heap_max_in_bytes'))
+            collectors = jvm.get('gc', dict()).get('collectors', dict())
+            for name, collector in collectors.items():
+                metric = '%s/JVM/GC/%s' % (prefix, name)
+                self.add_derive_value(metric, 'count',
+                                      collector.get('collection_count', 0))
+                self.add_derive_value(metric, 'ms',
+                                      collector.get(
+                                          'collection_time_in_millis', 0))
+            for name, pool in node.get('thread_pool', dict()).items():
+                if name not in pools:
+                    continue
+                metric = '%s/Thread Pool/%s' % (prefix, name)
+                self.add_gauge_value('%s/Queue' % metric, 'tasks',
+                                     pool.get('queue', 0))
+                self.add_derive_value('%s/Rejected' % metric, 'tasks',
+                                      pool.get('rejected', 0))
+            self.add_operation_datapoints(prefix, node.get('indices', dict()))
+
+    def add_operation_datapoints(self, prefix, stats):
+        """Add the indexing, search and get data points of a node or index,
+        along with the total of the operations it is ranked by for top_k.
+
+        :param str prefix: The metric name prefix of the node or index
+        :param dict stats: The indices stats of the node or index
+
+        """
+        operations = 0
+        for section, metric, count, millis in (
+                ('get', 'Get', 'total', 'time_in_millis'),
+                ('indexing', 'Indexing', 'index_total',
+                 'index_time_in_millis'),
+                ('search', 'Search Query', 'query_total',
+                 'query_time_in_millis')):
+            values = stats.get(section, dict())
+            self.add_latency_datapoints('%s/%s' % (prefix, metric),
+                                        values.get(count, 0),
+                                        values.get(millis, 0))
+            operations += values.get(count, 0)
+        self.add_derive_value('%s/Operations' % prefix, 'ops', operations)
+
+    def add_pending_tasks_datapoints(self, pending):
+        """Add the data points for the cluster state update tasks waiting to
+        be executed by the master node
+
+        :param dict pending: The pending cluster tasks
+
+        """
+        tasks = pending.get('tasks', list())
+        self.add_gauge_value('Cluster/Pending Tasks', 'tasks', len(tasks))
+        self.add_gauge_value('Cluster/Pending Tasks/Max Wait', 'ms',
+                             max([task.get('time_in_queue_millis', 0)
+                                  for task in tasks] or [0]))
+
+    def add_per_index_datapoints(self, stats):
+        """Add the document count, storage and operation data points of each
+        index under Component/Index.
+
+        :param dict stats: The index stats
+
+        """
+        for name, index in stats.get('indices', dict()).items():
+            prefix = 'Index/%s' % name
+            total = index.get('total', dict())
+            self.add_gauge_value('%s/Documents' % prefix, 'docs',
+                                 total.get('docs', dict()).get('count', 0))
+            self.add_gauge_value('%s/Storage' % prefix, 'bytes',
+                                 total.get('store', dict()).get(
+                                     'size_in_bytes', 0))
+            self.add_operation_datapoints(prefix, total)
+
+    def fetch_json(self, url_path, query=None, fields=None):
+        """Fetch and decode a JSON document from a path on the cluster,
+        returning None if it could not be fetched. If fields is set only the
+        selected fields are decoded. At most max_response_size bytes are
+        read.
+
+        :param str url_path: The path of the document
+        :param str query: The query string
+        :param dict fields: The fields to select
+        :rtype: dict
 
-        :param dict tree: The output values
-        :param dict values: The input values
+        """
+        url = self.url(url_path, query)
+        response = self.http_get(stream=True, url=url)
+        if not response:
+            return None
+        try:
+            content = base.response_content(response, self.max_response_size)
+        except ValueError as error:
+            LOGGER.error('Error reading %s: %s', url, error)
+            return None
+        finally:
+            response.close()
+        try:
+            if fields:
+                return streaming.select(content, fields)
+            return streaming.loads(content)
+        except Exception as error:
+            LOGGER.error('JSON decoding error: %r', error)
+            return None
+
+    @property
+    def node_metrics(self):
+        """Return the node stats metric groups to request
+
+        :rtype: list
 
         """
-        for key in values:
-            if key == 'timestamp':
-                continue
-            if isinstance(values[key], dict):
-                if key not in tree:
-                    tree[key] = dict()
-                    self.process_tree(tree[key], values[key])
-            elif isinstance(values[key], int):
-                if key not in tree:
-                    tree[key] = 0
-                tree[key] += values[key]
+        return sorted(group for group in self.config.get(
+            'node_metrics', self.DEFAULT_NODE_METRICS)
+            if group in self.NODE_STATS)
+
+    def poll(self):
+        """Fetch the node stats, the cluster health and, if enabled, the
+        cluster stats, pending tasks and index stats concurrently over the
+        shared HTTP session, so a poll takes as long as the slowest of them.
+        Instances with the same cluster setting share the responses, and
+        nothing is fetched when another agent holds the cluster_lock.
+
+        """
+        self.initialize()
+        if not self.cluster_leader:
+            return
+        fetches = {'health': lambda: self.fetch_json('/_cluster/health'),
+                   'nodes': self.fetch_data}
+        if self.config.get('cluster_stats'):
+            fetches['stats'] = lambda: self.fetch_json(
+                '/_cluster/stats', 'filter_path=%s' % self.CLUSTER_STATS)
+        if self.config.get('pending_tasks'):
+            fetches['pending'] = lambda: self.fetch_json(
+                '/_cluster/pending_tasks')
+        if self.config.get('indices'):
+            fetches['indices'] = lambda: self.fetch_json(
+                '/_stats/docs,get,indexing,search,store',
+                'level=indices&filter_path=%s' % ','.join(
+                    'indices.*.total.%s' % stat
+                    for stat in self.INDEX_STATS),
+                self.INDEX_FIELDS)
+        # The node stats vary with the metric groups requested, the other
+        # responses are the same for every instance of the cluster
+        keys = {'nodes': ('nodes',) + urlparse.urlsplit(self.stats_url)[2:4]}
+        results = base.concurrently(dict(
+            (name, functools.partial(self.cluster_fetch,
+                                     keys.get(name, name), fetch))
+            for name, fetch in fetches.items()))
+        if results.get('nodes'):
+            self.add_datapoints(results['nodes'])
+        if results.get('health'):
+            self.add_cluster_health_datapoints(results['health'])
+        if results.get('stats'):
+            self.add_cluster_stats_datapoints(results['stats'])
+        if results.get('pending') is not None:
+            self.add_pending_tasks_datapoints(results['pending'])
+        if results.get('indices'):
+            self.add_per_index_datapoints(results['indices'])
+        self.finish()
+
+    @property
+    def stats_url(self):
+        """Return the node stats URL, asking only for the metric groups and
+        fields that are used, unless a path is configured.
+
+        :rtype: str
+
+        """
+        if 'path' in self.config:
+            return super(ElasticSearch, self).stats_url
+        groups = self.node_metrics
+        paths = ['%s.%s' % (group, stat)
+                 for group in groups for stat in self.NODE_STATS[group]]
+        if self.config.get('nodes'):
+            groups = sorted(set(groups) | set(self.NODE_DETAILS))
+            paths += ['name'] + ['%s.%s' % (group, stat)
+                                 for group in sorted(self.NODE_DETAILS)
+                                 for stat in self.NODE_DETAILS[group]]
+        return self.url('%s/%s' % (self.DEFAULT_PATH, ','.join(groups)),
+                        'filter_path=%s' % ','.join('nodes.*.%s' % value
+                                                    for value in paths))
+
+    def sum_nodes(self, nodes):
+        """Add up the stats in NODE_STATS across all of the nodes, returning
+        them in the same tree as the node stats. Every node is counted, so
+        the Indices and Network metrics are totals for the cluster.
+
+        :param dict nodes: The stats of each node
+        :rtype: dict
+
+        """
+        totals = dict()
+        for group in self.node_metrics:
+            for stat in self.NODE_STATS[group]:
+                keys = stat.split('.')
+                total = 0
+                for node in nodes.values():
+                    value = node.get(group)
+                    for key in keys:
+                        value = value.get(key) if isinstance(value,
+                                                             dict) else None
+                    if isinstance(value, (int, long, float)):
+                        total += value
+                parent = totals.setdefault(group, dict())
+                for key in keys[:-1]:
+                    parent = parent.setdefault(key, dict())
+                parent[keys[-1]] = total
+        return totals
@@ -9,10 +9,70 @@ from newrelic_plugin_agent.plugins import base
 LOGGER = logging.getLogger(__name__)
 
 
-class HAProxy(base.CSVStatsPlugin):
+class HAProxy(base.CSVStatsPlugin, base.SocketStatsPlugin):
+    """Poll the HAProxy stats, either as CSV from the HTTP stats page or,
+    when stats_socket is set, with show info and show stat on the stats
+    socket.
 
+    """
+    COLUMNS = ['qcur', 'qmax', 'scur', 'smax', 'stot', 'bin', 'bout',
+               'dreq', 'dresp', 'ereq', 'eresp', 'econ', 'wretr', 'wredis',
+               'downtime', 'hrsp_5xx']
+    COMMAND = 'show info;show stat\n'
     DEFAULT_PATH = 'haproxy?stats;csv'
+    DISCOVERY_TTL = 60
+    ENTITIES = {'Backends/*': 'Sessions/Total[sessions]',
+                'Frontends/*': 'Sessions/Total[sessions]',
+                'Servers/*/*': 'Sessions/Total[sessions]'}
     GUID = 'com.meetme.newrelic_haproxy_agent'
+    LABELS = ['pxname', 'svname']
+    PERSISTENT = False
+
+    # The metrics added for each frontend, backend and server as
+    # (column, metric, units, derive)
+    ENTITY_METRICS = [('scur', 'Sessions/Current', 'sessions', False),
+                      ('stot', 'Sessions/Total', 'sessions', True),
+                      ('qcur', 'Queue/Current', 'connections', False),
+                      ('bin', 'Bytes/In', 'bytes', True),
+                      ('bout', 'Bytes/Out', 'bytes', True),
+                      ('dreq', 'Denied/Request', 'requests', True),
+                      ('ereq', 'Errors/Request', 'requests', True),
+                      ('econ', 'Errors/Connections', 'connections', True),
+                      ('eresp', 'Errors/Response', 'responses', True),
+                      ('hrsp_5xx', 'Responses/5xx', 'responses', True),
+                      ('wretr', 'Warnings/Retry', 'retries', True),
+                      ('wredis', 'Warnings/Redispatch', 'redispatches',
+                       True)]
+
+    # The show info fields added as (field, metric, units, derive)
+    INFO_METRICS = [('CurrConns', 'Info/Connections/Current', 'connections',
+                     False),
+                    ('CumConns', 'Info/Connections/Total', 'connections',
+                     True),
+                    ('CumReq', 'Info/Requests', 'requests', True),
+                    ('CurrSslConns', 'Info/SSL Connections/Current',
+                     'connections', False),
+                    ('Idle_pct', 'Info/Idle', 'percent', False),
+                    ('Run_queue', 'Info/Run Queue', 'tasks', False),
+                    ('Tasks', 'Info/Tasks', 'tasks', False)]
+
+    # The columns added up into the totals across all rows
+    METRICS = {'qcur': ('Queue', 'Current'),
+               'qmax': ('Queue', 'Max'),
+               'scur': ('Sessions', 'Current'),
+               'smax': ('Sessions', 'Max'),
+               'stot': ('Sessions', 'Total'),
+               'bin': ('Bytes', 'In'),
+               'bout': ('Bytes', 'Out'),
+               'dreq': ('Denied', 'Request'),
+               'dresp': ('Denied', 'Response'),
+               'ereq': ('Errors', 'Request'),
+               'eresp': ('Errors', 'Response'),
+               'econ': ('Errors', 'Connections'),
+               'wretr': ('Warnings', 'Retry'),
+               'wredis': ('Warnings', 'Redispatch'),
+               'downtime': ('Server', 'Downtime')}
+
     UNIT = {'Queue': {'Current': 'connections', 'Max': 'connections'},
             'Sessions': {'Current': 'sessions', 'Max': 'sessions',
                          'Total': 'sessions'},
@@ -23,46 +83,17 @@ class HAProxy(base.CSVStatsPlugin):
             'Server': {'Downtime': 'ms'},
             'Bytes': {'In': 'bytes', 'Out': 'bytes'}}
 
-    def sum_data(self, stats):
-        """Return the summed data as a dict
-
-        :rtype: dict
-
-        """
-        data = {'Queue': {'Current': 0, 'Max': 0},
-                'Sessions': {'Current': 0, 'Max': 0, 'Total': 0},
-                'Bytes': {'In': 0, 'Out': 0},
-                'Denied': {'Request': 0, 'Response': 0},
-                'Errors': {'Request': 0, 'Response': 0, 'Connections': 0},
-                'Warnings': {'Retry': 0, 'Redispatch': 0},
-                'Server': {'Downtime': 0}}
-        for row in stats:
-            data['Queue']['Current'] += int(row.get('qcur') or 0)
-            data['Queue']['Max'] += int(row.get('qmax') or 0)
-            data['Sessions']['Current'] += int(row.get('scur') or 0)
-            data['Sessions']['Max'] += int(row.get('smax') or 0)
-            data['Sessions']['Total'] += int(row.get('stot') or 0)
-            data['Bytes']['In'] += int(row.get('bin') or 0)
-            data['Bytes']['Out'] += int(row.get('bout') or 0)
-            data['Denied']['Request'] += int(row.get('dreq') or 0)
-            data['Denied']['Response'] += int(row.get('dresp') or 0)
-            data['Errors']['Request'] += int(row.get('ereq') or 0)
-            data['Errors']['Response'] += int(row.get('eresp') or 0)
-            data['Errors']['Connections'] += int(row.get('econ') or 0)
-            data['Warnings']['Retry'] += int(row.get('wretr') or 0)
-            data['Warnings']['Redispatch'] += int(row.get('wredis') or 0)
-            data['Server']['Downtime'] += int(row.get('downtime') or 0)
-        return data
-
     def add_datapoints(self, stats):
         """Add all of the data points for a node
 
-        :param list stats: The parsed csv content
+        :param dict stats: The show info fields and the parsed csv rows
 
         """
-        if not stats:
+        if not stats.get('rows'):
             return
-        stats = self.sum_data(stats)
+        self.add_info_datapoints(stats.get('info', dict()))
+        self.add_proxy_datapoints(stats['rows'])
+        stats = self.sum_data(stats['rows'])
 
         for section in [key for key in stats.keys() if key != 'server']:
             for key in stats[section].keys():
@@ -72,3 +103,210 @@ class HAProxy(base.CSVStatsPlugin):
                                       stats[section][key])
         self.add_gauge_value('Server/Downtime', 'ms',
                              stats['Server']['Downtime'])
+
+    def add_entity_datapoints(self, prefix, row, metrics):
+        """Add the data points for a single frontend, backend or server
+
+        :param str prefix: The metric name prefix of the entity
+        :param tuple row: The parsed csv row of the entity
+        :param list metrics: The row offset, metric, units and derive flag
+            of each metric
+
+        """
+        for offset, metric, units, derive in metrics:
+            if derive:
+                self.add_derive_value('%s/%s' % (prefix, metric), units,
+                                      row[offset])
+            else:
+                self.add_gauge_value('%s/%s' % (prefix, metric), units,
+                                     row[offset])
+
+    def add_info_datapoints(self, info):
+        """Add the process wide data points from show info
+
+        :param dict info: The show info fields
+
+        """
+        for field, metric, units, derive in self.INFO_METRICS:
+            if field not in info:
+                continue
+            if derive:
+                self.add_derive_value(metric, units, info[field])
+            elif field == 'CurrConns':
+                self.add_gauge_value(metric, units, info[field],
+                                     max_val=info.get('Maxconn'))
+            else:
+                self.add_gauge_value(metric, units, info[field])
+
+    def add_proxy_datapoints(self, rows):
+        """Add the data points for each frontend and backend, and for each
+        server if servers is set.
+
+        :param list rows: The parsed csv rows
+
+        """
+        labels = len(self.LABELS)
+        metrics = [(labels + self.COLUMNS.index(column), metric, units,
+                    derive)
+                   for column, metric, units, derive in self.ENTITY_METRICS]
+        servers = self.config.get('servers', False)
+        for row in rows:
+            proxy, service = row[0], row[1]
+            if service == 'FRONTEND':
+                self.add_entity_datapoints('Frontends/%s' % proxy, row,
+                                           metrics)
+            elif service == 'BACKEND':
+                self.add_entity_datapoints('Backends/%s' % proxy, row,
+                                           metrics)
+            elif servers:
+                self.add_entity_datapoints('Servers/%s/%s' %
+                                           (proxy, service), row, metrics)
+
+    @classmethod
+    def discover(cls, config):
+        """Return a config for each per-process stats socket matching the
+        glob in path, rescanning them every discovery_ttl seconds.
+
+        :param dict config: The configured instance
+        :rtype: list
+
+        """
+        members = base.discovered((cls.__name__, config.get('path')),
+                                  config.get('discovery_ttl',
+                                             cls.DISCOVERY_TTL),
+                                  lambda: cls.glob_sockets(
+                                      config.get('path', '')))
+        if not members:
+            LOGGER.error('No HAProxy stats sockets found for %s',
+                         config.get('name', 'unnamed'))
+            return list()
+        configs = list()
+        for name, address in members:
+            member = dict((key, value) for key, value in config.items()
+                          if key not in ('discover', 'discovery_ttl',
+                                         'path'))
+            member.update(address)
+            member['name'] = '%s/%s' % (config.get('name', 'unnamed'), name)
+            configs.append(member)
+        return configs
+
+    def fetch_data(self, connection=None, reused=False):
+        """Fetch the stats from the stats socket, or the CSV rows from the
+        HTTP stats page when stats_socket is not set.
+
+        :param socket connection: The stats socket connection
+        :param bool reused: If the connection was reused from the pool
+        :rtype: dict
+
+        """
+        if self.stats_socket:
+            return base.SocketStatsPlugin.fetch_data(self, connection, reused)
+        return {'info': dict(), 'rows': base.CSVStatsPlugin.fetch_data(self)}
+
+    @classmethod
+    def multiplexed(cls, config):
+        """Only stats socket instances are polled by the multiplexed poller,
+        HTTP instances are polled from their own thread.
+
+        :param dict config: The configured instance
+        :rtype: bool
+
+        """
+        return (bool(config.get('stats_socket')) and
+                super(HAProxy, cls).multiplexed(config))
+
+    def parse_reply(self, data):
+        """Parse the show info fields and the show stat rows out of the
+        stats socket reply, each command's output ending in an empty line.
+
+        :param buffer data: The stats socket reply
+        :rtype: dict
+
+        """
+        info_output, _separator, stat_output = str(data).partition('\n\n')
+        info = dict()
+        for line in info_output.splitlines():
+            field, _separator, value = line.partition(':')
+            try:
+                info[field] = int(value)
+            except ValueError:
+                continue
+        if not stat_output.startswith('# '):
+            LOGGER.error('Unexpected reply from HAProxy stats socket: %s',
+                         (info_output or stat_output).strip()[:200])
+            return None
+        return {'info': info, 'rows': self.parse_rows(
+            stat_output.splitlines())}
+
+    def poll(self):
+        """Poll the stats socket, or the HTTP stats page when stats_socket is
+        not set.
+
+        """
+        if self.stats_socket:
+            return base.SocketStatsPlugin.poll(self)
+        return base.CSVStatsPlugin.poll(self)
+
+    @property
+    def stats_socket(self):
+        """Return True if the stats are read from the HAProxy stats socket
+
+        :rtype: bool
+
+        """
+        return bool(self.config.get('stats_socket'))
+
+    @classmethod
+    def summarize(cls, config, instances, poll_interval):
+        """Return a plugin instance reporting the totals across the stats
+        sockets of all of the HAProxy processes, with the idle percentage
+        averaged instead of added up.
+
+        :param dict config: The configured instance
+        :param list instances: The polled plugin instances
+        :param int poll_interval: How often the plugin is invoked
+        :rtype: HAProxy
+
+        """
+        summary = cls(config, poll_interval)
+        summary.initialize()
+        responding = 0
+        totals = dict()
+        for instance in instances:
+            if not instance.gauge_values:
+                continue
+            responding += 1
+            for source, values in ((instance.derive_values,
+                                    summary.derive_values),
+                                   (instance.gauge_values,
+                                    summary.gauge_values)):
+                for metric, payload in source.items():
+                    totals[metric] = totals.get(metric, 0) + payload['total']
+                    values[metric] = summary.metric_payload(totals[metric])
+        idle = summary.metric_name('Info/Idle', 'percent')
+        if idle in summary.gauge_values:
+            summary.gauge_values[idle] = summary.metric_payload(
+                totals[idle] / float(responding))
+        summary.add_gauge_value('Processes', 'processes', len(instances))
+        summary.add_gauge_value('Processes/Responding', 'processes',
+                                responding)
+        return summary
+
+    def sum_data(self, stats):
+        """Return the summed data as a dict
+
+        :param list stats: The parsed rows with a value for each column
+        :rtype: dict
+
+        """
+        labels = len(self.LABELS)
+        totals = [0] * len(self.COLUMNS)
+        for row in stats:
+            for index in range(len(self.COLUMNS)):
+                totals[index] += row[labels + index]
+        data = dict((section, dict()) for section in self.UNIT)
+        for column, total in zip(self.COLUMNS, totals):
+            if column in self.METRICS:
+                section, key = self.METRICS[column]
+                data[section][key] = total
+        return data
@@ -3,6 +3,7 @@ memcached
 
 """
 import logging
+import re
 
 from newrelic_plugin_agent.plugins import base
 
@@ -12,6 +13,7 @@ LOGGER = logging.getLogger(__name__)
 class Memcached(base.SocketStatsPlugin):
 
     GUID = 'com.meetme.newrelic_memcached_agent'
+    COMMAND = 'stats\r\n'
     DEFAULT_PORT = 11211
     KEYS = ['curr_connections',
             'curr_items',
@@ -41,7 +43,30 @@ class Memcached(base.SocketStatsPlugin):
             'conn_yields',
             'rusage_system']
 
+    # Per slab class fields from stats slabs and stats items
+    SLAB_KEYS = ['age',
+                 'chunk_size',
+                 'evicted',
+                 'evicted_unfetched',
+                 'expired_unfetched',
+                 'free_chunks',
+                 'mem_requested',
+                 'number',
+                 'outofmemory',
+                 'reclaimed',
+                 'total_chunks',
+                 'total_pages',
+                 'used_chunks']
+
+    # Per slab class metrics limited with the top_k setting
+    ENTITIES = {'Slabs/*': 'Memory/Requested[bytes]'}
+
+    SLAB_COMMANDS = 'stats slabs\r\nstats items\r\n'
     SOCKET_RECV_MAX = 32768
+    ERROR_LINE = re.compile(r'^((?:CLIENT_|SERVER_)?ERROR[^\r\n]*)\r\n', re.M)
+    REPLY_END = re.compile(r'^(?:END|(?:CLIENT_|SERVER_)?ERROR[^\r\n]*)\r\n',
+                           re.M)
+    STAT_LINE = re.compile(r'STAT (?:(?:items:)?(\d+):)?(\S+) ([^\r\n]*)\r\n')
 
     def add_datapoints(self, stats):
         """Add all of the data points for a node
@@ -78,6 +103,54 @@ class Memcached(base.SocketStatsPlugin):
                               stats['rusage_user'])
         self.add_gauge_value('System/Memory', 'bytes', stats['bytes'])
 
+        if 'slabs' in stats:
+            self.add_gauge_value('Memory/Malloced', 'bytes',
+                                 stats.get('total_malloced', 0))
+            self.add_gauge_value('Slab Classes', 'classes',
+                                 len(stats['slabs']))
+            for slab_id, slab in stats['slabs'].items():
+                self.add_slab_datapoints(slab_id, slab)
+
+    def add_slab_datapoints(self, slab_id, slab):
+        """Add the chunk usage, evictions and item age of a slab class
+
+        :param str slab_id: The slab class id
+        :param dict slab: The slab class fields
+
+        """
+        name = 'Slabs/%s' % slab_id
+        self.add_gauge_value('%s/Chunk Size' % name, 'bytes',
+                             slab.get('chunk_size', 0))
+        self.add_gauge_value('%s/Chunks/Free' % name, 'chunks',
+                             slab.get('free_chunks', 0))
+        self.add_gauge_value('%s/Chunks/Total' % name, 'chunks',
+                             slab.get('total_chunks', 0))
+        self.add_gauge_value('%s/Chunks/Used' % name, 'chunks',
+                             slab.get('used_chunks', 0))
+        if slab.get('total_chunks'):
+            self.add_gauge_value('%s/Chunks/Utilization' % name, 'percent',
+                                 100.0 * slab.get('used_chunks', 0) /
+                                 slab['total_chunks'])
+        self.add_gauge_value('%s/Memory/Requested' % name, 'bytes',
+                             slab.get('mem_requested', 0))
+        self.add_gauge_value('%s/Pages' % name, 'pages',
+                             slab.get('total_pages', 0))
+
+        self.add_gauge_value('%s/Items' % name, 'items',
+                             slab.get('number', 0))
+        self.add_gauge_value('%s/Items/Age' % name, 'seconds',
+                             slab.get('age', 0))
+        self.add_derive_value('%s/Evictions' % name, 'items',
+                              slab.get('evicted', 0))
+        self.add_derive_value('%s/Evictions/Unfetched' % name, 'items',
+                              slab.get('evicted_unfetched', 0))
+        self.add_derive_value('%s/Expirations/Unfetched' % name, 'items',
+                              slab.get('expired_unfetched', 0))
+        self.add_derive_value('%s/Out Of Memory' % name, 'errors',
+                              slab.get('outofmemory', 0))
+        self.add_derive_value('%s/Reclaimed' % name, 'items',
+                              slab.get('reclaimed', 0))
+
     def command_value(self, name, prefix, stats):
         """Process commands adding the command and the hit ratio.
 
@@ -94,42 +167,39 @@ class Memcached(base.SocketStatsPlugin):
         self.add_derive_value('Command/Requests/%s' % name, 'requests', total)
         self.add_gauge_value('Command/Hit Ratio/%s' % name, 'ratio', ratio)
 
-    def fetch_data(self, connection):
-        """Loop in and read in all the data until we have received it all.
+    def parse_reply(self, data):
+        """Scan the STAT rows of the replies to the stats commands in place
+        and process them in a single pass. Commands answered with an error,
+        such as stats slabs on a proxy, are logged and skipped.
 
-        :param  socket connection: The connection
+        :param buffer data: The complete reply
+        :rtype: dict
 
         """
-        connection.send("stats\n")
-        data = super(Memcached, self).fetch_data(connection)
-        data_in = []
-        for line in data.replace('\r', '').split('\n'):
-            if line == 'END':
-                return self.process_data(data_in)
-            data_in.append(line.strip())
-        return None
+        for error in self.ERROR_LINE.findall(data):
+            LOGGER.warning('Error reply to a memcached stats command: %s',
+                           error)
+        return self.process_data(match.groups() for match in
+                                 self.STAT_LINE.finditer(data))
 
     def process_data(self, data):
-        """Loop through all the rows and parse each line, looking to see if it
-        is in the data points we would like to process, adding the key => value
-        pair to values if it is.
+        """Loop through all the rows, looking to see if each key is in the
+        data points we would like to process, adding the key => value pair to
+        values if it is. Rows for a slab class, from stats slabs or stats
+        items, are added to the slabs dict by slab class id.
 
-        :param list data: The list of rows
+        :param iterable data: The (slab id, key, value) tuples of the rows
         :returns: dict
 
         """
-        values = dict()
-        for row in data:
-            parts = row.split(' ')
-            if parts[1] in self.KEYS:
-                try:
-                    values[parts[1]] = int(parts[2])
-                except ValueError:
-                    try:
-                        values[parts[1]] = float(parts[2])
-                    except ValueError:
-                        LOGGER.warning('Could not parse line: %r', parts)
-                        values[parts[1]] = 0
+        values, slabs = dict(), dict()
+        for slab_id, key, value in data:
+            if slab_id:
+                if key in self.SLAB_KEYS:
+                    slabs.setdefault(slab_id, dict())[key] = \
+                        self.parse_value(key, value)
+            elif key in self.KEYS or key == 'total_malloced':
+                values[key] = self.parse_value(key, value)
 
         # Back fill any missed data
         for key in self.KEYS:
@@ -137,5 +207,63 @@ class Memcached(base.SocketStatsPlugin):
                 LOGGER.info('Populating missing element with 0: %s', key)
                 values[key] = 0
 
+        if self.slab_stats:
+            values['slabs'] = slabs
+
         # Return the values dict
         return values
+
+    @staticmethod
+    def parse_value(key, value):
+        """Return the numeric value of a STAT row
+
+        :param str key: The key of the row
+        :param str value: The value of the row
+        :rtype: int|float
+
+        """
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                LOGGER.warning('Could not parse value of %s: %r', key, value)
+                return 0
+
+    def reply_complete(self, data, closed):
+        """Return True once the END line, or an error line, of the reply to
+        each of the stats commands was received. Only the lines received
+        since the last call are scanned for terminators.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer data: The
+            data received so far
+        :param bool closed: If the remote end closed the connection
+        :rtype: bool
+
+        """
+        if not data.endswith('\r\n'):
+            return False
+        replies = 3 if self.slab_stats else 1
+        return data.count_lines(self.REPLY_END) >= replies
+
+    def request(self, reused):
+        """Return the stats command, followed by the stats slabs and stats
+        items commands in the same write if slab stats are enabled.
+
+        :param bool reused: If the connection was reused from the pool
+        :rtype: str
+
+        """
+        if self.slab_stats:
+            return self.COMMAND + self.SLAB_COMMANDS
+        return self.COMMAND
+
+    @property
+    def slab_stats(self):
+        """Return True if per slab class stats should be collected
+
+        :rtype: bool
+
+        """
+        return self.config.get('slabs', False)
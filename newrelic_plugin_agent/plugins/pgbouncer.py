@@ -12,6 +12,8 @@ LOGGER = logging.getLogger(__name__)
 class PgBouncer(postgresql.PostgreSQL):
 
     GUID = 'com.meetme.newrelic_pgbouncer_agent'
+    ENTITIES = {'Database/*': 'Requests[requests]',
+                'Pools/*': 'Clients/Active[clients]'}
     MULTIROW = ['POOLS', 'STATS']
 
     def add_pgbouncer_stats(self, stats):
@@ -47,6 +49,7 @@ class PgBouncer(postgresql.PostgreSQL):
 
         self.add_derive_value('Overview/Requests', 'requests', requests)
 
+        maxwait = list()
         for pool in stats['POOLS']:
             metric = 'Pools/%s' % pool['database']
             self.add_gauge_value('%s/Clients/Active' % metric, 'clients',
@@ -65,6 +68,10 @@ class PgBouncer(postgresql.PostgreSQL):
                                  pool['sv_used'])
             self.add_gauge_value('%s/Maximum Wait' % metric, 'seconds',
                                  pool['maxwait'])
+            maxwait.append(pool['maxwait'])
+
+        self.add_distribution_values('Overview/Maximum Wait', 'seconds',
+                                     maxwait)
 
     def add_stats(self, cursor):
         stats = dict()
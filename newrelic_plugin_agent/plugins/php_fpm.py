@@ -4,13 +4,21 @@ PHP FPM Support
 """
 import logging
 
+from newrelic_plugin_agent import fastcgi
+from newrelic_plugin_agent import streaming
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
 
-class FPM(base.JSONStatsPlugin):
+class FPM(base.JSONStatsPlugin, base.SocketStatsPlugin):
+    """Poll the php-fpm status page, either through a web server with HTTP
+    or, when fastcgi is set, directly from the pool's FastCGI socket.
 
+    """
+    DEFAULT_STATUS_PATH = '/status'
+    FASTCGI_PORT = 9000
+    FASTCGI_QUERY = 'json'
     GUID = 'com.meetme.newrelic_php_fpm_agent'
 
     def add_datapoints(self, stats):
@@ -41,3 +49,150 @@ class FPM(base.JSONStatsPlugin):
 
         self.add_derive_value('Slow Requests', 'requests',
                               stats.get('slow requests', 0))
+
+        if stats.get('processes'):
+            self.add_process_datapoints(stats['processes'])
+
+    def add_process_datapoints(self, processes):
+        """Summarize the per-process values from the full status output
+        as distributions instead of adding metrics for each process.
+
+        :param list processes: The per-process stats
+
+        """
+        duration, memory, cpu = list(), list(), list()
+        for process in processes:
+            duration.append(process.get('request duration', 0))
+            memory.append(process.get('last request memory', 0))
+            cpu.append(process.get('last request cpu', 0))
+
+        self.add_distribution_values('Processes/Request Duration', 'us',
+                                     duration)
+        self.add_distribution_values('Processes/Request Memory', 'bytes',
+                                     memory)
+        self.add_distribution_values('Processes/Request CPU', 'percent', cpu)
+
+    def fetch_data(self, connection=None, reused=False):
+        """Fetch the status page from the FastCGI socket, or from the HTTP
+        status URL when fastcgi is not set.
+
+        :param socket connection: The FastCGI socket connection
+        :param bool reused: If the connection was reused from the pool
+        :rtype: dict
+
+        """
+        if self.fastcgi:
+            return base.SocketStatsPlugin.fetch_data(self, connection, reused)
+        return base.JSONStatsPlugin.fetch_data(self)
+
+    @property
+    def fastcgi(self):
+        """Return True if the status page is requested directly from the
+        FastCGI socket of the pool.
+
+        :rtype: bool
+
+        """
+        return bool(self.config.get('fastcgi'))
+
+    @classmethod
+    def multiplexed(cls, config):
+        """Only FastCGI instances are polled by the multiplexed poller,
+        HTTP instances are polled from their own thread.
+
+        :param dict config: The configured instance
+        :rtype: bool
+
+        """
+        return (bool(config.get('fastcgi')) and
+                super(FPM, cls).multiplexed(config))
+
+    def parse_reply(self, data):
+        """Parse the status page out of the FastCGI response, returning None
+        if php-fpm did not return the status page.
+
+        :param buffer data: The FastCGI response
+        :rtype: dict
+
+        """
+        try:
+            stdout, stderr, _status = fastcgi.response(data)
+        except ValueError as error:
+            LOGGER.error('Invalid FastCGI response: %s', error)
+            return None
+        if stderr:
+            LOGGER.warning('php-fpm error output: %s', stderr.strip())
+        headers, _separator, body = stdout.partition('\r\n\r\n')
+        for header in headers.split('\r\n'):
+            name, _separator, value = header.partition(':')
+            if name.strip().lower() == 'status' and \
+                    not value.strip().startswith('2'):
+                LOGGER.error('Error response from php-fpm status %s: %s',
+                             self.status_path, value.strip())
+                return None
+        try:
+            if self.FIELDS:
+                return streaming.select(body, self.FIELDS)
+            return streaming.loads(body)
+        except Exception as error:
+            LOGGER.error('JSON decoding error: %r', error)
+            return None
+
+    def poll(self):
+        """Poll the FastCGI socket, or the HTTP status URL when fastcgi is
+        not set.
+
+        """
+        if self.fastcgi:
+            return base.SocketStatsPlugin.poll(self)
+        return base.JSONStatsPlugin.poll(self)
+
+    @property
+    def remote_address(self):
+        """Return the host and port of the FastCGI socket, port 9000 unless
+        another port is configured.
+
+        :rtype: tuple
+
+        """
+        return (self.config.get('host', self.DEFAULT_HOST),
+                self.config.get('port', self.FASTCGI_PORT))
+
+    def reply_complete(self, data, closed):
+        """The response is complete once the end of request record has been
+        received.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer data: The
+            data received so far
+        :param bool closed: If the remote end closed the connection
+        :rtype: bool
+
+        """
+        return fastcgi.response_end(data.data, len(data)) != -1
+
+    def request(self, reused):
+        """Return the FastCGI request for the status page, asking php-fpm to
+        keep the connection open when connections are pooled.
+
+        :param bool reused: If the connection was reused from the pool
+        :rtype: str
+
+        """
+        return fastcgi.request(
+            {'GATEWAY_INTERFACE': 'CGI/1.1',
+             'QUERY_STRING': self.config.get('query', self.FASTCGI_QUERY),
+             'REQUEST_METHOD': 'GET',
+             'REQUEST_URI': self.status_path,
+             'SCRIPT_FILENAME': self.status_path,
+             'SCRIPT_NAME': self.status_path,
+             'SERVER_PROTOCOL': 'HTTP/1.1'},
+            keep_conn=self.persistent)
+
+    @property
+    def status_path(self):
+        """Return the pm.status_path of the pool
+
+        :rtype: str
+
+        """
+        return self.config.get('status_path', self.DEFAULT_STATUS_PATH)
@@ -62,6 +62,7 @@ LOCK_MAP = {'AccessExclusiveLock': 'Locks/Access Exclusive',
 class PostgreSQL(base.Plugin):
 
     GUID = 'com.meetme.newrelic_postgresql_agent'
+    ENTITIES = {'Database/*': 'Transactions/Committed[transactions]'}
 
     def add_stats(self, cursor):
         self.add_backend_stats(cursor)
@@ -2,10 +2,14 @@
 rabbitmq
 
 """
+import functools
 import logging
 import requests
 import time
+import urlparse
 
+from newrelic_plugin_agent import connections
+from newrelic_plugin_agent import streaming
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -20,6 +24,10 @@ class RabbitMQ(base.Plugin):
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 80
     DEFAULT_API_PATH = '/api'
+    DEFAULT_PAGE_SIZE = 500
+    TIMEOUT = 30
+
+    ENTITIES = {'Queue/*/*': 'Messages/Published[messages]'}
 
     DUMMY_STATS = {'ack': 0,
                    'deliver': 0,
@@ -29,30 +37,56 @@ class RabbitMQ(base.Plugin):
                    'publish': 0,
                    'redeliver': 0}
 
-    def add_node_datapoints(self, node_data, queue_data, channel_data):
+    # The metric names of the message stats in DUMMY_STATS
+    MESSAGE_NAMES = {'ack': 'Acknowledged',
+                     'deliver': 'Delivered',
+                     'deliver_no_ack': 'Delivered No-Ack',
+                     'get': 'Got',
+                     'get_no_ack': 'Got No-Ack',
+                     'publish': 'Published',
+                     'redeliver': 'Redelivered'}
+
+    # The metric names of the queue message stats, in the order they are
+    # kept in the values of each queue
+    QUEUE_MESSAGES = (('Acknowledged', 'ack'),
+                      ('Delivered (All)', 'deliver_get'),
+                      ('Delivered', 'deliver'),
+                      ('Delivered No-Ack', 'deliver_no_ack'),
+                      ('Get', 'get'),
+                      ('Get No-Ack', 'get_no_ack'),
+                      ('Published', 'publish'),
+                      ('Redelivered', 'redeliver'))
+
+    # The columns of each list that are used, so the management API does not
+    # have to render and send anything else
+    CHANNEL_COLUMNS = (['client_flow_blocked', 'node'] +
+                       ['message_stats.%s' % key for key in DUMMY_STATS])
+    NODE_COLUMNS = ['fd_used', 'mem_used', 'name', 'proc_used',
+                    'sockets_used']
+    QUEUE_COLUMNS = (['active_consumers', 'consumers', 'messages_ready',
+                      'messages_unacknowledged', 'name', 'node', 'vhost',
+                      'message_stats.deliver_get'] +
+                     ['message_stats.%s' % key for key in DUMMY_STATS])
+
+    def add_node_datapoints(self, node_data, nodes):
         """Add all of the data points for a node
 
         :param list node_data: all of the nodes
-        :param list queue_data: all of the queues
-        :param list channel_data: all of the channels
+        :param dict nodes: The channel and queue totals of each node
 
         """
         channels = 0
         for node in node_data:
             name = node['name'].split('@')[-1]
-            self.add_node_channel_datapoints(name, channel_data)
-            self.add_node_message_datapoints(name, queue_data, channel_data)
-            self.add_node_queue_datapoints(name, queue_data)
-
-            count = 0
-            for channel in channel_data:
-                if channel['node'].split('@')[-1] == name:
-                    count += 1
-            channels += count
+            totals = nodes[node['name']]
+            self.add_node_channel_datapoints(name, totals)
+            self.add_node_message_datapoints(name, totals)
+            self.add_node_queue_datapoints(name, totals)
+            channels += totals['channels']
 
             base_name = 'Node/%s' % name
             self.add_gauge_value('%s/Channels/Open' % base_name,
-                                 'channels', count)
+                                 'channels', totals['channels'])
             self.add_gauge_value('%s/Erlang Processes' % base_name, 'processes',
                                  node.get('proc_used', 0))
             self.add_gauge_value('%s/File Descriptors' % base_name, 'fds',
@@ -66,137 +100,63 @@ class RabbitMQ(base.Plugin):
         self.add_gauge_value('Summary/Channels', 'channels', channels)
         self.add_gauge_value('Summary/Consumers', 'consumers', self.consumers)
 
-    def add_node_channel_datapoints(self, node, channel_data):
-        """Add datapoints for a node, creating summary values for top-level
-        queue consumer counts and message counts.
+    def add_node_channel_datapoints(self, node, totals):
+        """Add the number of channels of a node blocked by flow control
 
         :param str node: The node name
-        :param list channel_data: The full stack of queue metrics
+        :param dict totals: The channel and queue totals of the node
 
         """
-        channel_flow_blocked = 0
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                if channel.get('client_flow_blocked'):
-                    channel_flow_blocked += 1
-
         self.add_gauge_value('Node/%s/Channels/Blocked' % node, 'channels',
-                             channel_flow_blocked)
+                             totals['blocked'])
 
-    def add_node_message_datapoints(self, node, queue_data, channel_data):
+    def add_node_message_datapoints(self, node, totals):
         """Add message stats for the node
 
         :param str node: The node name
-        :param list queue_data: all of the queues
-        :param list channel_data: all of the channels
+        :param dict totals: The channel and queue totals of the node
 
         """
         base_name = 'Node/%s/Messages' % node
-
-        # Top level message stats
-        keys = self.DUMMY_STATS.keys()
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                for key in keys:
-                    total[key] += channel.get(key, 0)
-
-        # Per-Channel message Rates
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        message_stats = list()
-        for channel in channel_data:
-            if channel['node'].split('@')[-1] == node:
-                stats = channel.get('message_stats')
-                if stats:
-                    message_stats.append(stats)
-
-        for stat_block in message_stats:
-            for key in keys:
-                total[key] += stat_block.get(key, 0)
-
-        for key in keys:
-            name = key
-            if key == 'ack':
-                name = 'Acknowledged'
-            elif key == 'deliver':
-                name = 'Delivered'
-            elif key == 'deliver_get':
-                name = 'Delivered (Total)'
-            elif key == 'deliver_no_ack':
-                name = 'Delivered No-Ack'
-            elif key == 'get':
-                name = 'Got'
-            elif key == 'get_no_ack':
-                name = 'Got No-Ack'
-            elif key == 'publish':
-                name = 'Published'
-            elif key == 'redeliver':
-                name = 'Redelivered'
-            self.add_derive_value('%s/%s' % (base_name, name),
-                                  'messages',
-                                  total[key])
-
-        keys = ['messages_ready', 'messages_unacknowledged']
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        for queue in queue_data:
-            if queue['node'].split('@')[-1] == node:
-                for key in keys:
-                    total[key] += queue.get(key, 0)
+        for key, value in totals['messages'].items():
+            self.add_derive_value('%s/%s' % (base_name,
+                                             self.MESSAGE_NAMES[key]),
+                                  'messages', value)
 
         self.add_gauge_value('%s Available' % base_name, 'messages',
-                             total['messages_ready'])
+                             totals['messages_ready'])
         self.add_gauge_value('%s Unacknowledged' % base_name,
                              'messages',
-                             total['messages_unacknowledged'])
+                             totals['messages_unacknowledged'])
 
-    def add_node_queue_datapoints(self, node, queue_data):
-        """Add datapoints for a node, creating summary values for top-level
-        queue consumer counts and message counts.
+    def add_node_queue_datapoints(self, node, totals):
+        """Add the consumer counts of the queues on a node, adding them to
+        the summary consumer count.
 
         :param str node: The node name
-        :param list queue_data: The full stack of queue metrics
+        :param dict totals: The channel and queue totals of the node
 
         """
-        keys = ['consumers', 'active_consumers', 'idle_consumers']
-        count, total, min_val, max_val, values = self.initialize_counters(keys)
-        del keys[2]
-        for queue in queue_data:
-            if queue['node'].split('@')[-1] == node:
-                for key in keys:
-                    count[key] += 1
-                    value = queue.get(key, 0)
-                    total[key] += value
-                    values[key].append(value)
-
-                # Inventing a new key here, so it's a manual override
-                key = 'idle_consumers'
-                count[key] += count['consumers']
-                idle_count = total['consumers'] - total['active_consumers']
-                total[key] += idle_count
-                values[key].append(idle_count)
-
         base_name = 'Node/%s/Consumers' % node
         self.add_gauge_value('%s/Count' % base_name, 'consumers',
-                             total['consumers'],
+                             totals['consumers'],
                              None,
                              None,
-                             count['consumers'])
+                             totals['queues'])
 
-        self.consumers += total['consumers']
+        self.consumers += totals['consumers']
 
         self.add_gauge_value('%s/Active' % base_name, 'consumers',
-                             total['active_consumers'],
+                             totals['active_consumers'],
                              None,
                              None,
-                             count['active_consumers'])
+                             totals['queues'])
 
-        base_name = 'Node/%s/Consumers' % node
         self.add_gauge_value('%s/Idle' % base_name, 'consumers',
-                             total['idle_consumers'],
+                             totals['consumers'] - totals['active_consumers'],
                              None,
                              None,
-                             count['idle_consumers'])
+                             totals['queues'])
 
     def track_vhost_queue(self, vhost_name, queue_name):
         """ Checks whether the data for a vhost queue should be tracked or not
@@ -217,58 +177,40 @@ class RabbitMQ(base.Plugin):
     def add_queue_datapoints(self, queue_data):
         """Add per-queue datapoints to the processing stack.
 
-        :param list queue_data: The raw queue data list
+        :param iter queue_data: The values of each queue from queue_values
 
         """
         count = 0
-        available, consumers, deliver, publish, redeliver, unacked = \
-            0, 0, 0, 0, 0, 0
+        available, deliver, publish, redeliver, unacked = 0, 0, 0, 0, 0
         for count, queue in enumerate(queue_data):
-            if queue['name'][0:6] == 'amq.gen':
-                LOGGER.debug('Skipping auto-named queue: %s', queue['name'])
-                continue
-
-            message_stats = queue.get('message_stats', dict())
-            if not message_stats:
-                message_stats = self.DUMMY_STATS
+            vhost, name, consumers, ready, unacknowledged, messages = queue
+            vhost = 'Default' if vhost == '/' else vhost
+            entity = 'Queue/%s/%s' % (vhost, name)
 
-            vhost = 'Default' if queue['vhost'] == '/' else queue['vhost']
-            base_name = 'Queue/%s/%s' % (vhost, queue['name'])
-
-            if not self.track_vhost_queue(vhost, queue['name']):
+            if not self.track_vhost_queue(vhost, name):
                 continue
 
-            self.add_gauge_value('%s/Consumers' % base_name, 'consumers',
-                                 queue.get('consumers', 0))
-
-            base_name = 'Queue/%s/%s/Messages' % (vhost, queue['name'])
-            self.add_derive_value('%s/Acknowledged' % base_name, 'messages',
-                                  message_stats.get('ack', 0))
-            self.add_derive_value('%s/Delivered (All)' % base_name, 'messages',
-                                  message_stats.get('deliver_get', 0))
-            self.add_derive_value('%s/Delivered' % base_name, 'messages',
-                                  message_stats.get('deliver', 0))
-            self.add_derive_value('%s/Delivered No-Ack' % base_name, 'messages',
-                                  message_stats.get('deliver_no_ack', 0))
-            self.add_derive_value('%s/Get' % base_name, 'messages',
-                                  message_stats.get('get', 0))
-            self.add_derive_value('%s/Get No-Ack' % base_name, 'messages',
-                                  message_stats.get('get_no_ack', 0))
-            self.add_derive_value('%s/Published' % base_name, 'messages',
-                                  message_stats.get('publish', 0))
-            self.add_derive_value('%s/Redelivered' % base_name, 'messages',
-                                  message_stats.get('redeliver', 0))
+            self.add_gauge_value('%s/Consumers' % entity, 'consumers',
+                                 consumers, entity=entity)
+
+            message_stats = dict(zip([key for _metric, key
+                                      in self.QUEUE_MESSAGES], messages))
+            base_name = '%s/Messages' % entity
+            for metric, key in self.QUEUE_MESSAGES:
+                self.add_derive_value('%s/%s' % (base_name, metric),
+                                      'messages', message_stats[key],
+                                      entity=entity)
 
             self.add_gauge_value('%s Available' % base_name, 'messages',
-                                 queue.get('messages_ready', 0))
+                                 ready, entity=entity)
             self.add_gauge_value('%s Unacknowledged' % base_name, 'messages',
-                                 queue.get('messages_unacknowledged', 0))
+                                 unacknowledged, entity=entity)
 
-            available += queue.get('messages_ready', 0)
-            deliver += message_stats.get('deliver_get', 0)
-            publish += message_stats.get('publish', 0)
-            redeliver += message_stats.get('redeliver', 0)
-            unacked += queue.get('messages_unacknowledged', 0)
+            available += ready
+            deliver += message_stats['deliver_get']
+            publish += message_stats['publish']
+            redeliver += message_stats['redeliver']
+            unacked += unacknowledged
 
         # Summary stats
         self.add_derive_value('Summary/Messages/Delivered', 'messages',
@@ -283,6 +225,48 @@ class RabbitMQ(base.Plugin):
         self.add_gauge_value('Summary/Messages Unacknowledged', 'messages',
                              unacked, count=count)
 
+    def add_channel_totals(self, nodes, channel_data):
+        """Add up the channels, blocked channels and channel message stats
+        of each node in a single pass over the channels.
+
+        :param dict nodes: The channel and queue totals of each node
+        :param iter channel_data: all of the channels
+
+        """
+        for channel in channel_data:
+            totals = nodes.get(channel.get('node'))
+            if totals is None:
+                continue
+            totals['channels'] += 1
+            if channel.get('client_flow_blocked'):
+                totals['blocked'] += 1
+            stats = channel.get('message_stats')
+            if stats:
+                messages = totals['messages']
+                for key in messages:
+                    messages[key] += stats.get(key, 0)
+
+    def count_node_queues(self, nodes, queue_data):
+        """Add each queue to the totals of its node as it is passed through,
+        so the queues are only iterated over once.
+
+        :param dict nodes: The channel and queue totals of each node
+        :param iter queue_data: all of the queues
+        :rtype: iter
+
+        """
+        for queue in queue_data:
+            totals = nodes.get(queue.get('node'))
+            if totals is not None:
+                totals['queues'] += 1
+                totals['consumers'] += queue.get('consumers', 0)
+                totals['active_consumers'] += queue.get('active_consumers',
+                                                        0)
+                totals['messages_ready'] += queue.get('messages_ready', 0)
+                totals['messages_unacknowledged'] += queue.get(
+                    'messages_unacknowledged', 0)
+            yield queue
+
     def http_get(self, url, params=None):
         """Make a HTTP request for the URL.
 
@@ -293,34 +277,49 @@ class RabbitMQ(base.Plugin):
         kwargs = {'url': url,
                   'auth': (self.config.get('username', self.DEFAULT_USER),
                            self.config.get('password', self.DEFAULT_PASSWORD)),
+                  'stream': True,
+                  'timeout': self.config.get('timeout', self.TIMEOUT),
                   'verify': self.config.get('verify_ssl_cert', True)}
         if params:
             kwargs['params'] = params
 
         try:
-            return self.requests_session.get(**kwargs)
-        except requests.ConnectionError as error:
+            return self.session.get(**kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
             LOGGER.error('Error fetching data from %s: %s', url, error)
             return None
 
-    def fetch_data(self, data_type, columns=None):
+    def fetch_data(self, data_type, columns=None, params=None):
         """Fetch the data from the RabbitMQ server for the specified data type
 
         :param str data_type: The type of data to query
         :param list columns: Ask for specific columns
+        :param dict params: Additional query string parameters
         :rtype: list
 
         """
         url = '%s/%s' % (self.rabbitmq_base_url, data_type)
-        params = {'columns': ','.join(columns)} if columns else {}
+        params = dict(params or {})
+        if columns:
+            params['columns'] = ','.join(columns)
         response = self.http_get(url, params)
-        if not response or response.status_code != 200:
-            if response:
+        if response is None:
+            return list()
+        try:
+            if response.status_code != 200:
                 LOGGER.error('Error response from %s (%s): %s', url,
                              response.status_code, response.content)
+                return list()
+            data = base.response_content(
+                response, self.config.get('max_response_size',
+                                          base.MAX_RESPONSE_SIZE))
+        except ValueError as error:
+            LOGGER.error('Error reading %s: %s', url, error)
             return list()
+        finally:
+            response.close()
         try:
-            return response.json()
+            return streaming.loads(data)
         except Exception as error:
             LOGGER.error('JSON decoding error: %r', error)
             return list()
@@ -328,10 +327,22 @@ class RabbitMQ(base.Plugin):
     def fetch_channel_data(self):
         """Return the channel data from the RabbitMQ server
 
-        :rtype: list
+        :rtype: iter
 
         """
-        return self.fetch_data('channels')
+        return self.fetch_items('channels', self.CHANNEL_COLUMNS)
+
+    def fetch_items(self, data_type, columns):
+        """Return an iterator over the items of a paginated list, processing
+        one batch of pages at a time.
+
+        :param str data_type: The type of data to query
+        :param list columns: The columns to ask for
+        :rtype: iter
+
+        """
+        return (item for page in self.fetch_pages(data_type, columns)
+                for item in page)
 
     def fetch_node_data(self):
         """Return the node data from the RabbitMQ server
@@ -339,40 +350,134 @@ class RabbitMQ(base.Plugin):
         :rtype: list
 
         """
-        return self.fetch_data('nodes')
+        return self.fetch_data('nodes', self.NODE_COLUMNS)
+
+    def fetch_totals(self, node_data):
+        """Return the channel and queue totals of each node and the values
+        of each queue, reducing the channels and queues a page at a time as
+        they are fetched. The values of the queues are only collected into
+        a list when they are shared with the other instances of the cluster,
+        otherwise they are reduced as add_queue_datapoints iterates over
+        them.
+
+        :param list node_data: all of the nodes
+        :rtype: tuple
+
+        """
+        nodes = self.node_totals(node_data)
+        self.add_channel_totals(nodes, self.fetch_channel_data())
+        queues = self.queue_values(self.count_node_queues(
+            nodes, self.fetch_queue_data()))
+        if self.config.get('cluster'):
+            queues = list(queues)
+        return nodes, queues
+
+    def fetch_pages(self, data_type, columns):
+        """Yield the pages of a list from the management API, page_size
+        items at a time. After the first page, up to page_concurrency pages
+        are fetched at once, so only those pages are held in memory. Brokers
+        without pagination, before RabbitMQ 3.6, return a single page.
+
+        :param str data_type: The type of data to query
+        :param list columns: The columns to ask for
+        :rtype: iter
+
+        """
+        page_size = self.config.get('page_size', self.DEFAULT_PAGE_SIZE)
+        if not page_size:
+            yield self.fetch_data(data_type, columns)
+            return
+        params = {'page_size': page_size, 'sort': 'name'}
+        first = self.fetch_data(data_type, columns, dict(params, page=1))
+        if not isinstance(first, dict):
+            yield first
+            return
+        yield first.get('items', list())
+        concurrency = self.config.get('page_concurrency',
+                                      self.config.get(
+                                          'pool_size',
+                                          connections.HTTP_POOL_SIZE))
+        last_page = first.get('page_count', 1)
+        for start in range(2, last_page + 1, concurrency):
+            pages = base.concurrently(dict(
+                (page, functools.partial(self.fetch_data, data_type, columns,
+                                         dict(params, page=page)))
+                for page in range(start, min(start + concurrency,
+                                             last_page + 1))))
+            for page in sorted(pages):
+                if isinstance(pages[page], dict):
+                    yield pages[page].get('items', list())
 
     def fetch_queue_data(self):
         """Return the queue data from the RabbitMQ server
 
-        :rtype: list
+        :rtype: iter
+
+        """
+        return self.fetch_items('queues', self.QUEUE_COLUMNS)
+
+    def node_totals(self, node_data):
+        """Return empty channel and queue totals for each node, keyed by the
+        full node name the channels and queues refer to.
+
+        :param list node_data: all of the nodes
+        :rtype: dict
 
         """
-        return self.fetch_data('queues')
+        return dict((node['name'], {'active_consumers': 0,
+                                    'blocked': 0,
+                                    'channels': 0,
+                                    'consumers': 0,
+                                    'messages': dict(self.DUMMY_STATS),
+                                    'messages_ready': 0,
+                                    'messages_unacknowledged': 0,
+                                    'queues': 0})
+                    for node in node_data)
 
     def poll(self):
         """Poll the RabbitMQ server"""
         LOGGER.info('Polling RabbitMQ via %s', self.rabbitmq_base_url)
         start_time = time.time()
 
-        self.requests_session = requests.Session()
-
         # Initialize the values each iteration
-        self.derive = dict()
-        self.gauge = dict()
-        self.rate = dict()
+        self.initialize()
         self.consumers = 0
+        if not self.cluster_leader:
+            return
 
-        # Fetch the data from RabbitMQ
-        channel_data = self.fetch_channel_data()
-        node_data = self.fetch_node_data()
-        queue_data = self.fetch_queue_data()
+        # Fetch the data from RabbitMQ, sharing the nodes and the totals
+        # reduced from the channels and queues between the instances of the
+        # same cluster
+        node_data = self.cluster_fetch('nodes', self.fetch_node_data)
+        nodes, queues = self.cluster_fetch(
+            'totals', functools.partial(self.fetch_totals, node_data))
+        self.add_queue_datapoints(queues)
 
         # Create all of the metrics
-        self.add_queue_datapoints(queue_data)
-        self.add_node_datapoints(node_data, queue_data, channel_data)
+        self.add_node_datapoints(node_data, nodes)
         LOGGER.info('Polling complete in %.2f seconds',
                     time.time() - start_time)
 
+    def queue_values(self, queue_data):
+        """Reduce each queue to the values that are reported for it, its
+        vhost, name, consumers, ready and unacknowledged messages and the
+        message stats in QUEUE_MESSAGES, skipping auto-named queues.
+
+        :param iter queue_data: all of the queues
+        :rtype: iter
+
+        """
+        for queue in queue_data:
+            if queue['name'][0:6] == 'amq.gen':
+                LOGGER.debug('Skipping auto-named queue: %s', queue['name'])
+                continue
+            stats = queue.get('message_stats') or self.DUMMY_STATS
+            yield (queue['vhost'], queue['name'], queue.get('consumers', 0),
+                   queue.get('messages_ready', 0),
+                   queue.get('messages_unacknowledged', 0),
+                   tuple(stats.get(key, 0)
+                         for _metric, key in self.QUEUE_MESSAGES))
+
     @property
     def rabbitmq_base_url(self):
         """Return the fully composed RabbitMQ base URL
@@ -388,3 +493,18 @@ class RabbitMQ(base.Plugin):
 
         return '{scheme}://{host}:{port}{api_path}'.format(
             scheme=scheme, host=host, port=port, api_path=api_path)
+
+    @property
+    def session(self):
+        """Return the agent-wide HTTP session for the RabbitMQ management
+        API and user, so connections are kept alive and reused across poll
+        intervals.
+
+        :rtype: requests.Session
+
+        """
+        parsed = urlparse.urlparse(self.rabbitmq_base_url)
+        return connections.http_session(
+            (parsed.scheme, parsed.netloc,
+             self.config.get('username', self.DEFAULT_USER)),
+            self.config.get('pool_size', connections.HTTP_POOL_SIZE))
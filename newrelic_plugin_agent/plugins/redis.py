@@ -3,17 +3,93 @@ Redis plugin polls Redis for stats
 
 """
 import logging
+import re
 
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
 
 
+class RedisError(str):
+    """An error reply from Redis"""
+    pass
+
+
 class Redis(base.SocketStatsPlugin):
 
     GUID = 'com.meetme.newrelic_redis_agent'
 
     DEFAULT_PORT = 6379
+    ENTITIES = {'Commands/*': 'Calls[calls]', 'DB/*': 'Keys[keys]'}
+
+    # The INFO fields used by add_datapoints and how to convert them
+    INFO_FIELDS = {'blocked_clients': int,
+                   'connected_clients': int,
+                   'connected_slaves': int,
+                   'evicted_keys': int,
+                   'expired_keys': int,
+                   'keyspace_hits': int,
+                   'keyspace_misses': int,
+                   'master_last_io_seconds_ago': int,
+                   'master_repl_offset': int,
+                   'mem_fragmentation_ratio': float,
+                   'pubsub_commands': int,
+                   'pubsub_patterns': int,
+                   'rdb_changes_since_last_save': int,
+                   'rdb_last_bgsave_time_sec': int,
+                   'slave_repl_offset': int,
+                   'total_commands_processed': int,
+                   'total_connections_received': int,
+                   'used_cpu_sys': float,
+                   'used_cpu_sys_childrens': float,
+                   'used_cpu_user': float,
+                   'used_cpu_user_childrens': float,
+                   'used_memory': int,
+                   'used_memory_peak': int}
+
+    # The INFO sections that contain the fields
+    INFO_SECTIONS = ['clients', 'cpu', 'keyspace', 'memory', 'persistence',
+                     'replication', 'stats']
+
+    # Optional commands that can be enabled with the collect setting
+    COLLECT = {'commandstats': ('INFO', 'commandstats'),
+               'latency': ('LATENCY', 'LATEST'),
+               'maxmemory': ('CONFIG', 'GET', 'maxmemory'),
+               'memory_stats': ('MEMORY', 'STATS'),
+               'slowlog': ('SLOWLOG', 'LEN')}
+
+    # The MEMORY STATS fields that are reported
+    MEMORY_STATS = {'aof.buffer': ('Memory/AOF Buffer', 'bytes'),
+                    'clients.normal': ('Memory/Clients/Normal', 'bytes'),
+                    'clients.slaves': ('Memory/Clients/Slaves', 'bytes'),
+                    'dataset.bytes': ('Memory/Dataset', 'bytes'),
+                    'keys.bytes-per-key': ('Memory/Bytes Per Key', 'bytes'),
+                    'overhead.total': ('Memory/Overhead', 'bytes'),
+                    'peak.allocated': ('Memory/Peak Allocated', 'bytes'),
+                    'replication.backlog': ('Memory/Replication Backlog',
+                                            'bytes'),
+                    'startup.allocated': ('Memory/Startup Allocated',
+                                          'bytes'),
+                    'total.allocated': ('Memory/Allocated', 'bytes')}
+
+    COMMANDSTAT_LINE = re.compile(r'^cmdstat_([^:\r\n]+):'
+                                  r'calls=(\d+),usec=(\d+)', re.M)
+    INFO_LINE = re.compile(r'^(%s|db\d+|slave\d+):([^\r\n]*)\r\n' %
+                           '|'.join(sorted(INFO_FIELDS)), re.M)
+    KEYSPACE_VALUE = re.compile(r'(\w+)=(\d+)')
+    REPLICA_VALUE = re.compile(r'(\w+)=([^,]*)')
+    REPLICATION_LINE = re.compile(r'^(role|master_host|master_port|slave\d+):'
+                                  r'([^\r\n]*)\r\n', re.M)
+    REPLY_HEADER = re.compile(r'([-+:$*])([^\r\n]*)\r\n')
+
+    DISCOVERY_TTL = 300
+    SENTINEL_DOWN_FLAGS = set(['disconnected', 'o_down', 's_down'])
+
+    def __init__(self, config, poll_interval, last_interval_values=None):
+        super(Redis, self).__init__(config, poll_interval,
+                                    last_interval_values)
+        self.pipeline = list()
+        self.queries = None
 
     def add_datapoints(self, stats):
         """Add all of the data points for a node
@@ -32,10 +108,12 @@ class Redis(base.SocketStatsPlugin):
 
         # must happen before saving the new values
         # but only if we have the previous values
-        if ('Keys/Hit' in self.derive_last_interval.keys() and
-                'Keys/Missed' in self.derive_last_interval.keys()):
-            prev_hits = self.derive_last_interval['Keys/Hit']
-            prev_misses = self.derive_last_interval['Keys/Missed']
+        hit_metric = self.metric_name('Keys Hit', 'keys')
+        missed_metric = self.metric_name('Keys Missed', 'keys')
+        if (hit_metric in self.derive_last_interval and
+                missed_metric in self.derive_last_interval):
+            prev_hits = self.derive_last_interval[hit_metric]
+            prev_misses = self.derive_last_interval[missed_metric]
 
             # hits and misses since the last measure
             hits = stats.get('keyspace_hits', 0) - prev_hits
@@ -101,70 +179,433 @@ class Redis(base.SocketStatsPlugin):
         self.add_gauge_value('Keys/Total', 'keys', keys)
         self.add_gauge_value('Keys/Will Expire', 'keys', expires)
 
-    def connect(self):
-        """Top level interface to create a socket and connect it to the
-        redis daemon.
+        if 'master_repl_offset' in stats:
+            self.add_gauge_value('Replication/Offset', 'bytes',
+                                 stats['master_repl_offset'])
+            for replica in stats.get('replicas', list()):
+                self.add_replica_datapoints(stats['master_repl_offset'],
+                                            replica)
+        elif 'slave_repl_offset' in stats:
+            self.add_gauge_value('Replication/Offset', 'bytes',
+                                 stats['slave_repl_offset'])
+
+        if 'commandstats' in stats:
+            self.add_command_datapoints(stats['commandstats'])
+        for event, latest, maximum in stats.get('latency', list()):
+            self.add_gauge_value('Latency/%s/Latest' % event, 'milliseconds',
+                                 latest)
+            self.add_gauge_value('Latency/%s/Max' % event, 'milliseconds',
+                                 maximum)
+        if 'maxmemory' in stats:
+            self.add_gauge_value('Memory/Max', 'bytes', stats['maxmemory'])
+            if stats['maxmemory']:
+                self.add_gauge_value('Memory/Utilization', 'percent',
+                                     100.0 * stats.get('used_memory', 0) /
+                                     stats['maxmemory'])
+        for key, value in stats.get('memory_stats', dict()).items():
+            self.add_gauge_value(self.MEMORY_STATS[key][0],
+                                 self.MEMORY_STATS[key][1], value)
+        if 'slowlog' in stats:
+            self.add_gauge_value('Slowlog/Length', 'entries',
+                                 stats['slowlog'])
+
+    def add_command_datapoints(self, commands):
+        """Add the call rate, time spent and the average latency over the
+        interval for each command in INFO commandstats.
+
+        :param dict commands: The calls and usec for each command
+
+        """
+        for command, (calls, usec) in commands.items():
+            name = 'Commands/%s' % command
+
+            # Must happen before the derive values are saved
+            last_calls = self.derive_last_interval.get(
+                self.metric_name('%s/Calls' % name, 'calls'))
+            last_usec = self.derive_last_interval.get(
+                self.metric_name('%s/Time' % name, 'microseconds'))
+            if last_calls is not None and last_usec is not None:
+                if calls > last_calls:
+                    self.add_gauge_value('%s/Latency' % name, 'microseconds',
+                                         float(usec - last_usec) /
+                                         (calls - last_calls))
+
+            self.add_derive_value('%s/Calls' % name, 'calls', calls)
+            self.add_derive_value('%s/Time' % name, 'microseconds', usec)
+
+    def add_replica_datapoints(self, offset, replica):
+        """Add the replication lag of a replica connected to the master
 
-        :rtype: socket
+        :param int offset: The master replication offset
+        :param dict replica: The replica's fields from INFO replication
 
         """
-        connection = super(Redis, self).connect()
-        if connection and self.config.get('password'):
-            connection.send("*2\r\n$4\r\nAUTH\r\n$%i\r\n%s\r\n" %
-                            (len(self.config['password']),
-                             self.config['password']))
-            buffer_value = connection.recv(self.SOCKET_RECV_MAX)
-            if buffer_value == '+OK\r\n':
-                return connection
-            LOGGER.error('Authentication error: %s', buffer_value[4:].strip())
-            return None
-        return connection
+        name = 'Replication/Replicas/%s:%s' % (replica.get('ip'),
+                                               replica.get('port'))
+        try:
+            self.add_gauge_value('%s/Offset Lag' % name, 'bytes',
+                                 offset - int(replica.get('offset', offset)))
+            self.add_gauge_value('%s/Lag' % name, 'seconds',
+                                 int(replica.get('lag', 0)))
+        except ValueError:
+            LOGGER.debug('Could not parse replica values: %r', replica)
+
+    @staticmethod
+    def command(*args):
+        """Return the command encoded in the RESP protocol
+
+        :param list args: The command name and arguments
+        :rtype: str
+
+        """
+        return '*%i\r\n%s' % (len(args),
+                               ''.join(['$%i\r\n%s\r\n' % (len(str(arg)), arg)
+                                        for arg in args]))
+
+    @classmethod
+    def discover(cls, config):
+        """Return the configs of the master and replicas that are replicating
+        with the configured node, or that the Sentinel at the configured
+        address monitors if sentinel_master is set. The topology is cached
+        for discovery_ttl seconds. If it can not be discovered, the last
+        known topology is used, falling back to the configured node.
 
-    def fetch_data(self, connection):
-        """Loop in and read in all the data until we have received it all.
+        :param dict config: The configured instance
+        :rtype: list
 
-        :param  socket connection: The connection
+        """
+        if config.get('sentinel_master'):
+            sentinel = cls(dict(config,
+                                password=config.get('sentinel_password')), 0)
+            discover = sentinel.sentinel_members
+        else:
+            discover = cls(config, 0).replication_members
+        members = base.discovered((cls.__name__, config.get('path'),
+                                   config.get('host', cls.DEFAULT_HOST),
+                                   config.get('port', cls.DEFAULT_PORT),
+                                   config.get('sentinel_master')),
+                                  config.get('discovery_ttl',
+                                             cls.DISCOVERY_TTL),
+                                  discover)
+        return [cls.member_config(config, member)
+                for member in members or [dict()]]
+
+    @classmethod
+    def member_config(cls, config, address):
+        """Return the config for polling a discovered member
+
+        :param dict config: The configured instance
+        :param dict address: The host and port of the member, empty for the
+            configured node itself
         :rtype: dict
 
         """
-        connection.send("*0\r\ninfo\r\n")
+        member = dict((key, value) for key, value in config.items()
+                      if key not in ('discover', 'discovery_ttl',
+                                     'sentinel_master', 'sentinel_password'))
+        if address:
+            member.pop('path', None)
+            member.update(address)
+        member['name'] = '%s/%s' % (
+            config.get('name', 'unnamed'),
+            member.get('path') or '%s:%s' % (member.get('host',
+                                                        cls.DEFAULT_HOST),
+                                             member.get('port',
+                                                        cls.DEFAULT_PORT)))
+        return member
+
+    def parse_collected(self, name, reply, values):
+        """Add the reply to one of the optional collect commands to values
+
+        :param str name: The name of the collect command
+        :param mixed reply: The decoded reply
+        :param dict values: The values to add the reply to
 
-        # Read in the first line $1437
-        buffer_value = connection.recv(self.SOCKET_RECV_MAX)
-        lines = buffer_value.split('\r\n')
+        """
+        if name == 'latency':
+            values[name] = [(event, latest, maximum) for
+                            event, _timestamp, latest, maximum in reply]
+        elif name == 'maxmemory':
+            values[name] = int(reply[1])
+        elif name == 'memory_stats':
+            values[name] = dict((key, float(value)) for key, value in
+                                zip(reply[::2], reply[1::2])
+                                if key in self.MEMORY_STATS)
+        elif name == 'slowlog':
+            values[name] = reply
+
+    def parse_commandstats(self, data, start, end):
+        """Parse the calls and usec of each command out of the INFO
+        commandstats reply between start and end in a single pass.
+
+        :param buffer data: The complete reply
+        :param int start: The start of the INFO bulk string
+        :param int end: The end of the INFO bulk string
+        :rtype: dict
 
-        if lines[0][0] == '$':
-            byte_size = int(lines[0][1:].strip())
-        else:
-            return None
+        """
+        return dict((command, (int(calls), int(usec))) for
+                    command, calls, usec in
+                    self.COMMANDSTAT_LINE.findall(data, start, end))
 
-        while len(buffer_value) < byte_size:
-            buffer_value += connection.recv(self.SOCKET_RECV_MAX)
+    def parse_info(self, data, start, end, values):
+        """Parse the fields used by the plugin out of the INFO reply between
+        start and end in a single pass, skipping all of the other fields.
 
-        lines = buffer_value.split('\r\n')
+        :param buffer data: The complete reply
+        :param int start: The start of the INFO bulk string
+        :param int end: The end of the INFO bulk string
+        :param dict values: The values to add the fields to
+
+        """
+        for line in self.INFO_LINE.finditer(data, start, end):
+            key, value = line.groups()
+            if key[:2] == 'db':
+                values[key] = dict((name, int(count)) for name, count in
+                                   self.KEYSPACE_VALUE.findall(value))
+                continue
+            if key[:5] == 'slave' and key[5:].isdigit():
+                values.setdefault('replicas', list()).append(
+                    dict(self.REPLICA_VALUE.findall(value)))
+                continue
+            try:
+                values[key] = self.INFO_FIELDS[key](value)
+            except ValueError:
+                LOGGER.debug('Could not parse %s value: %r', key, value)
+
+    def parse_replication(self, data):
+        """Parse the role, master address and replicas from INFO replication
+
+        :param str data: The INFO replication bulk string
+        :rtype: dict
+
+        """
         values = dict()
-        for line in lines:
-            if ':' in line:
-                key, value = line.strip().split(':')
-                if key[:2] == 'db':
-                    values[key] = dict()
-                    subvalues = value.split(',')
-                    for temp in subvalues:
-                        subvalue = temp.split('=')
-                        value = subvalue[-1]
-                        try:
-                            values[key][subvalue[0]] = int(value)
-                        except ValueError:
-                            try:
-                                values[key][subvalue[0]] = float(value)
-                            except ValueError:
-                                values[key][subvalue[0]] = value
-                    continue
-                try:
-                    values[key] = int(value)
-                except ValueError:
-                    try:
-                        values[key] = float(value)
-                    except ValueError:
-                        values[key] = value
+        for key, value in self.REPLICATION_LINE.findall(data):
+            if key[:5] == 'slave':
+                values.setdefault('replicas', list()).append(
+                    dict(self.REPLICA_VALUE.findall(value)))
+            else:
+                values[key] = value
         return values
+
+    def parse_reply(self, data):
+        """Parse the replies to the pipelined commands. INFO replies are
+        scanned in place instead of being copied and split, the reply to AUTH
+        is skipped and the replies to the optional collect commands are
+        decoded. An error in reply to one of the collect commands, such as
+        an unsupported command on an older server, only skips that command.
+
+        :param buffer data: The complete reply
+        :rtype: dict
+
+        """
+        values, replies = dict(), list()
+        offset = 0
+        try:
+            for name in self.pipeline:
+                if name in ('info', 'commandstats'):
+                    match = self.REPLY_HEADER.match(data, offset)
+                    if match and match.group(1) == '$':
+                        offset = match.end()
+                        end = offset + max(int(match.group(2)), 0)
+                        if name == 'info':
+                            self.parse_info(data, offset, end, values)
+                        else:
+                            values[name] = self.parse_commandstats(data,
+                                                                   offset,
+                                                                   end)
+                        offset = end + 2
+                        continue
+                reply, offset = self.read_reply(data, offset)
+                if isinstance(reply, RedisError):
+                    if name in ('auth', 'info'):
+                        LOGGER.error('Error response from Redis: %s', reply)
+                        return None
+                    LOGGER.warning('Error response to %s from Redis: %s',
+                                   name, reply)
+                elif name == 'query':
+                    replies.append(reply)
+                elif name in self.COLLECT:
+                    self.parse_collected(name, reply, values)
+        except (IndexError, TypeError, ValueError) as error:
+            LOGGER.error('Unexpected response from Redis: %s', error)
+            return None
+        return replies if self.queries else values
+
+    def query(self, commands):
+        """Send the commands in one pipelined write, returning their decoded
+        replies or None on error.
+
+        :param list commands: The commands, each a tuple of its arguments
+        :rtype: list
+
+        """
+        self.queries = commands
+        try:
+            return self.fetch()
+        finally:
+            self.queries = None
+
+    def read_reply(self, data, offset):
+        """Decode the reply starting at offset, returning it along with the
+        offset of the next reply. Errors are returned as RedisError instances
+        instead of being raised so the rest of the pipeline can be read.
+
+        :param buffer data: The complete reply
+        :param int offset: Where the reply starts
+        :rtype: tuple
+        :raises: ValueError
+
+        """
+        match = self.REPLY_HEADER.match(data, offset)
+        if not match:
+            raise ValueError('%r' % data[offset:offset + 64])
+        kind, value = match.groups()
+        offset = match.end()
+        if kind == '$':
+            size = int(value)
+            if size < 0:
+                return None, offset
+            return data[offset:offset + size], offset + size + 2
+        if kind == '*':
+            items = list()
+            for _item in range(int(value)):
+                item, offset = self.read_reply(data, offset)
+                items.append(item)
+            return items, offset
+        if kind == ':':
+            return int(value), offset
+        if kind == '-':
+            return RedisError(value), offset
+        return value, offset
+
+    def replication_members(self):
+        """Return the addresses of the master and its replicas from INFO
+        replication, following a replica to its master.
+
+        :rtype: list
+
+        """
+        replies = self.query([('INFO', 'replication')])
+        if not replies or isinstance(replies[0], RedisError):
+            return None
+        info = self.parse_replication(replies[0])
+        if info.get('role') == 'slave' and info.get('master_host'):
+            master = {'host': info['master_host'],
+                      'port': int(info.get('master_port', self.DEFAULT_PORT))}
+            replies = self.__class__(self.member_config(self.config, master),
+                                     0).query([('INFO', 'replication')])
+            if not replies or isinstance(replies[0], RedisError):
+                return None
+            info = self.parse_replication(replies[0])
+            members = [master]
+        else:
+            members = [dict()]
+        for replica in info.get('replicas', list()):
+            members.append({'host': replica['ip'],
+                            'port': int(replica['port'])})
+        return members
+
+    def reply_complete(self, data, closed):
+        """Return True once the replies to all of the commands, including
+        the trailing CRLF of the last one, have been received so nothing is
+        left on the connection for the next poll.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer data: The
+            data received so far
+        :param bool closed: If the remote end closed the connection
+        :rtype: bool
+
+        """
+        offset = 0
+        for _reply in self.pipeline:
+            offset = self.reply_end(data, offset)
+            if offset == -1:
+                return False
+        return True
+
+    @classmethod
+    def reply_end(cls, data, offset):
+        """Return the end of the reply starting at offset, or -1 if it has not
+        been completely received yet.
+
+        :param newrelic_plugin_agent.connections.ReceiveBuffer data: The
+            data received so far
+        :param int offset: Where the reply starts
+        :rtype: int
+
+        """
+        if len(data) <= offset:
+            return -1
+        if data.startswith('$', offset):
+            return data.bulk_end(offset)
+        end = data.find('\r\n', offset)
+        if end == -1:
+            return -1
+        if data.startswith('*', offset):
+            count = int(str(data.view(offset + 1, end)))
+            offset = end + 2
+            for _item in range(count):
+                offset = cls.reply_end(data, offset)
+                if offset == -1:
+                    return -1
+            return offset
+        return end + 2
+
+    def request(self, reused):
+        """Return an INFO command for each of the sections the plugin uses
+        and any of the optional commands enabled with the collect setting, or
+        the commands passed to query, preceded by AUTH on a new connection to
+        a password protected server. The commands are pipelined in a single
+        write and the name of each is kept so the replies can be matched up
+        with them.
+
+        :param bool reused: If the connection was reused from the pool
+        :rtype: str
+
+        """
+        if self.queries:
+            commands = [self.command(*query) for query in self.queries]
+            self.pipeline = ['query'] * len(commands)
+        else:
+            commands = [self.command('INFO', section) for section in
+                        self.config.get('info_sections', self.INFO_SECTIONS)]
+            if not commands:
+                commands.append(self.command('INFO'))
+            self.pipeline = ['info'] * len(commands)
+            for name in self.config.get('collect', list()):
+                if name not in self.COLLECT:
+                    LOGGER.warning('Unsupported Redis collect command: %s',
+                                   name)
+                    continue
+                commands.append(self.command(*self.COLLECT[name]))
+                self.pipeline.append(name)
+        if self.config.get('password') and not reused:
+            commands.insert(0, self.command('AUTH', self.config['password']))
+            self.pipeline.insert(0, 'auth')
+        return ''.join(commands)
+
+    def sentinel_members(self):
+        """Return the addresses of the master and the replicas that are not
+        down from the Sentinel at the configured address.
+
+        :rtype: list
+
+        """
+        master = self.config['sentinel_master']
+        replies = self.query([('SENTINEL', 'get-master-addr-by-name', master),
+                              ('SENTINEL', 'slaves', master)])
+        if (not replies or isinstance(replies[0], RedisError) or
+                not replies[0]):
+            LOGGER.error('Sentinel does not know about master %s', master)
+            return None
+        members = [{'host': replies[0][0], 'port': int(replies[0][1])}]
+        if isinstance(replies[1], list):
+            for replica in replies[1]:
+                fields = dict(zip(replica[::2], replica[1::2]))
+                flags = set(fields.get('flags', '').split(','))
+                if not flags & self.SENTINEL_DOWN_FLAGS:
+                    members.append({'host': fields['ip'],
+                                    'port': int(fields['port'])})
+        return members
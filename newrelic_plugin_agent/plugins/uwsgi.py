@@ -2,10 +2,13 @@
 uWSGI
 
 """
-import json
 import logging
+import os
+from os import path
 import re
 
+from newrelic_plugin_agent import statistics
+from newrelic_plugin_agent import streaming
 from newrelic_plugin_agent.plugins import base
 
 LOGGER = logging.getLogger(__name__)
@@ -17,6 +20,38 @@ class uWSGI(base.SocketStatsPlugin):
 
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 1717
+    DISCOVERY_TTL = 60
+    PERSISTENT = False
+    ENTITIES = {'Worker/*': 'Requests[requests]'}
+
+    # The metrics of each vassal that are added up for the fleet summary
+    FLEET_METRICS = re.compile(r'^Component/(?:Summary/|Listen Queue)')
+
+    # The stats option in a vassal ini or yaml config file
+    STATS_OPTION = re.compile(r'^\s*stats\s*[=:]\s*(\S+)', re.M)
+    VASSAL_EXTENSIONS = ('.ini', '.yaml', '.yml')
+
+    # The fields of the stats dump used by add_datapoints, everything else,
+    # including the per core request vars, is skipped without decoding it
+    WORKER_FIELDS = {'apps': None,
+                     'avg_rt': None,
+                     'exceptions': None,
+                     'harakiri_count': None,
+                     'id': None,
+                     'requests': None,
+                     'respawn_count': None,
+                     'rss': None,
+                     'signals': None}
+    FIELDS = {'listen_queue': None,
+              'listen_queue_errors': None,
+              'locks': None,
+              'workers': WORKER_FIELDS}
+
+    def __init__(self, config, poll_interval, last_interval_values=None):
+        super(uWSGI, self).__init__(config, poll_interval,
+                                    last_interval_values)
+        self.memory = None
+        self.response_times = None
 
     def add_datapoints(self, stats):
         """Add all of the data points for a node
@@ -40,28 +75,22 @@ class uWSGI(base.SocketStatsPlugin):
         signals = 0
 
         apps = dict()
+        self.response_times = statistics.QuantileSketch()
+        self.memory = statistics.QuantileSketch()
+        worker_metrics = self.config.get('worker_metrics', True)
 
         for worker in stats.get('workers', list()):
-            id = worker['id']
-
             # totals
             exceptions += worker.get('exceptions', 0)
             harakiris += worker.get('harakiri_count', 0)
             requests += worker.get('requests', 0)
             respawns += worker.get('respawn_count', 0)
             signals += worker.get('signals', 0)
+            self.response_times.add(worker.get('avg_rt', 0))
+            self.memory.add(worker.get('rss', 0))
 
-            # Add the per worker
-            self.add_derive_value('Worker/%s/Exceptions' % id, 'exceptions',
-                                  worker.get('exceptions', 0))
-            self.add_derive_value('Worker/%s/Harakiri' % id, 'harakiris',
-                                  worker.get('harakiri_count', 0))
-            self.add_derive_value('Worker/%s/Requests' % id, 'requests',
-                                  worker.get('requests', 0))
-            self.add_derive_value('Worker/%s/Respawns' % id, 'respawns',
-                                  worker.get('respawn_count', 0))
-            self.add_derive_value('Worker/%s/Signals' % id, 'signals',
-                                  worker.get('signals', 0))
+            if worker_metrics:
+                self.add_worker_datapoints(worker)
 
             for app in worker['apps']:
                 if app['id'] not in apps:
@@ -86,16 +115,163 @@ class uWSGI(base.SocketStatsPlugin):
         self.add_derive_value('Summary/Workers', 'workers',
                               len(stats.get('workers', ())))
 
-    def fetch_data(self, connection):
-        """Read the data from the socket
+        self.add_distribution_values('Workers/Response Time', 'us',
+                                     self.response_times)
+        self.add_distribution_values('Workers/Memory', 'bytes', self.memory)
+
+    def add_worker_datapoints(self, worker):
+        """Add the per-worker data points
 
-        :param  socket connection: The connection
+        :param dict worker: The worker stats
+
+        """
+        id = worker['id']
+        self.add_derive_value('Worker/%s/Exceptions' % id, 'exceptions',
+                              worker.get('exceptions', 0))
+        self.add_derive_value('Worker/%s/Harakiri' % id, 'harakiris',
+                              worker.get('harakiri_count', 0))
+        self.add_derive_value('Worker/%s/Requests' % id, 'requests',
+                              worker.get('requests', 0))
+        self.add_derive_value('Worker/%s/Respawns' % id, 'respawns',
+                              worker.get('respawn_count', 0))
+        self.add_derive_value('Worker/%s/Signals' % id, 'signals',
+                              worker.get('signals', 0))
+
+    @classmethod
+    def discover(cls, config):
+        """Return the configs of the stats sockets matching the glob in path,
+        or of the vassals in the Emperor vassals directory, rescanning them
+        every discovery_ttl seconds.
+
+        :param dict config: The configured instance
+        :rtype: list
+
+        """
+        if config.get('vassals'):
+            discover = lambda: cls.vassal_sockets(config['vassals'])
+        else:
+            discover = lambda: cls.glob_sockets(config.get('path', ''))
+        members = base.discovered((cls.__name__, config.get('vassals'),
+                                   config.get('path')),
+                                  config.get('discovery_ttl',
+                                             cls.DISCOVERY_TTL),
+                                  discover)
+        if not members:
+            LOGGER.error('No uWSGI stats sockets found for %s',
+                         config.get('name', 'unnamed'))
+            return list()
+        configs = list()
+        for name, address in members:
+            member = dict((key, value) for key, value in config.items()
+                          if key not in ('discover', 'discovery_ttl', 'host',
+                                         'path', 'port', 'vassals'))
+            member.update(address)
+            member['name'] = '%s/%s' % (config.get('name', 'unnamed'), name)
+            configs.append(member)
+        return configs
+
+    @classmethod
+    def summarize(cls, config, instances, poll_interval):
+        """Return a plugin instance reporting the fleet wide totals of all of
+        the vassals, with the worker response time and memory distributions
+        of every vassal merged together.
+
+        :param dict config: The configured instance
+        :param list instances: The polled plugin instances
+        :param int poll_interval: How often the plugin is invoked
+        :rtype: uWSGI
+
+        """
+        summary = cls(config, poll_interval)
+        summary.initialize()
+        response_times = statistics.QuantileSketch()
+        memory = statistics.QuantileSketch()
+        responding = 0
+        totals = dict()
+        for instance in instances:
+            if instance.response_times is None:
+                continue
+            responding += 1
+            for source, values in ((instance.derive_values,
+                                    summary.derive_values),
+                                   (instance.gauge_values,
+                                    summary.gauge_values)):
+                for metric, payload in source.items():
+                    if cls.FLEET_METRICS.match(metric):
+                        totals[metric] = (totals.get(metric, 0) +
+                                          payload['total'])
+                        values[metric] = summary.metric_payload(
+                            totals[metric])
+            response_times.merge(instance.response_times)
+            memory.merge(instance.memory)
+        summary.add_gauge_value('Fleet/Vassals', 'vassals', len(instances))
+        summary.add_gauge_value('Fleet/Vassals/Responding', 'vassals',
+                                responding)
+        summary.add_distribution_values('Workers/Response Time', 'us',
+                                        response_times)
+        summary.add_distribution_values('Workers/Memory', 'bytes', memory)
+        return summary
+
+    @classmethod
+    def vassal_sockets(cls, directory):
+        """Return the name and stats socket address of each vassal with a
+        stats option in its ini or yaml config file in the vassals directory.
+        The %n magic variable is replaced with the vassal name and vassals
+        using other magic variables are skipped.
+
+        :param str directory: The Emperor vassals directory
+        :rtype: list
+
+        """
+        try:
+            filenames = sorted(os.listdir(directory))
+        except OSError as error:
+            LOGGER.error('Could not read vassals directory %s: %s',
+                         directory, error)
+            return None
+        sockets = list()
+        for filename in filenames:
+            name, extension = path.splitext(filename)
+            if extension not in cls.VASSAL_EXTENSIONS:
+                continue
+            try:
+                with open(path.join(directory, filename)) as handle:
+                    match = cls.STATS_OPTION.search(handle.read())
+            except IOError as error:
+                LOGGER.warning('Could not read vassal %s: %s', filename, error)
+                continue
+            if not match:
+                continue
+            address = match.group(1).strip('\'"').replace('%n', name)
+            if '%' in address:
+                LOGGER.debug('Skipping vassal %s stats address %s', name,
+                             address)
+            elif address.startswith('/'):
+                sockets.append((name, {'path': address}))
+            else:
+                host, _sep, port = address.rpartition(':')
+                try:
+                    port = int(port)
+                except ValueError:
+                    LOGGER.warning('Skipping vassal %s with invalid stats '
+                                   'address %s', name, address)
+                    continue
+                sockets.append((name, {'host': host or cls.DEFAULT_HOST,
+                                       'port': port}))
+        return sockets
+
+    def parse_reply(self, data):
+        """Select the fields used by add_datapoints from the JSON stats dump
+        read from the socket in a single streaming pass over the reply.
+
+        :param buffer data: The stats dump
         :return: dict
 
         """
-        data = super(uWSGI, self).fetch_data(connection, read_till_empty=True)
         if data:
-            data = re.sub(r'"HTTP_COOKIE=[^"]*"', '""', data)
-            return json.loads(data)
+            try:
+                return streaming.select(data, self.FIELDS)
+            except ValueError as error:
+                LOGGER.error('Error parsing uWSGI stats: %s', error)
+                return None
         return {}
-
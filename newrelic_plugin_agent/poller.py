@@ -0,0 +1,283 @@
+"""
+Multiplexed polling of socket based plugin instances, connecting to all of
+the targets in parallel and collecting their replies from a single thread.
+
+"""
+import errno
+import logging
+import select
+import socket
+import time
+
+from newrelic_plugin_agent import connections
+
+LOGGER = logging.getLogger(__name__)
+
+CONNECTING, WRITING, READING = range(3)
+
+
+class Selector(object):
+    """Minimal wrapper around epoll, falling back to poll, that waits for
+    sockets to become readable or writable.
+
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.read, self.write = select.EPOLLIN, select.EPOLLOUT
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.read, self.write = select.POLLIN, select.POLLOUT
+            self.scale = 1000
+
+    def close(self):
+        """Release the underlying poller"""
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
+
+    def modify(self, fd, writable):
+        """Change the events waited for on the file descriptor
+
+        :param int fd: The file descriptor
+        :param bool writable: Wait for writability instead of readability
+
+        """
+        self.poller.modify(fd, self.write if writable else self.read)
+
+    def register(self, fd, writable):
+        """Start waiting for events on the file descriptor
+
+        :param int fd: The file descriptor
+        :param bool writable: Wait for writability instead of readability
+
+        """
+        self.poller.register(fd, self.write if writable else self.read)
+
+    def select(self, timeout):
+        """Wait up to timeout seconds, returning the file descriptors with
+        events pending.
+
+        :param float timeout: The timeout in seconds
+        :rtype: list
+
+        """
+        try:
+            return [fd for fd, _event in
+                    self.poller.poll(max(timeout, 0) * self.scale)]
+        except (IOError, OSError, select.error) as error:
+            if error.args[0] == errno.EINTR:
+                return list()
+            raise
+
+    def unregister(self, fd):
+        """Stop waiting for events on the file descriptor
+
+        :param int fd: The file descriptor
+
+        """
+        self.poller.unregister(fd)
+
+
+class Target(object):
+    """The state of polling a single plugin instance"""
+    def __init__(self, plugin, connection, reused, deadline):
+        self.connection = connection
+        self.deadline = deadline
+        self.plugin = plugin
+        self.received = connections.receive_buffer()
+        self.request = plugin.request(reused) or ''
+        self.reused = reused
+        if not reused:
+            self.state = CONNECTING
+        elif self.request:
+            self.state = WRITING
+        else:
+            self.state = READING
+
+
+class SocketPoller(object):
+    """Poll many SocketStatsPlugin instances from a single thread. Every
+    target is connected to (or has a connection taken from its pool) up
+    front, requests are written as the sockets become writable and replies
+    are framed by each plugin's reply_complete method before being handed to
+    its parse_reply and add_datapoints methods, so polling all of the targets
+    takes about as long as the slowest one.
+
+    """
+    def __init__(self, plugins):
+        self.plugins = plugins
+        self.retries = list()
+        self.selector = None
+        self.targets = dict()
+
+    def poll(self):
+        """Poll all of the plugins, returning when they have all completed or
+        timed out. Each target has its own deadline, from the configured
+        socket timeout of its plugin, and fails as soon as it has passed
+        without waiting for the slower targets.
+
+        """
+        self.selector = Selector()
+        for plugin in self.plugins:
+            LOGGER.info('Polling %s', plugin.__class__.__name__)
+            plugin.initialize()
+            self.start(plugin, time.time() + plugin.config.get(
+                'timeout', plugin.SOCKET_TIMEOUT))
+
+        while self.targets:
+            now = time.time()
+            for target in [target for target in self.targets.values()
+                           if target.deadline <= now]:
+                self.expire(target)
+            if not self.targets:
+                break
+            deadline = min(target.deadline
+                           for target in self.targets.values())
+            for fd in self.selector.select(deadline - now):
+                if fd in self.targets:
+                    self.process(self.targets[fd])
+
+            # Reconnect after the batch of events so a reused file
+            # descriptor is not mistaken for the failed connection
+            while self.retries:
+                plugin, deadline = self.retries.pop()
+                self.start(plugin, deadline, False)
+        self.selector.close()
+
+    def complete(self, target):
+        """Hand the complete reply to the plugin and return the connection
+        to its pool.
+
+        :param Target target: The target that completed
+
+        """
+        plugin = target.plugin
+        try:
+            data = plugin.parse_reply(target.received.view())
+        except Exception as error:
+            LOGGER.exception('Error parsing reply from %s: %s',
+                             plugin.__class__.__name__, error)
+            data = None
+        self.remove(target)
+        if not data:
+            target.connection.close()
+            plugin.error_message()
+            return
+        target.connection.settimeout(plugin.config.get('timeout',
+                                                       plugin.SOCKET_TIMEOUT))
+        plugin.release(target.connection)
+        try:
+            plugin.add_datapoints(data)
+        except Exception as error:
+            LOGGER.exception('Error adding datapoints for %s: %s',
+                             plugin.__class__.__name__, error)
+            return
+        plugin.finish()
+
+    def expire(self, target):
+        """Fail the target once its deadline has passed
+
+        :param Target target: The target that timed out
+
+        """
+        LOGGER.error('Timeout polling %s', target.plugin.__class__.__name__)
+        self.remove(target)
+        target.connection.close()
+        target.plugin.error_message()
+
+    def fail(self, target, error, retry=True):
+        """Handle a failed target, retrying once on a new connection if the
+        connection was taken from the pool.
+
+        :param Target target: The target that failed
+        :param mixed error: The error that occurred
+        :param bool retry: Retry if the connection was taken from the pool
+
+        """
+        self.remove(target)
+        target.connection.close()
+        if retry and target.reused:
+            LOGGER.debug('Pooled connection failed, reconnecting: %s', error)
+            self.retries.append((target.plugin, target.deadline))
+            return
+        LOGGER.error('Error polling %s: %s',
+                     target.plugin.__class__.__name__, error)
+        target.plugin.error_message()
+
+    def process(self, target):
+        """Advance the target when its socket is ready
+
+        :param Target target: The target to process
+
+        """
+        connection = target.connection
+        try:
+            if target.state == CONNECTING:
+                result = connection.getsockopt(socket.SOL_SOCKET,
+                                               socket.SO_ERROR)
+                if result:
+                    raise socket.error(result, errno.errorcode.get(result))
+                target.state = WRITING
+            if target.state == WRITING:
+                if target.request:
+                    sent = connection.send(target.request)
+                    target.request = target.request[sent:]
+                if not target.request:
+                    target.state = READING
+                    self.selector.modify(connection.fileno(), False)
+                return
+            count = target.received.recv(
+                connection, target.plugin.recv_size(target.received))
+        except socket.error as error:
+            if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.fail(target, error)
+
+        if len(target.received) > target.plugin.max_response_size:
+            return self.fail(target, 'reply is over the %i byte limit' %
+                             target.plugin.max_response_size, False)
+
+        if target.plugin.reply_complete(target.received, not count):
+            self.complete(target)
+        elif not count:
+            self.fail(target, 'connection closed before reply completed')
+
+    def remove(self, target):
+        """Stop tracking the target and release its receive buffer
+
+        :param Target target: The target to remove
+
+        """
+        fd = target.connection.fileno()
+        self.selector.unregister(fd)
+        del self.targets[fd]
+        connections.release_buffer(target.received)
+
+    def start(self, plugin, deadline, use_pool=True):
+        """Start polling the plugin, using a pooled connection if there is
+        one, otherwise starting a non-blocking connect.
+
+        :param newrelic_plugin_agent.plugins.base.SocketStatsPlugin plugin:
+        :param float deadline: When polling the plugin times out
+        :param bool use_pool: Try to use a pooled connection
+
+        """
+        connection = None
+        if use_pool and plugin.persistent:
+            connection = plugin.pool.get()
+        reused = connection is not None
+        if not reused:
+            try:
+                connection = plugin.socket_connect(False)
+            except socket.error as error:
+                LOGGER.error('Error connecting to %s: %s',
+                             plugin.__class__.__name__, error)
+                connection = None
+            if not connection:
+                plugin.error_message()
+                return
+        connection.setblocking(0)
+        target = Target(plugin, connection, reused, deadline)
+        self.targets[connection.fileno()] = target
+        self.selector.register(connection.fileno(), target.state != READING)
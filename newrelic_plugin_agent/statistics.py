@@ -0,0 +1,249 @@
+"""
+Streaming statistics used to summarize values before they are sent to the
+NewRelic platform.
+
+"""
+import collections
+import math
+
+
+class Accumulator(object):
+    """Fold a stream of values into count, mean, min, max and the sum of
+    squares using Welford's online algorithm, so no individual sample needs
+    to be retained.
+
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value, min_val=None, max_val=None):
+        """Fold a value into the accumulator. If the source reported its own
+        min or max value along with the sample, those are honored as well.
+
+        :param int|float value: The sampled value
+        :param int|float min_val: Optional source reported minimum
+        :param int|float max_val: Optional source reported maximum
+
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+        for low in (value, min_val):
+            if low is not None and (self.min is None or low < self.min):
+                self.min = low
+        for high in (value, max_val):
+            if high is not None and (self.max is None or high > self.max):
+                self.max = high
+
+    @property
+    def stddev(self):
+        """Return the population standard deviation of the folded values
+
+        :rtype: float
+
+        """
+        if not self.count:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+    @property
+    def sum_of_squares(self):
+        """Return the sum of the squared values
+
+        :rtype: float
+
+        """
+        return self.m2 + self.count * self.mean * self.mean
+
+    @property
+    def total(self):
+        """Return the sum of the folded values
+
+        :rtype: float
+
+        """
+        return self.mean * self.count
+
+
+class WindowedMinMax(object):
+    """Track the minimum and maximum of the values seen over the last
+    ``window`` intervals. Two monotonic deques hold only the values that can
+    still become the min or max, so each update is amortized O(1) and the
+    memory used is bounded by the window size.
+
+    """
+    def __init__(self, window):
+        self.window = window
+        self.last_interval = None
+        self._min = collections.deque()
+        self._max = collections.deque()
+
+    def add(self, interval, value):
+        """Add the value for the given interval number, expiring any values
+        that have fallen out of the window.
+
+        :param int interval: The monotonically increasing interval number
+        :param int|float value: The value for the interval
+        :rtype: tuple
+
+        """
+        self.last_interval = interval
+        expired = interval - self.window
+        for values in (self._min, self._max):
+            while values and values[0][0] <= expired:
+                values.popleft()
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((interval, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((interval, value))
+        return self.min, self.max
+
+    @property
+    def max(self):
+        """Return the maximum value in the window
+
+        :rtype: int|float
+
+        """
+        return self._max[0][1] if self._max else None
+
+    @property
+    def min(self):
+        """Return the minimum value in the window
+
+        :rtype: int|float
+
+        """
+        return self._min[0][1] if self._min else None
+
+
+class QuantileSketch(object):
+    """Mergeable quantile sketch that counts values in logarithmically sized
+    buckets, in the manner of DDSketch. Quantiles are accurate to within the
+    relative accuracy of the true value, the number of buckets is capped and
+    two sketches with the same accuracy can be merged without losing any
+    precision, so distributions from many sources can be combined.
+    Negative values are counted in their own buckets, keyed by their
+    magnitude.
+
+    """
+    MAX_BUCKETS = 2048
+    RELATIVE_ACCURACY = 0.01
+
+    def __init__(self, values=None, relative_accuracy=RELATIVE_ACCURACY,
+                 max_buckets=MAX_BUCKETS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.max_buckets = max_buckets
+        self.buckets = dict()
+        self.count = 0
+        self.max = None
+        self.min = None
+        self.negative_buckets = dict()
+        self.sum_of_squares = 0
+        self.total = 0
+        self.zero_count = 0
+        self._log_gamma = math.log(self.gamma)
+        for value in values or list():
+            self.add(value)
+
+    def add(self, value, count=1):
+        """Add a value to the sketch
+
+        :param int|float value: The value to add
+        :param int count: The number of times the value was observed
+
+        """
+        if value:
+            buckets = self.buckets if value > 0 else self.negative_buckets
+            key = int(math.ceil(math.log(abs(value)) / self._log_gamma))
+            buckets[key] = buckets.get(key, 0) + count
+            if len(buckets) > self.max_buckets:
+                self._collapse(buckets)
+        else:
+            self.zero_count += count
+        self.count += count
+        self.total += value * count
+        self.sum_of_squares += value * value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Merge another sketch into this one
+
+        :param QuantileSketch other: The sketch to merge
+        :raises: ValueError
+
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('Can not merge sketches of different accuracy')
+        for buckets, others in ((self.buckets, other.buckets),
+                                (self.negative_buckets,
+                                 other.negative_buckets)):
+            for key, count in others.items():
+                buckets[key] = buckets.get(key, 0) + count
+            while len(buckets) > self.max_buckets:
+                self._collapse(buckets)
+        self.count += other.count
+        self.total += other.total
+        self.sum_of_squares += other.sum_of_squares
+        self.zero_count += other.zero_count
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, quantile):
+        """Return the approximate value at the given quantile
+
+        :param float quantile: The quantile between 0 and 1
+        :rtype: float
+
+        """
+        if not self.count:
+            return None
+        rank = quantile * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative_buckets, reverse=True):
+            seen += self.negative_buckets[key]
+            if seen > rank:
+                return self._clamp(-2 * self.gamma ** key / (self.gamma + 1))
+        seen += self.zero_count
+        if seen > rank:
+            return self._clamp(0)
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return self._clamp(2 * self.gamma ** key / (self.gamma + 1))
+        return self.max
+
+    def _clamp(self, value):
+        """Return the value limited to the range of the values added
+
+        :param int|float value: The value to limit
+        :rtype: int|float
+
+        """
+        return max(self.min, min(value, self.max))
+
+    def _collapse(self, buckets):
+        """Fold the bucket of the smallest magnitude into the next one,
+        trading accuracy of the values closest to zero for a bounded number
+        of buckets.
+
+        :param dict buckets: The positive or negative buckets to collapse
+
+        """
+        keys = sorted(buckets)
+        buckets[keys[1]] += buckets.pop(keys[0])
@@ -0,0 +1,236 @@
+"""
+Streaming selection of fields from JSON documents. Only the fields that are
+asked for are decoded, everything else is skipped over with regular
+expressions without building any objects, so large subtrees such as per
+request variables cost little more than scanning their bytes. Whole
+documents are decoded with the fastest JSON decoder that is installed.
+
+"""
+import json
+import logging
+import re
+
+LOGGER = logging.getLogger(__name__)
+
+CONSTANTS = {'false': False, 'null': None, 'true': True}
+KEY = re.compile(r'\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*:\s*', re.S)
+NUMBER = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?')
+SCALAR = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null')
+SEPARATOR = re.compile(r'\s*([,\]}])\s*')
+SKIP = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.S)
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+WHITESPACE = re.compile(r'\s*')
+
+# Drop in replacements for json.loads, fastest first
+DECODERS = ('ujson', 'simplejson')
+
+# Marks the keys of an object that are not selected
+SKIPPED = object()
+
+
+def decode(data, offset):
+    """Decode the JSON value at offset, returning it and the offset after
+    it. Numbers and constants are converted directly, which is much cheaper
+    than calling json.loads for each of them.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The offset of the value
+    :rtype: tuple
+    :raises: ValueError
+
+    """
+    match = NUMBER.match(data, offset)
+    if match:
+        if match.group(1) or match.group(2):
+            return float(match.group(0)), match.end()
+        return int(match.group(0)), match.end()
+    end = skip(data, offset)
+    value = data[offset:end]
+    if value in CONSTANTS:
+        return CONSTANTS[value], end
+    return json.loads(value), end
+
+
+def fastest_decoder():
+    """Return the loads function of the fastest JSON decoder installed,
+    falling back to the json module of the standard library.
+
+    :rtype: callable
+
+    """
+    for name in DECODERS:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        LOGGER.debug('Decoding JSON with %s', name)
+        return module.loads
+    return json.loads
+
+
+loads = fastest_decoder()
+
+
+def fields_for(paths):
+    """Return the fields dict selecting the values at the dotted paths, in
+    which a * matches any key of an object, such as nodes.*.jvm.uptime.
+
+    :param iterable paths: The dotted paths of the values to select
+    :rtype: dict
+
+    """
+    selected = dict()
+    for value_path in paths:
+        keys = value_path.split('.')
+        parent = selected
+        for key in keys[:-1]:
+            if parent.get(key) is None:
+                parent[key] = dict()
+            parent = parent[key]
+        parent.setdefault(keys[-1], None)
+    return selected
+
+
+def select(data, fields):
+    """Return the selected fields of the JSON object in data. The fields
+    dict maps each key to select to None, to decode the whole value, or to
+    a fields dict to select from the value itself, which can be an object
+    or an array of objects. A * key selects every key of an object that is
+    not selected by name.
+
+    :param str|buffer data: The JSON document
+    :param dict fields: The fields to select
+    :rtype: dict
+    :raises: ValueError
+
+    """
+    value, _end = select_value(data, WHITESPACE.match(data).end(), fields)
+    return value
+
+
+def select_array(data, offset, fields):
+    """Select the fields from each object in the array at offset, returning
+    the list of selections and the offset after the array.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The offset of the opening bracket
+    :param dict fields: The fields to select
+    :rtype: tuple
+    :raises: ValueError
+
+    """
+    values = list()
+    offset = WHITESPACE.match(data, offset + 1).end()
+    if data[offset:offset + 1] == ']':
+        return values, offset + 1
+    while True:
+        value, offset = select_value(data, offset, fields)
+        values.append(value)
+        offset = separator(data, offset)
+        if data[offset - 1] == ']':
+            return values, offset
+        offset = WHITESPACE.match(data, offset).end()
+
+
+def select_object(data, offset, fields):
+    """Select the fields from the object at offset, returning them and the
+    offset after the object.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The offset of the opening brace
+    :param dict fields: The fields to select
+    :rtype: tuple
+    :raises: ValueError
+
+    """
+    values = dict()
+    offset = WHITESPACE.match(data, offset + 1).end()
+    if data[offset:offset + 1] == '}':
+        return values, offset + 1
+    while True:
+        match = KEY.match(data, offset)
+        if not match:
+            raise ValueError('Expected object key at %i' % offset)
+        key, offset = match.group(1), match.end()
+        if '\\' in key:
+            key = json.loads('"%s"' % key)
+        selected = fields.get(key, fields.get('*', SKIPPED))
+        if selected is None:
+            values[key], offset = decode(data, offset)
+        elif selected is not SKIPPED:
+            values[key], offset = select_value(data, offset, selected)
+        else:
+            offset = skip(data, offset)
+        offset = separator(data, offset)
+        if data[offset - 1] == '}':
+            return values, offset
+
+
+def select_value(data, offset, fields):
+    """Select the fields from the object or array of objects at offset,
+    returning the selection and the offset after the value.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The offset of the value
+    :param dict fields: The fields to select
+    :rtype: tuple
+    :raises: ValueError
+
+    """
+    char = data[offset:offset + 1]
+    if char == '{':
+        return select_object(data, offset, fields)
+    if char == '[':
+        return select_array(data, offset, fields)
+    return decode(data, offset)
+
+
+def separator(data, offset):
+    """Return the offset after the comma or closing bracket following the
+    value that ends at offset.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The end of the value
+    :rtype: int
+    :raises: ValueError
+
+    """
+    match = SEPARATOR.match(data, offset)
+    if not match:
+        raise ValueError('Expected , or closing bracket at %i' % offset)
+    return match.start(1) + 1
+
+
+def skip(data, offset):
+    """Return the offset after the JSON value at offset without decoding it.
+    Runs of strings and scalars are skipped in a single regular expression
+    match, so only the brackets of nested values are visited one at a time.
+
+    :param str|buffer data: The JSON document
+    :param int offset: The offset of the value
+    :rtype: int
+    :raises: ValueError
+
+    """
+    char = data[offset:offset + 1]
+    if char == '"':
+        match = STRING.match(data, offset)
+    elif char not in ('[', '{'):
+        match = SCALAR.match(data, offset)
+    else:
+        depth = 0
+        while True:
+            char = data[offset:offset + 1]
+            if char in ('[', '{'):
+                depth += 1
+            elif char in (']', '}'):
+                depth -= 1
+            else:
+                raise ValueError('Unterminated value at %i' % offset)
+            offset += 1
+            if not depth:
+                return offset
+            offset = SKIP.match(data, offset).end()
+    if not match:
+        raise ValueError('Invalid value at %i' % offset)
+    return match.end()
@@ -0,0 +1,190 @@
+"""
+Tests for newrelic_plugin_agent.plugins.base
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from newrelic_plugin_agent.plugins import base
+
+
+class QueuePlugin(base.Plugin):
+
+    ENTITIES = {'Queue/*': 'Published[messages]'}
+
+    def __init__(self, config):
+        super(QueuePlugin, self).__init__(dict(config, name='test'), 60)
+
+    def add_queues(self, published):
+        for queue, value in published.items():
+            for metric, units in (('Published', 'messages'),
+                                  ('Consumers', 'consumers')):
+                self.add_derive_value('Queue/%s/%s' % (queue, metric), units,
+                                      0)
+                self.add_derive_value('Queue/%s/%s' % (queue, metric), units,
+                                      value)
+
+    def metrics(self):
+        return self.component_data()['metrics']
+
+
+class LimitCardinalityTests(unittest.TestCase):
+
+    def test_unlimited(self):
+        plugin = QueuePlugin({})
+        plugin.add_queues({'a': 1, 'b': 2})
+        self.assertEqual(len(plugin.metrics()), 4)
+
+    def test_top_k(self):
+        plugin = QueuePlugin({'top_k': 2})
+        plugin.add_queues({'a': 1, 'b': 5, 'c': 3, 'd': 2})
+        metrics = plugin.metrics()
+        self.assertEqual(sorted(metrics),
+                         ['Component/Queue/__other__/Consumers[consumers]',
+                          'Component/Queue/__other__/Published[messages]',
+                          'Component/Queue/b/Consumers[consumers]',
+                          'Component/Queue/b/Published[messages]',
+                          'Component/Queue/c/Consumers[consumers]',
+                          'Component/Queue/c/Published[messages]'])
+        other = metrics['Component/Queue/__other__/Published[messages]']
+        self.assertEqual(other['total'], 3)
+
+    def test_other_entity_not_merged(self):
+        plugin = QueuePlugin({'top_k': 1})
+        plugin.add_queues({'Other': 10, 'a': 1, 'b': 2})
+        metrics = plugin.metrics()
+        self.assertEqual(
+            metrics['Component/Queue/Other/Published[messages]']['total'],
+            10)
+        self.assertEqual(
+            metrics['Component/Queue/__other__/Published[messages]']['total'],
+            3)
+
+    def test_max_metrics(self):
+        plugin = QueuePlugin({'max_metrics': 6})
+        plugin.add_queues(dict(('q%i' % index, index)
+                               for index in range(10)))
+        metrics = plugin.metrics()
+        self.assertLessEqual(len(metrics), 6)
+        self.assertIn('Component/Queue/q9/Published[messages]', metrics)
+        self.assertIn('Component/Queue/__other__/Published[messages]',
+                      metrics)
+        self.assertEqual(sum(payload['total']
+                             for metric, payload in metrics.items()
+                             if metric.endswith('Published[messages]')),
+                         sum(range(10)))
+
+    def test_entity_names_with_slashes(self):
+        plugin = QueuePlugin({'top_k': 1})
+        for queue, value in (('a/b', 5), ('c', 1)):
+            metric = 'Queue/%s/Published' % queue
+            plugin.add_derive_value(metric, 'messages', 0,
+                                    entity='Queue/%s' % queue)
+            plugin.add_derive_value(metric, 'messages', value,
+                                    entity='Queue/%s' % queue)
+        self.assertEqual(sorted(plugin.metrics()),
+                         ['Component/Queue/__other__/Published[messages]',
+                          'Component/Queue/a/b/Published[messages]'])
+
+
+class ClusterResultTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def tearDown(self):
+        base.CLUSTER_RESULTS.clear()
+
+    def fetch(self):
+        self.calls += 1
+        return {'calls': self.calls}
+
+    def test_shared(self):
+        key = ('Test', 'cluster', 'shared')
+        self.assertEqual(base.cluster_result(key, 60, self.fetch),
+                         {'calls': 1})
+        self.assertEqual(base.cluster_result(key, 60, self.fetch),
+                         {'calls': 1})
+        self.assertEqual(self.calls, 1)
+
+    def test_expired(self):
+        key = ('Test', 'cluster', 'expired')
+        base.cluster_result(key, 0, self.fetch)
+        time.sleep(0.01)
+        self.assertEqual(base.cluster_result(key, 0, self.fetch),
+                         {'calls': 2})
+
+    def test_expired_results_dropped(self):
+        base.cluster_result(('Test', 'cluster', 'old'), 0, self.fetch)
+        time.sleep(0.01)
+        base.expire_cluster_results()
+        self.assertNotIn(('Test', 'cluster', 'old'), base.CLUSTER_RESULTS)
+
+    def test_failure_not_cached(self):
+        key = ('Test', 'cluster', 'failed')
+        self.assertIsNone(base.cluster_result(key, 60, lambda: None))
+        self.assertEqual(base.cluster_result(key, 60, self.fetch),
+                         {'calls': 1})
+
+
+class ClusterLeaderTests(unittest.TestCase):
+
+    HOLD_LOCK = ('import fcntl, sys\n'
+                 'handle = open(sys.argv[1], "a+")\n'
+                 'fcntl.lockf(handle, fcntl.LOCK_EX)\n'
+                 'sys.stdout.write("locked\\n")\n'
+                 'sys.stdout.flush()\n'
+                 'sys.stdin.read()\n')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.directory, 'cluster.lock')
+
+    def tearDown(self):
+        handle = base.LEADER_LOCKS.pop(self.lock_path, None)
+        if handle:
+            handle.close()
+        shutil.rmtree(self.directory)
+
+    def test_leader(self):
+        self.assertTrue(base.cluster_leader(self.lock_path))
+        self.assertTrue(base.cluster_leader(self.lock_path))
+        with open(self.lock_path) as handle:
+            self.assertEqual(handle.read().split()[1], str(os.getpid()))
+
+    def test_follower(self):
+        holder = subprocess.Popen([sys.executable, '-c', self.HOLD_LOCK,
+                                   self.lock_path],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline(), 'locked\n')
+            self.assertFalse(base.cluster_leader(self.lock_path))
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        self.assertTrue(base.cluster_leader(self.lock_path))
+
+    def test_unwritable_lock_path(self):
+        self.assertTrue(base.cluster_leader(
+            os.path.join(self.directory, 'missing', 'cluster.lock')))
+
+    def test_plugin_follower_forgets_last_values(self):
+        holder = subprocess.Popen([sys.executable, '-c', self.HOLD_LOCK,
+                                   self.lock_path],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+        try:
+            holder.stdout.readline()
+            plugin = base.Plugin({'cluster_lock': self.lock_path}, 60,
+                                 {'Component/Queue/a/Published': 1})
+            self.assertFalse(plugin.cluster_leader)
+            self.assertEqual(plugin.derive_last_interval, {})
+        finally:
+            holder.stdin.close()
+            holder.wait()
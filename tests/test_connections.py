@@ -0,0 +1,157 @@
+"""
+Tests for newrelic_plugin_agent.connections
+
+"""
+import socket
+import threading
+import time
+import unittest
+
+from newrelic_plugin_agent import connections
+
+
+class SocketPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = connections.SocketPool()
+        self.local, self.remote = socket.socketpair()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.local.close()
+        self.remote.close()
+
+    def test_empty(self):
+        self.assertIsNone(self.pool.get())
+
+    def test_reuse(self):
+        self.pool.put(self.local)
+        self.assertIs(self.pool.get(), self.local)
+        self.assertIsNone(self.pool.get())
+
+    def test_timeout_restored(self):
+        self.local.settimeout(5)
+        self.pool.put(self.local)
+        self.assertEqual(self.pool.get().gettimeout(), 5)
+
+    def test_closed_by_remote(self):
+        self.pool.put(self.local)
+        self.remote.close()
+        self.assertIsNone(self.pool.get())
+
+    def test_unread_data(self):
+        self.pool.put(self.local)
+        self.remote.sendall('stale')
+        self.assertIsNone(self.pool.get())
+
+    def test_idle_timeout(self):
+        pool = connections.SocketPool(idle_timeout=0)
+        pool.put(self.local)
+        time.sleep(0.01)
+        self.assertIsNone(pool.get())
+
+    def test_max_idle(self):
+        pool = connections.SocketPool(max_idle=1)
+        other, other_remote = socket.socketpair()
+        try:
+            pool.put(self.local)
+            pool.put(other)
+            self.assertEqual(len(pool.idle), 1)
+        finally:
+            pool.clear()
+            other.close()
+            other_remote.close()
+
+    def test_shared_pool(self):
+        key = ('SocketPoolTests', 'shared')
+        self.assertIs(connections.socket_pool(key),
+                      connections.socket_pool(key))
+        self.assertIsNot(connections.socket_pool(key),
+                         connections.socket_pool(key + ('other',)))
+
+
+class ReceiveBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.local, self.remote = socket.socketpair()
+
+    def tearDown(self):
+        self.local.close()
+        self.remote.close()
+
+    def received(self, value, size=connections.ReceiveBuffer.INITIAL_SIZE):
+        buffer_ = connections.ReceiveBuffer(size)
+        sender = threading.Thread(target=self.remote.sendall, args=(value,))
+        sender.start()
+        while len(buffer_) < len(value):
+            buffer_.recv(self.local, 65536)
+        sender.join()
+        return buffer_
+
+    def test_recv(self):
+        received = self.received('+OK\r\n')
+        self.assertEqual(len(received), 5)
+        self.assertEqual(str(received.view()), '+OK\r\n')
+        self.assertEqual(str(received.view(1, 3)), 'OK')
+
+    def test_grows(self):
+        value = 'x' * 100000
+        received = self.received(value, 16)
+        self.assertEqual(str(received.view()), value)
+        self.assertGreaterEqual(len(received.data), len(value))
+
+    def test_closed(self):
+        received = connections.ReceiveBuffer()
+        self.remote.close()
+        self.assertEqual(received.recv(self.local, 1024), 0)
+
+    def test_framing(self):
+        received = self.received('$5\r\nhello\r\n$-1\r\n$3\r\nab')
+        self.assertTrue(received.startswith('$5'))
+        self.assertTrue(received.startswith('hello', 4))
+        self.assertFalse(received.startswith('$', -1))
+        self.assertEqual(received.bulk_end(), 11)
+        self.assertEqual(received.bulk_end(11), 16)
+        self.assertEqual(received.bulk_end(16), -1)
+        self.assertTrue(received.endswith('ab'))
+        self.assertEqual(received.find('hello'), 4)
+        self.assertEqual(received.find('hello', 5), -1)
+
+    def test_reset(self):
+        received = self.received('END\r\n')
+        received.reset()
+        self.assertEqual(len(received), 0)
+        self.assertFalse(received.endswith('\r\n'))
+
+    def test_free_list(self):
+        received = connections.receive_buffer()
+        received.length = 10
+        connections.release_buffer(received)
+        reused = connections.receive_buffer()
+        self.assertIs(reused, received)
+        self.assertEqual(len(reused), 0)
+        connections.release_buffer(reused)
+
+    def test_large_buffer_not_pooled(self):
+        received = connections.ReceiveBuffer(
+            connections.MAX_POOLED_BUFFER_SIZE + 1)
+        connections.release_buffer(received)
+        self.assertNotIn(received, connections.RECEIVE_BUFFERS)
+
+
+class HTTPSessionTests(unittest.TestCase):
+
+    def test_shared_per_user(self):
+        key = ('https', 'HTTPSessionTests:443', 'guest')
+        session = connections.http_session(key)
+        self.assertIs(connections.http_session(key), session)
+        self.assertIsNot(connections.http_session(key[:2] + ('admin',)),
+                         session)
+        self.assertIsNot(connections.http_session(('http',) + key[1:]),
+                         session)
+
+    def test_adapter_mounted(self):
+        session = connections.http_session(('http', 'HTTPSessionTests:80',
+                                            None))
+        self.assertIs(session.adapters['http://'],
+                      session.adapters['https://'])
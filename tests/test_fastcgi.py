@@ -0,0 +1,91 @@
+"""
+Tests for newrelic_plugin_agent.fastcgi
+
+"""
+import unittest
+
+from newrelic_plugin_agent import fastcgi
+
+
+def padded(record_type, content, padding):
+    return (fastcgi.HEADER.pack(fastcgi.VERSION, record_type, 1,
+                                len(content), padding) +
+            content + '\0' * padding)
+
+
+def records(data):
+    """Return the type and content of each record in data"""
+    values, offset = list(), 0
+    while offset < len(data):
+        _version, record_type, _request_id, length, padding = \
+            fastcgi.HEADER.unpack_from(data, offset)
+        start = offset + fastcgi.HEADER.size
+        values.append((record_type, data[start:start + length]))
+        offset = start + length + padding
+    return values
+
+
+END_REQUEST = fastcgi.record(fastcgi.END_REQUEST,
+                             fastcgi.END_REQUEST_BODY.pack(0, 0))
+
+
+class EncodeTests(unittest.TestCase):
+
+    def test_encode_length(self):
+        self.assertEqual(fastcgi.encode_length(5), '\x05')
+        self.assertEqual(fastcgi.encode_length(127), '\x7f')
+        self.assertEqual(fastcgi.encode_length(128), '\x80\x00\x00\x80')
+
+    def test_encode_params(self):
+        self.assertEqual(fastcgi.encode_params({'B': 'x', 'A': 12}),
+                         '\x01\x02A12\x01\x01Bx')
+
+    def test_request(self):
+        request = records(fastcgi.request({'REQUEST_METHOD': 'GET'},
+                                          keep_conn=True))
+        self.assertEqual([record_type for record_type, _content in request],
+                         [fastcgi.BEGIN_REQUEST, fastcgi.PARAMS,
+                          fastcgi.PARAMS, fastcgi.STDIN])
+        self.assertEqual(fastcgi.BEGIN_REQUEST_BODY.unpack(request[0][1]),
+                         (fastcgi.RESPONDER, fastcgi.KEEP_CONN))
+        self.assertEqual(request[1][1], '\x0e\x03REQUEST_METHODGET')
+        self.assertEqual(request[2][1], '')
+        self.assertEqual(request[3][1], '')
+
+    def test_request_large_params(self):
+        request = records(fastcgi.request({'QUERY_STRING': 'x' * 100000}))
+        params = [content for record_type, content in request
+                  if record_type == fastcgi.PARAMS]
+        self.assertEqual(len(params), 3)
+        self.assertEqual(''.join(params),
+                         fastcgi.encode_params({'QUERY_STRING':
+                                                'x' * 100000}))
+
+
+class ResponseTests(unittest.TestCase):
+
+    def test_response(self):
+        data = (padded(fastcgi.STDOUT, 'Status: 200\r\n', 3) +
+                padded(fastcgi.STDERR, 'warning', 1) +
+                padded(fastcgi.STDOUT, '\r\n{}', 0) +
+                fastcgi.record(fastcgi.END_REQUEST,
+                               fastcgi.END_REQUEST_BODY.pack(1, 0)))
+        self.assertEqual(fastcgi.response(data),
+                         ('Status: 200\r\n\r\n{}', 'warning', 1))
+        self.assertEqual(fastcgi.response(buffer(data)),
+                         ('Status: 200\r\n\r\n{}', 'warning', 1))
+
+    def test_no_end_request(self):
+        self.assertRaises(ValueError, fastcgi.response,
+                          fastcgi.record(fastcgi.STDOUT, 'partial'))
+
+    def test_unsupported_version(self):
+        self.assertRaises(ValueError, fastcgi.response,
+                          '\x02' + END_REQUEST[1:])
+
+    def test_response_end(self):
+        data = padded(fastcgi.STDOUT, 'body', 4) + END_REQUEST + 'next'
+        end = len(data) - 4
+        self.assertEqual(fastcgi.response_end(data, len(data)), end)
+        for length in range(end):
+            self.assertEqual(fastcgi.response_end(data, length), -1)
@@ -0,0 +1,73 @@
+"""
+Tests for the stats socket parsing of newrelic_plugin_agent.plugins.haproxy
+
+"""
+import unittest
+
+from newrelic_plugin_agent.plugins import haproxy
+
+INFO = ('Name: HAProxy\n'
+        'Version: 2.4.0\n'
+        'Maxconn: 2000\n'
+        'CurrConns: 12\n'
+        'CumConns: 400\n'
+        'Idle_pct: 97\n'
+        '\n')
+
+STAT = ('# pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,dreq,dresp,'
+        'ereq,econ,eresp,wretr,wredis,status,downtime,hrsp_5xx,\n'
+        'web,FRONTEND,,,10,20,2000,300,1000,2000,1,0,2,,,,,OPEN,,4,\n'
+        'app,app1,0,1,5,9,,150,500,900,,0,,0,1,2,0,UP,10,1,\n'
+        'app,app2,1,2,3,7,,100,400,800,,0,,1,0,0,1,UP,0,0,\n'
+        'app,BACKEND,1,2,8,16,200,250,900,1700,0,0,,1,1,2,1,UP,10,1,\n'
+        '\n')
+
+
+class HAProxySocketTests(unittest.TestCase):
+
+    def plugin(self, **config):
+        return haproxy.HAProxy(dict(config, stats_socket=True,
+                                    path='/run/haproxy.sock'), 60)
+
+    def test_request(self):
+        self.assertEqual(self.plugin().request(False),
+                         'show info;show stat\n')
+
+    def test_parse_reply(self):
+        stats = self.plugin().parse_reply(buffer(INFO + STAT))
+        self.assertEqual(stats['info'], {'Maxconn': 2000, 'CurrConns': 12,
+                                         'CumConns': 400, 'Idle_pct': 97})
+        self.assertEqual(len(stats['rows']), 4)
+        frontend = stats['rows'][0]
+        self.assertEqual(frontend[:2], ('web', 'FRONTEND'))
+        columns = haproxy.HAProxy.COLUMNS
+        self.assertEqual(frontend[2 + columns.index('scur')], 10)
+        self.assertEqual(frontend[2 + columns.index('qcur')], 0)
+        self.assertEqual(frontend[2 + columns.index('hrsp_5xx')], 4)
+
+    def test_unexpected_reply(self):
+        self.assertIsNone(self.plugin().parse_reply(
+            buffer('Unknown command. Please enter one of the following '
+                   'commands only :\n')))
+
+    def test_add_datapoints(self):
+        plugin = self.plugin(servers=True)
+        plugin.add_datapoints(plugin.parse_reply(buffer(INFO + STAT)))
+        gauges = plugin.gauge_values
+        self.assertEqual(
+            gauges['Component/Frontends/web/Sessions/Current[sessions]']
+            ['total'], 10)
+        self.assertEqual(
+            gauges['Component/Servers/app/app2/Queue/Current[connections]']
+            ['total'], 1)
+        self.assertEqual(
+            gauges['Component/Info/Connections/Current[connections]']['max'],
+            2000)
+        self.assertIn('Component/Backends/app/Bytes/In[bytes]',
+                      plugin.derive_values)
+
+    def test_servers_not_reported_by_default(self):
+        plugin = self.plugin()
+        plugin.add_datapoints(plugin.parse_reply(buffer(INFO + STAT)))
+        self.assertFalse([metric for metric in plugin.gauge_values
+                          if metric.startswith('Component/Servers/')])
@@ -0,0 +1,105 @@
+"""
+Tests for the memcached STAT parsing and reply framing of
+newrelic_plugin_agent.plugins.memcached
+
+"""
+import unittest
+
+from newrelic_plugin_agent import connections
+from newrelic_plugin_agent.plugins import memcached
+
+STATS = ('STAT pid 1234\r\n'
+         'STAT version 1.6.9\r\n'
+         'STAT curr_items 42\r\n'
+         'STAT get_hits 10\r\n'
+         'STAT rusage_user 0.250000\r\n'
+         'STAT total_malloced 2048\r\n'
+         'END\r\n')
+
+SLABS = ('STAT 1:chunk_size 96\r\n'
+         'STAT 1:used_chunks 3\r\n'
+         'STAT 5:chunk_size 240\r\n'
+         'STAT active_slabs 2\r\n'
+         'END\r\n')
+
+ITEMS = ('STAT items:1:number 3\r\n'
+         'STAT items:1:evicted 1\r\n'
+         'STAT items:5:age 30\r\n'
+         'END\r\n')
+
+
+def received(value):
+    buffer_ = connections.ReceiveBuffer()
+    buffer_.data[:len(value)] = value
+    buffer_.length = len(value)
+    return buffer_
+
+
+class MemcachedTests(unittest.TestCase):
+
+    def test_request(self):
+        self.assertEqual(memcached.Memcached({}, 60).request(False),
+                         'stats\r\n')
+        self.assertEqual(memcached.Memcached({'slabs': True},
+                                             60).request(False),
+                         'stats\r\nstats slabs\r\nstats items\r\n')
+
+    def test_parse_stats(self):
+        plugin = memcached.Memcached({}, 60)
+        values = plugin.parse_reply(received(STATS).view())
+        self.assertEqual(values['curr_items'], 42)
+        self.assertEqual(values['get_hits'], 10)
+        self.assertEqual(values['rusage_user'], 0.25)
+        self.assertEqual(values['total_malloced'], 2048)
+        self.assertEqual(values['cmd_get'], 0)
+        self.assertNotIn('pid', values)
+        self.assertNotIn('slabs', values)
+
+    def test_parse_slabs(self):
+        plugin = memcached.Memcached({'slabs': True}, 60)
+        values = plugin.parse_reply(received(STATS + SLABS + ITEMS).view())
+        self.assertEqual(values['curr_items'], 42)
+        self.assertEqual(values['slabs'],
+                         {'1': {'chunk_size': 96, 'used_chunks': 3,
+                                'number': 3, 'evicted': 1},
+                          '5': {'chunk_size': 240, 'age': 30}})
+
+    def test_reply_complete(self):
+        plugin = memcached.Memcached({}, 60)
+        self.assertFalse(plugin.reply_complete(received(STATS[:-2]), False))
+        self.assertTrue(plugin.reply_complete(received(STATS), False))
+
+    def test_reply_complete_slabs(self):
+        plugin = memcached.Memcached({'slabs': True}, 60)
+        self.assertFalse(plugin.reply_complete(received(STATS + SLABS),
+                                               False))
+        self.assertTrue(plugin.reply_complete(received(STATS + SLABS +
+                                                       ITEMS), False))
+
+    def test_reply_complete_incremental(self):
+        plugin = memcached.Memcached({'slabs': True}, 60)
+        reply = STATS + SLABS + ITEMS
+        for step in (1, 2, 5, 13):
+            buffer_ = connections.ReceiveBuffer()
+            complete = list()
+            for offset in range(0, len(reply), step):
+                chunk = reply[offset:offset + step]
+                buffer_.data[buffer_.length:buffer_.length + len(chunk)] = \
+                    chunk
+                buffer_.length += len(chunk)
+                complete.append(plugin.reply_complete(buffer_, False))
+            self.assertEqual(complete.count(True), 1)
+            self.assertTrue(complete[-1])
+
+    def test_error_replies(self):
+        plugin = memcached.Memcached({'slabs': True}, 60)
+        reply = STATS + 'ERROR\r\nSERVER_ERROR not supported\r\n'
+        self.assertTrue(plugin.reply_complete(received(reply), False))
+        values = plugin.parse_reply(received(reply).view())
+        self.assertEqual(values['curr_items'], 42)
+        self.assertEqual(values['slabs'], {})
+
+    def test_stat_named_end(self):
+        plugin = memcached.Memcached({'slabs': True}, 60)
+        reply = 'STAT END 1\r\nSTAT ERROR 2\r\nEND\r\nEND\r\n'
+        self.assertFalse(plugin.reply_complete(received(reply), False))
@@ -0,0 +1,100 @@
+"""
+Tests for the FastCGI status polling of
+newrelic_plugin_agent.plugins.php_fpm
+
+"""
+import json
+import unittest
+
+from newrelic_plugin_agent import connections
+from newrelic_plugin_agent import fastcgi
+from newrelic_plugin_agent.plugins import php_fpm
+
+STATUS = {'pool': 'www',
+          'accepted conn': 120,
+          'listen queue': 0,
+          'active processes': 2,
+          'idle processes': 3,
+          'processes': [{'pid': 1, 'request duration': 100},
+                        {'pid': 2, 'request duration': 300}]}
+
+
+def fastcgi_response(stdout, stderr=''):
+    data = fastcgi.record(fastcgi.STDOUT, stdout)
+    if stderr:
+        data += fastcgi.record(fastcgi.STDERR, stderr)
+    return data + fastcgi.record(fastcgi.END_REQUEST,
+                                 fastcgi.END_REQUEST_BODY.pack(0, 0))
+
+
+def received(value):
+    buffer_ = connections.ReceiveBuffer()
+    buffer_.data[:len(value)] = value
+    buffer_.length = len(value)
+    return buffer_
+
+
+class FPMTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = php_fpm.FPM({'fastcgi': True,
+                                   'status_path': '/fpm-status'}, 60)
+
+    def test_remote_address(self):
+        self.assertEqual(self.plugin.remote_address, ('localhost', 9000))
+
+    def test_multiplexed(self):
+        self.assertTrue(php_fpm.FPM.multiplexed({'fastcgi': True}))
+        self.assertFalse(php_fpm.FPM.multiplexed({}))
+
+    def test_request(self):
+        request = self.plugin.request(False)
+        self.assertIn('SCRIPT_FILENAME/fpm-status', request)
+        self.assertIn('QUERY_STRINGjson', request)
+        begin = fastcgi.BEGIN_REQUEST_BODY.unpack_from(request,
+                                                       fastcgi.HEADER.size)
+        self.assertEqual(begin, (fastcgi.RESPONDER, fastcgi.KEEP_CONN))
+
+    def test_request_not_persistent(self):
+        plugin = php_fpm.FPM({'fastcgi': True, 'persistent': False}, 60)
+        begin = fastcgi.BEGIN_REQUEST_BODY.unpack_from(plugin.request(False),
+                                                       fastcgi.HEADER.size)
+        self.assertEqual(begin, (fastcgi.RESPONDER, 0))
+
+    def test_reply_complete(self):
+        reply = fastcgi_response('Content-type: application/json\r\n\r\n{}')
+        self.assertFalse(self.plugin.reply_complete(received(reply[:-1]),
+                                                    False))
+        self.assertTrue(self.plugin.reply_complete(received(reply), False))
+
+    def test_parse_reply(self):
+        reply = fastcgi_response('Content-type: application/json\r\n\r\n' +
+                                 json.dumps(STATUS))
+        self.assertEqual(self.plugin.parse_reply(received(reply).view()),
+                         STATUS)
+
+    def test_parse_reply_with_error_output(self):
+        reply = fastcgi_response('Content-type: application/json\r\n\r\n' +
+                                 json.dumps(STATUS), 'PHP Warning: slow')
+        self.assertEqual(self.plugin.parse_reply(received(reply).view()),
+                         STATUS)
+
+    def test_error_status(self):
+        reply = fastcgi_response('Status: 404 Not Found\r\n'
+                                 'Content-type: text/html\r\n\r\n'
+                                 'File not found.', 'Primary script unknown')
+        self.assertIsNone(self.plugin.parse_reply(received(reply).view()))
+
+    def test_invalid_json(self):
+        reply = fastcgi_response('Content-type: text/html\r\n\r\n<html>')
+        self.assertIsNone(self.plugin.parse_reply(received(reply).view()))
+
+    def test_invalid_response(self):
+        self.assertIsNone(self.plugin.parse_reply(
+            received(fastcgi.record(fastcgi.STDOUT, 'partial')).view()))
+
+    def test_add_datapoints(self):
+        self.plugin.add_datapoints(STATUS)
+        self.assertEqual(
+            self.plugin.gauge_values[
+                'Component/Processes/Idle[processes]']['total'], 3)
@@ -0,0 +1,127 @@
+"""
+Tests for newrelic_plugin_agent.poller
+
+"""
+import socket
+import threading
+import time
+import unittest
+
+from newrelic_plugin_agent import poller
+from newrelic_plugin_agent.plugins import base
+
+
+class LinePlugin(base.SocketStatsPlugin):
+
+    COMMAND = 'stats\r\n'
+
+    def add_datapoints(self, data):
+        self.add_gauge_value('Reply/Length', 'bytes', len(data))
+
+    def reply_complete(self, data, closed):
+        return data.endswith('\r\n')
+
+
+class LineServer(object):
+    """Reply to each stats line with the reply after waiting delay seconds"""
+
+    def __init__(self, reply='OK\r\n', delay=0):
+        self.connections = 0
+        self.delay = delay
+        self.reply = reply
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, _address = self.listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.listener.close()
+
+    def handle(self, connection):
+        try:
+            while connection.recv(1024):
+                time.sleep(self.delay)
+                connection.sendall(self.reply)
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def plugin(self, **config):
+        config.update({'host': '127.0.0.1', 'port': self.port})
+        return LinePlugin(config, 60)
+
+
+class SocketPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = list()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server(self, *args, **kwargs):
+        server = LineServer(*args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    @staticmethod
+    def polled(plugin):
+        return 'Component/Reply/Length[bytes]' in plugin.gauge_values
+
+    def test_parallel(self):
+        plugins = [self.server(delay=0.3).plugin(persistent=False)
+                   for _index in range(10)]
+        start = time.time()
+        poller.SocketPoller(plugins).poll()
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(all(self.polled(plugin) for plugin in plugins))
+
+    def test_pooled_connection_reused(self):
+        server = self.server()
+        poller.SocketPoller([server.plugin()]).poll()
+        plugin = server.plugin()
+        poller.SocketPoller([plugin]).poll()
+        self.assertTrue(self.polled(plugin))
+        self.assertEqual(server.connections, 1)
+
+    def test_own_deadline(self):
+        slow = self.server(delay=0.5).plugin(timeout=0.1, persistent=False)
+        fast = self.server(delay=0.2).plugin(timeout=2, persistent=False)
+        start = time.time()
+        poller.SocketPoller([slow, fast]).poll()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertFalse(self.polled(slow))
+        self.assertTrue(self.polled(fast))
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        plugin = LinePlugin({'host': '127.0.0.1', 'port': port}, 60)
+        poller.SocketPoller([plugin]).poll()
+        self.assertFalse(self.polled(plugin))
+
+    def test_max_response_size(self):
+        server = self.server(reply='x' * 10000 + '\r\n')
+        plugin = server.plugin(max_response_size=1000, persistent=False)
+        poller.SocketPoller([plugin]).poll()
+        self.assertFalse(self.polled(plugin))
+        self.assertEqual(server.connections, 1)
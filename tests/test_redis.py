@@ -0,0 +1,130 @@
+"""
+Tests for the Redis INFO and RESP parsing of
+newrelic_plugin_agent.plugins.redis
+
+"""
+import unittest
+
+from newrelic_plugin_agent import connections
+from newrelic_plugin_agent.plugins import redis
+
+INFO = ('# Clients\r\n'
+        'connected_clients:5\r\n'
+        'blocked_clients:1\r\n'
+        'client_longest_output_list:0\r\n'
+        '# Memory\r\n'
+        'used_memory:1048576\r\n'
+        'used_memory_human:1.00M\r\n'
+        'mem_fragmentation_ratio:1.25\r\n'
+        '# Replication\r\n'
+        'role:master\r\n'
+        'slave0:ip=10.0.0.2,port=6379,state=online,offset=90,lag=1\r\n'
+        'master_repl_offset:100\r\n'
+        '# Keyspace\r\n'
+        'db0:keys=10,expires=2,avg_ttl=0\r\n'
+        'db3:keys=7,expires=0,avg_ttl=0\r\n')
+
+COMMANDSTATS = ('# Commandstats\r\n'
+                'cmdstat_get:calls=10,usec=50,usec_per_call=5.00\r\n'
+                'cmdstat_set:calls=4,usec=40,usec_per_call=10.00\r\n')
+
+
+def bulk(value):
+    return '$%i\r\n%s\r\n' % (len(value), value)
+
+
+def received(value):
+    buffer_ = connections.ReceiveBuffer()
+    buffer_.data[:len(value)] = value
+    buffer_.length = len(value)
+    return buffer_
+
+
+class RedisTests(unittest.TestCase):
+
+    def plugin(self, **config):
+        plugin = redis.Redis(dict(config, info_sections=['all']), 60)
+        plugin.request(False)
+        return plugin
+
+    def test_command(self):
+        self.assertEqual(redis.Redis.command('INFO', 'memory'),
+                         '*2\r\n$4\r\nINFO\r\n$6\r\nmemory\r\n')
+
+    def test_request(self):
+        plugin = redis.Redis({'password': 'secret',
+                              'collect': ['slowlog', 'unknown']}, 60)
+        request = plugin.request(False)
+        self.assertTrue(request.startswith(redis.Redis.command('AUTH',
+                                                               'secret')))
+        self.assertEqual(plugin.pipeline,
+                         ['auth'] + ['info'] * len(plugin.INFO_SECTIONS) +
+                         ['slowlog'])
+        plugin.request(True)
+        self.assertNotIn('auth', plugin.pipeline)
+
+    def test_reply_complete(self):
+        plugin = self.plugin(collect=['latency'])
+        reply = bulk(INFO) + '*1\r\n*4\r\n$7\r\ncommand\r\n:1\r\n:5\r\n:9\r\n'
+        for end in range(len(reply)):
+            self.assertFalse(plugin.reply_complete(received(reply[:end]),
+                                                   False))
+        self.assertTrue(plugin.reply_complete(received(reply), False))
+
+    def test_parse_info(self):
+        plugin = self.plugin()
+        values = plugin.parse_reply(received(bulk(INFO)).view())
+        self.assertEqual(values['connected_clients'], 5)
+        self.assertEqual(values['blocked_clients'], 1)
+        self.assertEqual(values['used_memory'], 1048576)
+        self.assertEqual(values['mem_fragmentation_ratio'], 1.25)
+        self.assertEqual(values['master_repl_offset'], 100)
+        self.assertEqual(values['db0'], {'keys': 10, 'expires': 2,
+                                         'avg_ttl': 0})
+        self.assertEqual(values['db3']['keys'], 7)
+        self.assertEqual(values['replicas'][0]['ip'], '10.0.0.2')
+        self.assertNotIn('used_memory_human', values)
+        self.assertNotIn('client_longest_output_list', values)
+
+    def test_parse_collected(self):
+        plugin = self.plugin(collect=['commandstats', 'maxmemory',
+                                      'slowlog', 'latency'])
+        reply = (bulk(INFO) + bulk(COMMANDSTATS) +
+                 '*2\r\n$9\r\nmaxmemory\r\n$4\r\n1024\r\n' +
+                 ':3\r\n' +
+                 '-ERR unknown command \'LATENCY\'\r\n')
+        values = plugin.parse_reply(received(reply).view())
+        self.assertEqual(values['commandstats'], {'get': (10, 50),
+                                                  'set': (4, 40)})
+        self.assertEqual(values['maxmemory'], 1024)
+        self.assertEqual(values['slowlog'], 3)
+        self.assertNotIn('latency', values)
+        self.assertEqual(values['connected_clients'], 5)
+
+    def test_auth_error(self):
+        plugin = redis.Redis({'password': 'wrong', 'info_sections': []}, 60)
+        plugin.request(False)
+        reply = '-ERR invalid password\r\n' + bulk(INFO)
+        self.assertIsNone(plugin.parse_reply(received(reply).view()))
+
+    def test_read_reply(self):
+        plugin = self.plugin()
+        data = '*3\r\n:1\r\n$-1\r\n*2\r\n+OK\r\n-ERR no\r\n:7\r\n'
+        reply, offset = plugin.read_reply(data, 0)
+        self.assertEqual(reply[:2], [1, None])
+        self.assertEqual(reply[2][0], 'OK')
+        self.assertIsInstance(reply[2][1], redis.RedisError)
+        self.assertEqual(plugin.read_reply(data, offset), (7, len(data)))
+
+    def test_unexpected_reply(self):
+        plugin = self.plugin()
+        self.assertIsNone(plugin.parse_reply(received('garbage\r\n').view()))
+
+    def test_parse_replication(self):
+        plugin = self.plugin()
+        values = plugin.parse_replication('role:slave\r\n'
+                                          'master_host:10.0.0.1\r\n'
+                                          'master_port:6380\r\n')
+        self.assertEqual(values, {'role': 'slave',
+                                  'master_host': '10.0.0.1',
+                                  'master_port': '6380'})
@@ -0,0 +1,137 @@
+"""
+Tests for newrelic_plugin_agent.statistics
+
+"""
+import math
+import random
+import unittest
+
+from newrelic_plugin_agent import statistics
+
+
+class AccumulatorTests(unittest.TestCase):
+
+    def test_empty(self):
+        accumulator = statistics.Accumulator()
+        self.assertEqual(accumulator.count, 0)
+        self.assertEqual(accumulator.stddev, 0.0)
+        self.assertEqual(accumulator.total, 0)
+        self.assertIsNone(accumulator.min)
+        self.assertIsNone(accumulator.max)
+
+    def test_add(self):
+        values = [4, 8, 15, 16, 23, 42]
+        accumulator = statistics.Accumulator()
+        for value in values:
+            accumulator.add(value)
+        mean = sum(values) / float(len(values))
+        self.assertEqual(accumulator.count, len(values))
+        self.assertAlmostEqual(accumulator.mean, mean)
+        self.assertAlmostEqual(accumulator.total, sum(values))
+        self.assertAlmostEqual(accumulator.sum_of_squares,
+                               sum(value * value for value in values))
+        self.assertAlmostEqual(accumulator.stddev, math.sqrt(
+            sum((value - mean) ** 2 for value in values) / len(values)))
+        self.assertEqual(accumulator.min, 4)
+        self.assertEqual(accumulator.max, 42)
+
+    def test_source_min_max(self):
+        accumulator = statistics.Accumulator()
+        accumulator.add(10, min_val=2, max_val=20)
+        accumulator.add(12)
+        self.assertEqual(accumulator.min, 2)
+        self.assertEqual(accumulator.max, 20)
+
+
+class WindowedMinMaxTests(unittest.TestCase):
+
+    def test_window(self):
+        window = statistics.WindowedMinMax(3)
+        self.assertEqual(window.add(1, 5), (5, 5))
+        self.assertEqual(window.add(2, 1), (1, 5))
+        self.assertEqual(window.add(3, 3), (1, 5))
+        self.assertEqual(window.add(4, 4), (1, 4))
+        self.assertEqual(window.add(5, 2), (2, 4))
+        self.assertEqual(window.add(6, 2), (2, 4))
+        self.assertEqual(window.add(7, 2), (2, 2))
+
+    def test_bounded(self):
+        window = statistics.WindowedMinMax(10)
+        for interval in range(1000):
+            window.add(interval, interval % 17)
+        self.assertLessEqual(len(window._min), 10)
+        self.assertLessEqual(len(window._max), 10)
+
+    def test_empty(self):
+        window = statistics.WindowedMinMax(3)
+        self.assertIsNone(window.min)
+        self.assertIsNone(window.max)
+
+
+class QuantileSketchTests(unittest.TestCase):
+
+    def assertAccurate(self, sketch, values, accuracy=0.02):
+        values = sorted(values)
+        for quantile in (0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1):
+            expected = values[int(quantile * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(quantile) - expected),
+                                 abs(expected) * accuracy)
+
+    def test_empty(self):
+        self.assertIsNone(statistics.QuantileSketch().quantile(0.5))
+
+    def test_positive(self):
+        values = [random.uniform(1, 10000) for _index in range(5000)]
+        sketch = statistics.QuantileSketch(values)
+        self.assertEqual(sketch.count, 5000)
+        self.assertAlmostEqual(sketch.total, sum(values), 3)
+        self.assertEqual(sketch.min, min(values))
+        self.assertEqual(sketch.max, max(values))
+        self.assertAccurate(sketch, values)
+
+    def test_negative(self):
+        values = [random.uniform(-1000, 1000) for _index in range(5000)]
+        sketch = statistics.QuantileSketch(values)
+        self.assertAccurate(sketch, values)
+        self.assertLess(sketch.quantile(0.1), 0)
+
+    def test_zeros(self):
+        sketch = statistics.QuantileSketch([0, 0, 0, 5])
+        self.assertEqual(sketch.zero_count, 3)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertEqual(sketch.quantile(1), 5)
+
+    def test_count(self):
+        sketch = statistics.QuantileSketch()
+        sketch.add(10, 3)
+        sketch.add(20)
+        self.assertEqual(sketch.count, 4)
+        self.assertEqual(sketch.total, 50)
+        self.assertEqual(sketch.sum_of_squares, 700)
+
+    def test_merge(self):
+        left = [random.uniform(-100, 100) for _index in range(2000)]
+        right = [random.uniform(0, 500) for _index in range(2000)]
+        sketch = statistics.QuantileSketch(left)
+        sketch.merge(statistics.QuantileSketch(right))
+        combined = statistics.QuantileSketch(left + right)
+        self.assertEqual(sketch.buckets, combined.buckets)
+        self.assertEqual(sketch.negative_buckets, combined.negative_buckets)
+        self.assertEqual(sketch.count, combined.count)
+        self.assertEqual(sketch.min, combined.min)
+        self.assertEqual(sketch.max, combined.max)
+
+    def test_merge_accuracy_mismatch(self):
+        self.assertRaises(ValueError, statistics.QuantileSketch().merge,
+                          statistics.QuantileSketch(relative_accuracy=0.05))
+
+    def test_max_buckets(self):
+        values = [1.1 ** exponent for exponent in range(1000)]
+        sketch = statistics.QuantileSketch(values + [-value
+                                                     for value in values],
+                                           max_buckets=50)
+        self.assertLessEqual(len(sketch.buckets), 50)
+        self.assertLessEqual(len(sketch.negative_buckets), 50)
+        self.assertEqual(sketch.count, 2000)
+        self.assertLessEqual(abs(sketch.quantile(1) - max(values)),
+                             max(values) * 0.01)
@@ -0,0 +1,101 @@
+"""
+Tests for newrelic_plugin_agent.streaming
+
+"""
+import json
+import unittest
+
+from newrelic_plugin_agent import streaming
+
+DOCUMENT = json.dumps({
+    'version': '2.0.14',
+    'listen_queue': 3,
+    'load': 1.5,
+    'workers': [{'id': 1, 'requests': 100, 'status': 'idle',
+                 'apps': [{'id': 0, 'mountpoint': '', 'requests': 100}],
+                 'cores': [{'id': 0, 'vars': ['PATH_INFO=/', 'A=[{']}]},
+                {'id': 2, 'requests': 5, 'status': 'busy',
+                 'apps': [], 'cores': []}],
+    'sockets': [{'name': ':8080', 'queue': 0}],
+    'nodes': {'a': {'jvm': {'uptime': 10, 'heap': 5},
+                    'name': 'node "a"'},
+              'b': {'jvm': {'uptime': 20}, 'name': 'node b'}},
+    'empty': {},
+    'flags': [True, False, None],
+    'exponent': 1e3,
+    'negative': -7})
+
+
+class FieldsForTests(unittest.TestCase):
+
+    def test_paths(self):
+        self.assertEqual(streaming.fields_for(['a.b', 'a.c.d', 'e']),
+                         {'a': {'b': None, 'c': {'d': None}}, 'e': None})
+
+    def test_wildcard(self):
+        self.assertEqual(streaming.fields_for(['nodes.*.jvm.uptime',
+                                               'nodes.*.name']),
+                         {'nodes': {'*': {'jvm': {'uptime': None},
+                                          'name': None}}})
+
+
+class SelectTests(unittest.TestCase):
+
+    def test_scalars(self):
+        self.assertEqual(streaming.select(DOCUMENT,
+                                          {'listen_queue': None,
+                                           'load': None,
+                                           'exponent': None,
+                                           'negative': None,
+                                           'version': None,
+                                           'flags': None}),
+                         {'listen_queue': 3, 'load': 1.5, 'exponent': 1000.0,
+                          'negative': -7, 'version': '2.0.14',
+                          'flags': [True, False, None]})
+
+    def test_array_of_objects(self):
+        selected = streaming.select(DOCUMENT, {'workers': {'id': None,
+                                                           'requests': None}})
+        self.assertEqual(selected, {'workers': [{'id': 1, 'requests': 100},
+                                                {'id': 2, 'requests': 5}]})
+
+    def test_nested(self):
+        selected = streaming.select(
+            DOCUMENT, {'workers': {'apps': {'requests': None}}})
+        self.assertEqual(selected['workers'][0]['apps'], [{'requests': 100}])
+        self.assertEqual(selected['workers'][1]['apps'], [])
+
+    def test_wildcard(self):
+        selected = streaming.select(
+            DOCUMENT, streaming.fields_for(['nodes.*.jvm.uptime',
+                                            'nodes.*.name']))
+        self.assertEqual(selected, {'nodes': {
+            'a': {'jvm': {'uptime': 10}, 'name': 'node "a"'},
+            'b': {'jvm': {'uptime': 20}, 'name': 'node b'}}})
+
+    def test_whole_value(self):
+        selected = streaming.select(DOCUMENT, {'sockets': None,
+                                               'empty': None})
+        self.assertEqual(selected, {'sockets': [{'name': ':8080',
+                                                 'queue': 0}],
+                                    'empty': {}})
+
+    def test_matches_loads(self):
+        self.assertEqual(streaming.select(DOCUMENT, {'*': None}),
+                         json.loads(DOCUMENT))
+
+    def test_buffer(self):
+        self.assertEqual(streaming.select(buffer(DOCUMENT),
+                                          {'listen_queue': None}),
+                         {'listen_queue': 3})
+
+    def test_invalid(self):
+        for document in ('{"a": 1', '{"a" 1}', '{"a": [1, 2}', '{1: 2}'):
+            self.assertRaises(ValueError, streaming.select, document,
+                              {'a': None})
+
+
+class LoadsTests(unittest.TestCase):
+
+    def test_loads(self):
+        self.assertEqual(streaming.loads(DOCUMENT), json.loads(DOCUMENT))